@@ -4,24 +4,60 @@ Importing this will run LoginKeychain(), which tries to determine the importing
 user's login keychain and sets the global variable login_keychain accordingly.
 """
 
+import base64
+import binascii
 import datetime
+import hashlib
+import heapq
+import json
 import logging
-import operator
+from multiprocessing import pool as thread_pool
+import optparse
 import os
 import re
 import shutil
+import sys
 import tempfile
+import threading
+import time
+from . import defaults
 from . import gmacpyutil
 from . import getauth
 
+# strptime imports _strptime on first use, which is not thread safe.
+import _strptime  # pylint: disable=unused-import,g-bad-import-order
+
+try:
+  from OpenSSL import crypto
+except ImportError:
+  crypto = None
+
 
 CMD_OPENSSL = '/usr/bin/openssl'
 CMD_SECURITY = '/usr/bin/security'
+CMD_NICE = '/usr/bin/nice'
+CMD_SUDO = '/usr/bin/sudo'
 PEM_HEADER = '-----BEGIN CERTIFICATE-----'
 PEM_FOOTER = '-----END CERTIFICATE-----'
 OPENSSL_DATETIME_FORMAT = '%b %d %H:%M:%S %Y %Z'
 SYSTEM_KEYCHAIN = '/Library/Keychains/System.keychain'
+SYSTEM_ROOTS_KEYCHAIN = (
+    '/System/Library/Keychains/SystemRootCertificates.keychain')
+CERTS_INDEX_DIR = defaults.CERTS_INDEX_DIR
+# Whether KeyPools keep unencrypted private keys on disk unless told to.
+KEY_POOL_ENABLED = defaults.CERTS_KEY_POOL
+KEY_POOL_DIR = defaults.CERTS_KEY_POOL_DIR
+KEY_POOL_SIZE = defaults.CERTS_KEY_POOL_SIZE
+# Seconds after which an unfinished or abandoned key file in a pool is removed.
+KEY_POOL_STALE_AGE = 3600
+# Number of threads parsing certificates from a keychain dump.
+CERT_PARSE_THREADS = 4
+# (name, seconds) of the expiry buckets counted by ScanCertificateExpiry
+EXPIRY_BUCKETS = (('expired', 0), ('7d', 7 * 24 * 3600),
+                  ('30d', 30 * 24 * 3600))
+EXPIRY_SCAN_TOP = 10
 login_keychain = None
+_keychain_indexes = {}
 
 
 class Error(Exception):
@@ -39,8 +75,13 @@ class KeychainError(Error):
 class Certificate(object):
   """Basic certificate object.
 
-  The Certificate constructor accepts a string of PEM-encoded data. The object
-  will populate with attributes decoded from the PEM.
+  The Certificate constructor accepts a string of PEM-encoded data. Attributes
+  are decoded from the PEM on first access: fingerprint and osx_fingerprint
+  only need a SHA-1 of the DER data, and the first access to any other
+  attribute parses the whole certificate once. Attributes live in __slots__,
+  so a Certificate holds little more than its PEM data. A certificate that
+  cannot be parsed raises CertError on attribute access, not on construction;
+  the parse is only attempted once, and later accesses raise the same error.
 
   Certificate objects will have these read-only attributes:
   certhash        hash of the certificate's subject name
@@ -61,17 +102,124 @@ class Certificate(object):
     pem: str, PEM-encoded data
   """
 
+  _ATTRIBUTES = ('certhash', 'subject', 'subject_cn', 'serial', 'issuer',
+                 'issuer_cn', 'startdate', 'enddate', 'fingerprint',
+                 'osx_fingerprint', 'email')
+  _FINGERPRINT_ATTRIBUTES = ('fingerprint', 'osx_fingerprint')
+  __slots__ = ('pem', '_parsed', '_parse_error') + _ATTRIBUTES
+
   def __init__(self, pem):
     self.pem = pem
-    self._ParsePEMCertificate(pem)
+    self._parsed = False
+    self._parse_error = None
+
+  def __getattr__(self, name):
+    # Only called for slots which have not been set yet.
+    if name in self._FINGERPRINT_ATTRIBUTES:
+      self._SetFingerprint()
+    elif name in self._ATTRIBUTES and (not self._parsed or self._parse_error):
+      self.Parse()
+    else:
+      raise AttributeError(name)
+    return object.__getattribute__(self, name)
 
   def get(self, key):  # pylint: disable=g-bad-name
-    return self.__dict__.get(key, None)
+    return getattr(self, key, None)
 
+  def Parse(self):
+    """Parses the whole certificate now, unless that was already done.
+
+    Raises:
+      CertError: unable to get certificate data, now or on an earlier attempt
+    """
+    if self._parse_error is not None:
+      raise self._parse_error  # pylint: disable=raising-bad-type
+    if not self._parsed:
+      try:
+        self._ParsePEMCertificate(self.pem)
+      except CertError, e:
+        self._parse_error = e
+        raise
+      finally:
+        self._parsed = True
+
+  def _SetFingerprint(self):
+    """Sets fingerprint and osx_fingerprint from the DER data.
+
+    Raises:
+      CertError: the PEM data could not be decoded
+    """
+    body = [line for line in self.pem.strip().splitlines()
+            if line and not line.startswith('-----')]
+    try:
+      der = base64.b64decode(''.join(body))
+    except (binascii.Error, TypeError) as e:
+      raise CertError('Unable to decode certificate: %s' % e)
+    if not der:
+      raise CertError('Unable to decode certificate: no data')
+    self.osx_fingerprint = hashlib.sha1(der).hexdigest().upper()
+    self.fingerprint = ':'.join(
+        self.osx_fingerprint[i:i + 2]
+        for i in range(0, len(self.osx_fingerprint), 2))
 
   def _ParsePEMCertificate(self, pem):
     """Reads data from PEM encoded certificate.
 
+    The certificate is parsed in-process with pyOpenSSL when it is available,
+    which avoids forking openssl for every certificate in a keychain. If
+    pyOpenSSL is missing or cannot load the data, we fall back to openssl x509.
+    Both paths set the same attributes in the same format.
+
+    Args:
+      pem: str, PEM-encoded data
+
+    Raises:
+      CertError: unable to get certificate data
+    """
+    if crypto is not None:
+      try:
+        self._ParsePEMCertificateInProcess(pem)
+        return
+      except crypto.Error:
+        pass
+    self._ParsePEMCertificateWithOpenSSL(pem)
+
+  def _ParsePEMCertificateInProcess(self, pem):
+    """Reads data from PEM encoded certificate using pyOpenSSL.
+
+    The values are formatted to match the output of openssl x509 as parsed by
+    _ParsePEMCertificateWithOpenSSL: names in the compat (oneline) format,
+    dates as "Apr 29 18:09:17 2036 GMT", the serial as upper-case hex padded to
+    whole bytes, and the hash as 8 hex digits.
+
+    Args:
+      pem: str, PEM-encoded data
+
+    Raises:
+      crypto.Error: pyOpenSSL could not load the certificate
+    """
+    x509 = crypto.load_certificate(crypto.FILETYPE_PEM, pem)
+
+    self.certhash = '%08x' % x509.subject_name_hash()
+    for attr, name in (('subject', x509.get_subject()),
+                       ('issuer', x509.get_issuer())):
+      name = _OneLineName(name)
+      setattr(self, attr, name)
+      cn = _CNFromOneLineName(name)
+      if cn is not None:
+        setattr(self, ''.join([attr, '_cn']), cn)
+    for attr, asn1_time in (('startdate', x509.get_notBefore()),
+                            ('enddate', x509.get_notAfter())):
+      setattr(self, attr, _OpenSSLDate(asn1_time))
+    fingerprint = x509.digest('sha1')
+    self.fingerprint = fingerprint
+    self.osx_fingerprint = re.sub(':', '', fingerprint)
+    self.serial = _OpenSSLSerial(x509.get_serial_number())
+    self.email = ''.join(_Emails(x509))
+
+  def _ParsePEMCertificateWithOpenSSL(self, pem):
+    """Reads data from PEM encoded certificate using openssl x509.
+
     This method take a PEM-encoded certificate and parses it with openssl x509.
     It adds attributes to the object from the parsed output. We feed the PEM
     data though openssl x509 once, with a given order of requested attributes,
@@ -104,22 +252,22 @@ class Certificate(object):
 
     for attr in attrs:
       command.extend(['-%s' % attr])
-    (stdout, stderr, returncode) = gmacpyutil.RunProcess(command, pem)
+    # This runs on _GetCertificates' parsing threads.
+    (stdout, stderr, returncode) = gmacpyutil.RunProcess(command, pem,
+                                                         close_fds=True)
     if returncode:
       raise CertError('Unable to retrieve data for certificates: %s' % stderr)
     output = stdout.splitlines()
     for index, attr in enumerate(attrs):
       if attr in ('issuer', 'subject'):
         name = output[index].split(' ', 1)[1]
-        self.__dict__[attr] = name
-        try:
-          self.__dict__[''.join([attr, '_cn'])] = (
-              name.split('/')[-1].split('=')[1])
-        except IndexError:
-          pass
+        setattr(self, attr, name)
+        cn = _CNFromOneLineName(name)
+        if cn is not None:
+          setattr(self, ''.join([attr, '_cn']), cn)
       elif attr == 'fingerprint':
-        self.__dict__['fingerprint'] = output[index].split('=', 1)[1]
-        self.__dict__['osx_fingerprint'] = (
+        self.fingerprint = output[index].split('=', 1)[1]
+        self.osx_fingerprint = (
             re.sub(':', '', output[index].split('=', 1)[1]))
       elif attr in ('enddate', 'startdate'):
         datestring = output[index].split('=')[1]
@@ -128,13 +276,108 @@ class Certificate(object):
                                                   OPENSSL_DATETIME_FORMAT)
         except ValueError:
           dateobject = None
-        self.__dict__[attr] = [datestring, dateobject]
+        setattr(self, attr, [datestring, dateobject])
       elif attr == 'hash':
-        self.__dict__['certhash'] = output[index]
+        self.certhash = output[index]
       elif attr == 'serial':
-        self.__dict__[attr] = output[index].split('=')[1]
+        setattr(self, attr, output[index].split('=')[1])
       elif attr == 'email':
-        self.__dict__[attr] = ''.join(output[index:])
+        setattr(self, attr, ''.join(output[index:]))
+
+
+def _CNFromOneLineName(name):
+  """Returns the CN from a name in openssl compat format, or None.
+
+  Like openssl x509 -nameopt compat parsing has always done, this takes the
+  value of the last component of "/X=ZZ/CN=VALUE".
+
+  Args:
+    name: str, name in openssl compat format
+  Returns:
+    str, the CN, or None if the name is not in the expected format
+  """
+  try:
+    return name.split('/')[-1].split('=')[1]
+  except IndexError:
+    return None
+
+
+def _OneLineName(name):
+  """Formats an X509Name like openssl -nameopt compat.
+
+  Bytes outside printable ASCII are escaped as \\xHH, as X509_NAME_oneline
+  does.
+
+  Args:
+    name: crypto.X509Name
+  Returns:
+    str, name like "/C=US/O=Megacorp/CN=host.megacorp.com"
+  """
+  parts = []
+  for key, value in name.get_components():
+    value = ''.join(c if ' ' <= c <= '~' else '\\x%02X' % ord(c)
+                    for c in value)
+    parts.append('/%s=%s' % (key, value))
+  return ''.join(parts)
+
+
+def _OpenSSLDate(asn1_time):
+  """Converts an ASN.1 time to the [datestring, datetime] used by Certificate.
+
+  Args:
+    asn1_time: str, time as returned by pyOpenSSL, e.g. "20360429180917Z"
+  Returns:
+    list, [str like "Apr 29 18:09:17 2036 GMT", datetime or None]
+  """
+  try:
+    dateobject = datetime.datetime.strptime(asn1_time[:14], '%Y%m%d%H%M%S')
+  except (TypeError, ValueError):
+    return [asn1_time, None]
+  datestring = '%s %2d %s GMT' % (dateobject.strftime('%b'), dateobject.day,
+                                  dateobject.strftime('%H:%M:%S %Y'))
+  return [datestring, dateobject]
+
+
+def _OpenSSLSerial(serial):
+  """Formats a serial number like openssl x509 -serial.
+
+  Args:
+    serial: int or long, the certificate serial number
+  Returns:
+    str, upper-case hex padded to a whole number of bytes
+  """
+  sign = '-' if serial < 0 else ''
+  serial = '%X' % abs(serial)
+  if len(serial) % 2:
+    serial = '0' + serial
+  return sign + serial
+
+
+def _Emails(x509):
+  """Returns email addresses like openssl x509 -email.
+
+  Subject emailAddress entries come first, followed by rfc822Name entries from
+  the subjectAltName extension, without duplicates.
+
+  Args:
+    x509: crypto.X509
+  Returns:
+    list of str
+  """
+  emails = [value for key, value in x509.get_subject().get_components()
+            if key == 'emailAddress']
+  for index in range(x509.get_extension_count()):
+    extension = x509.get_extension(index)
+    if extension.get_short_name() != 'subjectAltName':
+      continue
+    for general_name in str(extension).split(', '):
+      if general_name.startswith('email:'):
+        emails.append(general_name.split(':', 1)[1])
+  unique = []
+  for email in emails:
+    if email not in unique:
+      unique.append(email)
+  return unique
 
 
 def LoginKeychain():
@@ -153,45 +396,356 @@ def LoginKeychain():
     login_keychain = None
 
 
-def _GetCertificates(keychain=None):
+def _ReadPEMBlocks(stream):
+  """Yields PEM certificates from a stream as soon as each one is complete.
+
+  Args:
+    stream: file-like object with PEM output, e.g. security find-certificate -p
+  Yields:
+    str, PEM-encoded certificate
+  """
+  body = None
+  for line in iter(stream.readline, ''):
+    line = line.strip()
+    if line == PEM_HEADER:
+      body = []
+    elif line == PEM_FOOTER:
+      if body is not None:
+        yield '%s\n%s\n%s' % (PEM_HEADER, '\n'.join(body), PEM_FOOTER)
+      body = None
+    elif body is not None:
+      body.append(line)
+
+
+def _ParseCertificate(pem):
+  """Creates and fully parses a Certificate; runs in the parsing pool.
+
+  Args:
+    pem: str, PEM-encoded data
+  Returns:
+    tuple, (Certificate, None) or (None, CertError) if it could not be parsed
+  """
+  cert = Certificate(pem)
+  try:
+    cert.Parse()
+  except CertError, e:
+    return (None, e)
+  return (cert, None)
+
+
+def _ReportUnparseable(errors):
+  """Logs, once, that some certificates could not be parsed.
+
+  Args:
+    errors: list of CertError, one per skipped certificate
+  """
+  if errors:
+    logging.info('Encountered %d unparseable certificate(s), skipped them.',
+                 len(errors))
+    logging.debug('First unparseable certificate error: %s', errors[0])
+
+
+def _GetCertificates(keychain=None, parse=False):
   """Gets all certificates in a given keychain.
 
+  The output of security find-certificate is read as it arrives, and each
+  certificate is yielded as soon as its PEM block is complete. With parse, the
+  certificates are parsed by a pool of CERT_PARSE_THREADS threads and yielded
+  in keychain order; certificates that cannot be parsed are skipped and
+  reported once.
+
   On a newly-created keychain, searching for all certs gives a
   CSSMERR_DL_INVALID_RECORDTYPE error and sets the returncode to 9. Just
   assume there are no certs in this case.
 
   Args:
     keychain: str, keychain to look in
+    parse: bool, fully parse certificates before yielding them
 
   Yields:
-    Certificate objects
+    Certificate objects; unless parse is set, these are parsed when their
+    attributes are first read
 
   Raises:
     CertError: could not search for certficates
-    StopIteration: no more matching certs
   """
   cmd = [CMD_SECURITY, 'find-certificate', '-a', '-p']
 
   if keychain is not None:
     cmd.extend([keychain])
 
-  (stdout, stderr, returncode) = gmacpyutil.RunProcess(cmd)
-  if returncode == 0:
-    allcerts = stdout.split(PEM_FOOTER)
-    allcerts.pop()
-    for cert in allcerts:
-      pem = '%s\n%s\n%s' % (PEM_HEADER, '\n'.join(cert.split()[2:]), PEM_FOOTER)
-      try:
+  # Keychains are dumped on several threads by ScanCertificateExpiry, and a
+  # security which inherited another dump's pipes could hold them open.
+  task = gmacpyutil.RunProcessInBackground(cmd, close_fds=True)
+  # security can warn about every unreadable item, which would fill its
+  # stderr pipe while we are still reading stdout.
+  stderr = gmacpyutil.ReadInBackground(task.stderr)
+  parsers = None
+  unparseable = []
+  returncode = None
+  try:
+    pems = _ReadPEMBlocks(task.stdout)
+    if parse:
+      parsers = thread_pool.ThreadPool(CERT_PARSE_THREADS)
+      for cert, error in parsers.imap(_ParseCertificate, pems):
+        if error:
+          unparseable.append(error)
+        else:
+          yield cert
+    else:
+      for pem in pems:
         yield Certificate(pem)
-      except CertError, e:
-        logging.info('Encountered an unparseable certificate, continuing.')
-        logging.debug(str(e))
-        continue
-  elif returncode == 9:
-    raise StopIteration
-  else:
+    returncode = task.wait()
+  finally:
+    if returncode is None and task.poll() is None:
+      # The caller stopped early; kill security first, so the pool's reader
+      # sees EOF and can shut down.
+      task.kill()
+      task.wait()
+    if parsers is not None:
+      parsers.terminate()
+    _ReportUnparseable(unparseable)
+
+  if returncode and returncode != 9:
     raise CertError('Unable to get all certificates. Exit code: %s, '
-                    'Output: %s' % (returncode, stderr))
+                    'Output: %s' % (returncode, stderr()))
+
+
+class KeychainIndex(object):
+  """On-disk index of the certificates in one keychain.
+
+  The index maps fingerprint, subject_cn, issuer_cn, certhash and the enddate
+  string to PEM data, so lookups do not need to dump and parse the keychain.
+  It is stored as JSON in CERTS_INDEX_DIR, together with the size and mtime of
+  the keychain file, and is rebuilt whenever either of those changes.
+
+  The index decides which certificates lookups see, so it is only used if
+  the current user owns the keychain, and only read from or written to an
+  index directory the current user owns and nobody else can write to.
+
+  Attributes:
+    keychain: str, path to the keychain file
+    path: str, path to the index file
+  """
+
+  VERSION = 1
+  INDEXED_ATTRIBUTES = ('fingerprint', 'certhash', 'subject_cn', 'issuer_cn',
+                        'enddate')
+
+  def __init__(self, keychain, index_dir=CERTS_INDEX_DIR):
+    self.keychain = keychain
+    self.path = os.path.join(
+        os.path.expanduser(index_dir),
+        '%s.json' % hashlib.sha1(os.path.abspath(keychain)).hexdigest())
+    self._stamp = None
+    self._entries = []
+    self._index = {}
+
+  def _KeychainStamp(self):
+    """Returns [size, mtime] of the keychain file.
+
+    Raises:
+      OSError: the keychain file could not be read
+    """
+    stat = os.stat(self.keychain)
+    return [stat.st_size, stat.st_mtime]
+
+  def Usable(self):
+    """Whether the index can be trusted for this keychain.
+
+    Returns:
+      bool, False if the keychain belongs to another user, or the index
+      directory is not private to the current user
+    """
+    try:
+      if os.stat(self.keychain).st_uid != os.geteuid():
+        logging.debug('%s belongs to another user, not indexing it.',
+                      self.keychain)
+        return False
+    except OSError:
+      return False
+    index_dir = os.path.dirname(self.path)
+    try:
+      if not os.path.isdir(index_dir):
+        os.makedirs(index_dir, 0700)
+      stat = os.lstat(index_dir)
+    except OSError, e:
+      logging.debug('Cannot create certificate index %s: %s', index_dir, e)
+      return False
+    if stat.st_uid != os.geteuid() or stat.st_mode & 0022:
+      logging.debug('Certificate index %s is not private, not using it.',
+                    index_dir)
+      return False
+    return True
+
+  def Refresh(self):
+    """Makes sure the index matches the keychain, rebuilding it if needed.
+
+    Raises:
+      OSError: the keychain file could not be read
+      CertError: could not search for certificates
+    """
+    stamp = self._KeychainStamp()
+    if stamp == self._stamp:
+      return
+    if not self._Load(stamp):
+      self._Build(stamp)
+      self._Save()
+
+  def _SetEntries(self, entries, stamp):
+    self._entries = entries
+    self._stamp = stamp
+    self._index = dict((attr, {}) for attr in self.INDEXED_ATTRIBUTES)
+    for position, entry in enumerate(entries):
+      for attr in self.INDEXED_ATTRIBUTES:
+        if entry.get(attr) is not None:
+          self._index[attr].setdefault(entry[attr], []).append(position)
+
+  def _Load(self, stamp):
+    """Loads the index file if it is current.
+
+    Args:
+      stamp: list, current [size, mtime] of the keychain
+    Returns:
+      bool, whether a current index was loaded
+    """
+    try:
+      with open(self.path) as index_file:
+        stat = os.fstat(index_file.fileno())
+        if stat.st_uid != os.geteuid() or stat.st_mode & 0022:
+          return False
+        data = json.load(index_file)
+    except (IOError, OSError, ValueError):
+      return False
+    if data.get('version') != self.VERSION or data.get('stamp') != stamp:
+      return False
+    entries = []
+    for entry in data.get('certificates', []):
+      entries.append(dict((str(key), value and value.encode('utf-8'))
+                          for key, value in entry.iteritems()))
+    self._SetEntries(entries, stamp)
+    return True
+
+  def _Build(self, stamp):
+    """Dumps and parses the keychain to build the index."""
+    logging.debug('Building certificate index for %s', self.keychain)
+    entries = []
+    for cert in _GetCertificates(keychain=self.keychain, parse=True):
+      entry = dict((attr, cert.get(attr))
+                   for attr in self.INDEXED_ATTRIBUTES if attr != 'enddate')
+      entry['enddate'] = cert.enddate[0]
+      entry['pem'] = cert.pem
+      entries.append(entry)
+    self._SetEntries(entries, stamp)
+
+  def _Save(self):
+    """Atomically writes the index file; failures only cost a rebuild."""
+    index_dir = os.path.dirname(self.path)
+    temp_path = None
+    try:
+      if not os.path.isdir(index_dir):
+        os.makedirs(index_dir, 0700)
+      fd, temp_path = tempfile.mkstemp(dir=index_dir, prefix='.index')
+      with os.fdopen(fd, 'w') as index_file:
+        json.dump({'version': self.VERSION, 'keychain': self.keychain,
+                   'stamp': self._stamp, 'certificates': self._entries},
+                  index_file)
+      os.rename(temp_path, self.path)
+    except (IOError, OSError, UnicodeDecodeError), e:
+      logging.debug('Unable to save certificate index %s: %s', self.path, e)
+      if temp_path and os.path.exists(temp_path):
+        os.remove(temp_path)
+
+  def Invalidate(self):
+    """Forgets the index, in memory and on disk."""
+    self._stamp = None
+    try:
+      os.remove(self.path)
+    except OSError:
+      pass
+
+  def _Certificate(self, position):
+    """Returns a Certificate with the indexed attributes already set."""
+    entry = self._entries[position]
+    cert = Certificate(entry['pem'])
+    for attr in self.INDEXED_ATTRIBUTES:
+      if attr != 'enddate' and entry.get(attr) is not None:
+        setattr(cert, attr, entry[attr])
+    cert.osx_fingerprint = re.sub(':', '', entry['fingerprint'])
+    try:
+      enddate = datetime.datetime.strptime(entry['enddate'],
+                                           OPENSSL_DATETIME_FORMAT)
+    except (TypeError, ValueError):
+      enddate = None
+    cert.enddate = [entry['enddate'], enddate]
+    return cert
+
+  def Find(self, attr, value):
+    """Finds certificates by an indexed attribute.
+
+    Args:
+      attr: str, one of INDEXED_ATTRIBUTES
+      value: the value to look up; for enddate, either the date string or the
+             [str, datetime] list used by Certificate
+    Returns:
+      list of Certificate objects
+    """
+    if attr == 'enddate' and isinstance(value, (list, tuple)):
+      value = value[0]
+    return [self._Certificate(position)
+            for position in self._index[attr].get(value, [])]
+
+  def All(self):
+    """Returns all certificates in the keychain as Certificate objects."""
+    return [self._Certificate(position)
+            for position in range(len(self._entries))]
+
+
+def _GetKeychainIndex(keychain):
+  """Returns a current KeychainIndex for keychain, or None.
+
+  Indexes are kept for the life of the process and revalidated against the
+  keychain file on every call.
+
+  Args:
+    keychain: str, path to the keychain
+  Returns:
+    KeychainIndex, or None if keychain is not a readable keychain file or
+    the index cannot be trusted (see KeychainIndex.Usable)
+  Raises:
+    CertError: could not search for certificates
+  """
+  if keychain is None:
+    return None
+  index = _keychain_indexes.get(keychain)
+  if index is None:
+    index = KeychainIndex(keychain)
+  if not index.Usable():
+    _keychain_indexes.pop(keychain, None)
+    return None
+  try:
+    index.Refresh()
+  except OSError, e:
+    logging.debug('Not using a certificate index for %s: %s', keychain, e)
+    return None
+  _keychain_indexes[keychain] = index
+  return index
+
+
+def _InvalidateKeychainIndex(keychain):
+  """Invalidates the index of a keychain this module has modified.
+
+  The keychain's size and mtime usually change anyway, but mtime may only
+  have one second resolution and a keychain does not always shrink when a
+  certificate is deleted.
+
+  Args:
+    keychain: str, path to the keychain
+  """
+  if keychain is None:
+    return
+  index = _keychain_indexes.pop(keychain, None) or KeychainIndex(keychain)
+  index.Invalidate()
 
 
 def DeleteCert(osx_fingerprint, keychain=None, gui=False,
@@ -216,22 +770,231 @@ def DeleteCert(osx_fingerprint, keychain=None, gui=False,
     cmd.append(keychain)
   (unused_stdout, stderr, returncode) = (
       gmacpyutil.RunProcess(cmd, sudo=sudo, sudo_password=sudo_pass))
+  _InvalidateKeychainIndex(keychain)
 
   if returncode:
     raise CertError('Unable to delete certificate: %s' % stderr)
 
 
+class Query(object):
+  """A compiled predicate over Certificate objects.
+
+  Queries are built with Equals, Prefix, Regex, DateWindow and ExpiresWithin,
+  and combined with AllOf and AnyOf, or with the & and | operators. Calling a
+  query with a certificate returns whether it matches. AllOf and AnyOf stop
+  at the first criterion which decides the result, and CompileQuery puts the
+  criteria which do not need a parsed certificate first.
+
+  Attributes:
+    description: str, human readable form of the query
+    cheap: bool, whether the query can run without parsing a certificate
+  """
+
+  def __init__(self, predicate, description, cheap=False):
+    self._predicate = predicate
+    self.description = description
+    self.cheap = cheap
+
+  def __call__(self, cert):
+    return self._predicate(cert)
+
+  def __and__(self, other):
+    return AllOf(self, other)
+
+  def __or__(self, other):
+    return AnyOf(self, other)
+
+  def __repr__(self):
+    return '<Query %s>' % self.description
+
+
+_FIND_CRITERIA = ('subject', 'subject_cn', 'issuer', 'issuer_cn', 'startdate',
+                  'enddate', 'certhash', 'fingerprint', 'email')
+
+
+def _IsCheap(attr):
+  """Returns whether attr can be read without parsing a certificate."""
+  # pylint: disable=protected-access
+  return attr in Certificate._FINGERPRINT_ATTRIBUTES
+
+
+def Equals(attr, value):
+  """Returns a Query matching certificates whose attr equals value."""
+  return Query(lambda cert: cert.get(attr) == value,
+               '%s == %r' % (attr, value), cheap=_IsCheap(attr))
+
+
+def Prefix(attr, prefix):
+  """Returns a Query matching certificates whose attr starts with prefix."""
+  def Predicate(cert):
+    value = cert.get(attr)
+    return value is not None and value.startswith(prefix)
+  return Query(Predicate, '%s startswith %r' % (attr, prefix),
+               cheap=_IsCheap(attr))
+
+
+def Regex(attr, pattern, flags=0):
+  """Returns a Query matching certificates whose attr matches pattern.
+
+  Args:
+    attr: str, certificate attribute
+    pattern: str, regular expression, searched for anywhere in the value
+    flags: int, re module flags
+  Returns:
+    Query
+  """
+  regex = re.compile(pattern, flags)
+  def Predicate(cert):
+    value = cert.get(attr)
+    return value is not None and regex.search(value) is not None
+  return Query(Predicate, '%s =~ %r' % (attr, pattern), cheap=_IsCheap(attr))
+
+
+def DateWindow(attr, after=None, before=None):
+  """Returns a Query matching certificates with a date in a window.
+
+  Args:
+    attr: str, 'startdate' or 'enddate'
+    after: datetime, optional, the date must not be earlier than this
+    before: datetime, optional, the date must be earlier than this
+  Returns:
+    Query; certificates with a malformed date never match
+  """
+  def Predicate(cert):
+    value = cert.get(attr)
+    date = value and value[1]
+    if not date:
+      return False
+    return ((after is None or date >= after) and
+            (before is None or date < before))
+  return Query(Predicate, '%s in [%s, %s)' % (attr, after, before))
+
+
+def ExpiresWithin(seconds=0, days=0):
+  """Returns a Query matching certificates that expire within a period.
+
+  Like CertificateExpired, certificates which have already expired match.
+
+  Args:
+    seconds: int, number of seconds from now
+    days: int, number of days from now, added to seconds
+  Returns:
+    Query
+  """
+  delta = datetime.timedelta(days=days, seconds=seconds)
+  def Predicate(cert):
+    enddate = cert.get('enddate')
+    if not enddate or not enddate[1]:
+      raise CertError('Certificate has a malformed enddate.')
+    return datetime.datetime.utcnow() + delta > enddate[1]
+  return Query(Predicate, 'expires within %s' % delta)
+
+
+def AllOf(*queries):
+  """Returns a Query matching certificates which match all queries."""
+  def Predicate(cert):
+    for query in queries:
+      if not query(cert):
+        return False
+    return True
+  return Query(Predicate,
+               '(%s)' % ' and '.join(q.description for q in queries),
+               cheap=all(q.cheap for q in queries))
+
+
+def AnyOf(*queries):
+  """Returns a Query matching certificates which match any of the queries."""
+  def Predicate(cert):
+    for query in queries:
+      if query(cert):
+        return True
+    return False
+  return Query(Predicate,
+               '(%s)' % ' or '.join(q.description for q in queries),
+               cheap=all(q.cheap for q in queries))
+
+
+def CompileQuery(query=None, **criteria):
+  """Compiles FindCertificates-style criteria into one Query.
+
+  Args:
+    query: Query, optional, ANDed with the criteria
+    **criteria: attribute=value pairs; a value may also be a Query, which is
+                used as is. Criteria with false values are ignored.
+  Returns:
+    Query
+  """
+  queries = []
+  for attr, value in sorted(criteria.iteritems()):
+    if not value:
+      continue
+    if isinstance(value, Query):
+      queries.append(value)
+    else:
+      queries.append(Equals(attr, value))
+  if query is not None:
+    queries.append(query)
+  # The sort is stable, so this only moves cheap criteria to the front.
+  queries.sort(key=lambda q: not q.cheap)
+  return AllOf(*queries)
+
+
+def _FindMatchingCertificates(keychain, query, criteria):
+  """Yields certificates from keychain which match the criteria and query.
+
+  Args:
+    keychain: str, which keychain to look in
+    query: Query or None
+    criteria: dict, FindCertificates-style attribute=value criteria
+  Yields:
+    Certificate objects
+  Raises:
+    CertError: could not search for certificates
+  """
+  matcher = CompileQuery(query=query, **criteria)
+  index = _GetKeychainIndex(keychain)
+  if index is None:
+    candidates = _GetCertificates(keychain=keychain, parse=not matcher.cheap)
+  else:
+    for attr in KeychainIndex.INDEXED_ATTRIBUTES:
+      value = criteria.get(attr)
+      if value and not isinstance(value, Query):
+        candidates = index.Find(attr, value)
+        break
+    else:
+      candidates = index.All()
+
+  unparseable = []
+  try:
+    for cert in candidates:
+      try:
+        matched = matcher(cert)
+      except CertError, e:
+        unparseable.append(e)
+        continue
+      if matched:
+        yield cert
+  finally:
+    if hasattr(candidates, 'close'):
+      candidates.close()
+    _ReportUnparseable(unparseable)
+
+
 def FindCertificates(subject=None, subject_cn=None, issuer=None, issuer_cn=None,
                      startdate=None, enddate=None, certhash=None,
-                     fingerprint=None, email=None, keychain=None):
-                     # pylint: disable=unused-argument
+                     fingerprint=None, email=None, keychain=None, query=None):
   """Finds certificates by attribute.
 
-  Multiple attributes are ANDed together.
+  Multiple attributes are ANDed together. Each attribute may be a plain value,
+  which must be equal, or a Query such as Prefix('subject_cn', 'host').
+  query can express anything else, e.g. AnyOf(...) or ExpiresWithin(days=30).
 
-  To do this, we get a list of all matching certs with a list comprehension,
-  then run a reduce multiplying all results. Since bools multiply as ints, a
-  False means multiply by 0 so any False match makes the whole thing False.
+  The criteria are compiled into one Query which stops at the first criterion
+  that fails. Certificates are only parsed as far as the criteria need, so a
+  search by fingerprint alone does not parse any certificate.
+
+  When keychain is a keychain file, candidates come from its KeychainIndex,
+  so repeated searches do not dump the keychain again until it changes.
 
   Args:
     subject: str, find certificate by full subject
@@ -244,25 +1007,41 @@ def FindCertificates(subject=None, subject_cn=None, issuer=None, issuer_cn=None,
     fingerprint: str, find certificate by fingerprint
     email: str, find certificates by email address
     keychain: str, which keychain to look in
+    query: Query, optional, additional query the certificates must match
   Returns:
     List of matching Certificate objects
   Raises:
     CertError: could not search for certificates
   """
+  criteria = {'subject': subject, 'subject_cn': subject_cn, 'issuer': issuer,
+              'issuer_cn': issuer_cn, 'startdate': startdate,
+              'enddate': enddate, 'certhash': certhash,
+              'fingerprint': fingerprint, 'email': email}
+  return list(_FindMatchingCertificates(keychain, query, criteria))
+
 
-  attrs = vars().keys()[:]
-  attrs.remove('keychain')
-  allcerts = _GetCertificates(keychain=keychain)
-  matchedcerts = []
+def FindFirstCertificate(keychain=None, query=None, **criteria):
+  """Finds the first certificate matching the criteria.
 
-  for cert in allcerts:
-    if reduce(operator.mul,  # pylint: disable=bad-builtin
-              [(cert.get(k) == eval(k))  # pylint: disable=eval-used
-               for k in attrs
-               if eval(k)],  # pylint: disable=eval-used
-              True):
-      matchedcerts.append(cert)
-  return matchedcerts
+  Takes the same arguments as FindCertificates, but stops scanning the
+  keychain as soon as a certificate matches.
+
+  Args:
+    keychain: str, which keychain to look in
+    query: Query, optional, additional query the certificate must match
+    **criteria: attribute=value criteria, as for FindCertificates
+  Returns:
+    Certificate object, or None if nothing matched
+  Raises:
+    CertError: could not search for certificates
+    TypeError: an unknown criterion was given
+  """
+  for attr in criteria:
+    if attr not in _FIND_CRITERIA:
+      raise TypeError('Unknown certificate criterion: %s' % attr)
+  for cert in _FindMatchingCertificates(keychain, query, criteria):
+    return cert
+  return None
 
 
 def CertificateExpired(cert, expires=0):
@@ -277,7 +1056,8 @@ def CertificateExpired(cert, expires=0):
     CertError: cert is a mandatory argument
     CertError: cert is not a PEM encoded x509 cert
   """
-  expiry = datetime.datetime.today() + datetime.timedelta(seconds=expires)
+  # Certificate dates are in GMT.
+  expiry = datetime.datetime.utcnow() + datetime.timedelta(seconds=expires)
   # enddate is a list of [str, (datetime|None)], we want the datetime object
   cert_end = cert.enddate[1]
   if cert_end:
@@ -286,6 +1066,288 @@ def CertificateExpired(cert, expires=0):
     raise CertError('Certificate has a malformed enddate.')
 
 
+class ExpiryReport(object):
+  """Results of ScanCertificateExpiry.
+
+  Attributes:
+    soonest: list of (keychain, Certificate) tuples, soonest expiring first
+    counts: dict, number of certificates in each of EXPIRY_BUCKETS by name.
+      Buckets do not overlap, e.g. '30d' counts neither expired certificates
+      nor those already counted in '7d'.
+    total: int, number of certificates scanned
+    errors: dict, keychain path to the error which stopped its scan
+  """
+
+  def __init__(self):
+    self.soonest = []
+    self.counts = dict((name, 0) for name, _ in EXPIRY_BUCKETS)
+    self.total = 0
+    self.errors = {}
+
+
+def _ScanKeychainExpiry(keychain, now, top):
+  """Scans one keychain for ScanCertificateExpiry.
+
+  Args:
+    keychain: str, path to the keychain
+    now: datetime, the time to measure expiry from, in GMT
+    top: int, how many of the soonest expiring certificates to keep
+  Returns:
+    tuple of (list of (enddate, position, Certificate) tuples for the top
+    soonest expiring certificates, dict of bucket counts, int total)
+  Raises:
+    CertError: could not search for certificates
+  """
+  index = _GetKeychainIndex(keychain)
+  if index is None:
+    certificates = _GetCertificates(keychain=keychain, parse=True)
+  else:
+    certificates = index.All()
+
+  counts = dict((name, 0) for name, _ in EXPIRY_BUCKETS)
+  scanned = [0]
+  unparseable = []
+
+  def Entries():
+    for position, cert in enumerate(certificates):
+      try:
+        enddate = cert.enddate[1]
+      except CertError, e:
+        unparseable.append(e)
+        continue
+      if not enddate:
+        unparseable.append(CertError('Certificate has a malformed enddate.'))
+        continue
+      scanned[0] += 1
+      remaining = (enddate - now).total_seconds()
+      for name, seconds in EXPIRY_BUCKETS:
+        if remaining < seconds:
+          counts[name] += 1
+          break
+      yield (enddate, position, cert)
+
+  entries = Entries()
+  try:
+    soonest = heapq.nsmallest(top, entries) if top > 0 else []
+    # nsmallest returns early for top <= 0; the buckets still need counting.
+    for _ in entries:
+      pass
+  finally:
+    _ReportUnparseable(unparseable)
+  return soonest, counts, scanned[0]
+
+
+def ScanCertificateExpiry(keychains=None, top=EXPIRY_SCAN_TOP, now=None):
+  """Scans keychains concurrently for certificates which expire soon.
+
+  Each keychain is scanned in its own thread, through its KeychainIndex where
+  it has one. Only the top soonest expiring certificates are kept, in a
+  heap, and the rest are only counted into EXPIRY_BUCKETS.
+
+  Args:
+    keychains: list of keychain paths, defaults to the System and login
+      keychains
+    top: int, how many of the soonest expiring certificates to return
+    now: datetime, the time to measure expiry from, in GMT, defaults to now
+  Returns:
+    ExpiryReport
+  """
+  if keychains is None:
+    keychains = [SYSTEM_KEYCHAIN, login_keychain]
+  unique = []
+  for keychain in keychains:
+    if keychain and keychain not in unique:
+      unique.append(keychain)
+  if now is None:
+    now = datetime.datetime.utcnow()
+
+  report = ExpiryReport()
+  if not unique:
+    return report
+
+  def Scan(keychain):
+    try:
+      return keychain, _ScanKeychainExpiry(keychain, now, top), None
+    except CertError, e:
+      return keychain, None, e
+
+  pool = thread_pool.ThreadPool(len(unique))
+  try:
+    results = pool.map(Scan, unique)
+  finally:
+    pool.terminate()
+
+  candidates = []
+  for order, (keychain, result, error) in enumerate(results):
+    if error is not None:
+      logging.error('Unable to scan %s for expiring certificates: %s',
+                    keychain, error)
+      report.errors[keychain] = str(error)
+      continue
+    soonest, counts, total = result
+    for name in counts:
+      report.counts[name] += counts[name]
+    report.total += total
+    candidates.extend((enddate, order, position, keychain, cert)
+                      for enddate, position, cert in soonest)
+  report.soonest = [(keychain, cert) for _, _, _, keychain, cert
+                    in heapq.nsmallest(top, candidates)]
+  return report
+
+
+class CertificateChain(object):
+  """A certificate chain built by IssuerIndex.BuildChain.
+
+  Attributes:
+    certificates: list of Certificate objects, from the leaf towards the root
+    complete: bool, whether the chain ends in a self-signed certificate
+    missing_issuer: str, subject of the first issuer which could not be
+      found, in the same format as Certificate.issuer, or None
+    verified: bool, whether OpenSSL verified the complete chain
+    error: str, why the chain could not be verified, or None
+  """
+
+  def __init__(self):
+    self.certificates = []
+    self.complete = False
+    self.missing_issuer = None
+    self.verified = False
+    self.error = None
+
+
+class IssuerIndex(object):
+  """Certificates indexed by subject name hash, for building chains.
+
+  The hash is the one Certificate.certhash carries, so finding the issuer of
+  a certificate is a dictionary lookup on the hash of its issuer name instead
+  of a FindCertificates(issuer_cn=...) scan of the keychains. Requires
+  pyOpenSSL.
+  """
+
+  def __init__(self, certificates):
+    """Indexes certificates.
+
+    Args:
+      certificates: iterable of Certificate objects; duplicates are ignored
+    Raises:
+      CertError: pyOpenSSL is not available
+    """
+    if crypto is None:
+      raise CertError('Building certificate chains requires pyOpenSSL.')
+    self._by_subject = {}
+    fingerprints = set()
+    unparseable = []
+    for cert in certificates:
+      try:
+        if cert.osx_fingerprint in fingerprints:
+          continue
+        x509 = crypto.load_certificate(crypto.FILETYPE_PEM, cert.pem)
+      except (CertError, crypto.Error), e:
+        unparseable.append(e)
+        continue
+      fingerprints.add(cert.osx_fingerprint)
+      certhash = '%08x' % x509.subject_name_hash()
+      self._by_subject.setdefault(certhash, []).append((cert, x509))
+    _ReportUnparseable(unparseable)
+
+  def _Issuer(self, x509, chain_fingerprints):
+    """Finds the issuer of a certificate.
+
+    Args:
+      x509: crypto.X509, the certificate
+      chain_fingerprints: set of str, fingerprints already in the chain
+    Returns:
+      tuple of (Certificate, crypto.X509), or None if there is none
+    """
+    issuer_name = x509.get_issuer()
+    candidates = [
+        (cert, candidate)
+        for cert, candidate in self._by_subject.get(
+            '%08x' % issuer_name.hash(), [])
+        if candidate.get_subject() == issuer_name and
+        cert.osx_fingerprint not in chain_fingerprints]
+    if not candidates:
+      return None
+    # Prefer an issuer which has not expired, then the one valid for longest.
+    candidates.sort(key=lambda c: (not c[1].has_expired(), c[1].get_notAfter()),
+                    reverse=True)
+    return candidates[0]
+
+  def BuildChain(self, cert):
+    """Builds and verifies the chain of a certificate.
+
+    Args:
+      cert: Certificate, the leaf
+    Returns:
+      CertificateChain
+    Raises:
+      CertError: cert could not be loaded
+    """
+    try:
+      x509 = crypto.load_certificate(crypto.FILETYPE_PEM, cert.pem)
+    except crypto.Error, e:
+      raise CertError('Unable to load certificate: %s' % e)
+
+    chain = CertificateChain()
+    chain.certificates.append(cert)
+    chain_x509 = [x509]
+    chain_fingerprints = set([cert.osx_fingerprint])
+    while x509.get_subject() != x509.get_issuer():
+      issuer = self._Issuer(x509, chain_fingerprints)
+      if issuer is None:
+        chain.missing_issuer = _OneLineName(x509.get_issuer())
+        chain.error = 'Missing issuer: %s' % chain.missing_issuer
+        return chain
+      cert, x509 = issuer
+      chain.certificates.append(cert)
+      chain_x509.append(x509)
+      chain_fingerprints.add(cert.osx_fingerprint)
+    chain.complete = True
+
+    store = crypto.X509Store()
+    store.add_cert(chain_x509[-1])
+    try:
+      context = crypto.X509StoreContext(store, chain_x509[0], chain_x509[1:-1])
+    except TypeError:
+      # pyOpenSSL before 20.0 cannot be given untrusted intermediates.
+      for intermediate in chain_x509[1:-1]:
+        store.add_cert(intermediate)
+      context = crypto.X509StoreContext(store, chain_x509[0])
+    try:
+      context.verify_certificate()
+    except crypto.X509StoreContextError, e:
+      chain.error = 'Unable to verify chain: %s' % e
+    else:
+      chain.verified = True
+    return chain
+
+
+def GetIssuerIndex(keychains=None):
+  """Indexes the certificates in keychains for building chains.
+
+  Keychains with a KeychainIndex are read from it; the others are dumped
+  once each.
+
+  Args:
+    keychains: list of keychain paths, defaults to the System, system roots
+      and login keychains
+  Returns:
+    IssuerIndex
+  Raises:
+    CertError: could not search for certificates, or pyOpenSSL is missing
+  """
+  if keychains is None:
+    keychains = [SYSTEM_KEYCHAIN, SYSTEM_ROOTS_KEYCHAIN, login_keychain]
+  certificates = []
+  for keychain in keychains:
+    if not keychain:
+      continue
+    index = _GetKeychainIndex(keychain)
+    if index is None:
+      certificates.extend(_GetCertificates(keychain=keychain))
+    else:
+      certificates.extend(index.All())
+  return IssuerIndex(certificates)
 
 
 def VerifyIdentityPreference(subject_cn, service):
@@ -308,13 +1370,157 @@ def VerifyIdentityPreference(subject_cn, service):
   return search_string in stdout
 
 
+class KeychainItem(object):
+  """A record from security dump-keychain.
+
+  Attributes:
+    keychain: str, path of the keychain holding the item
+    item_class: str, e.g. 'genp' for a generic password
+    attributes: dict, attribute name, e.g. 'svce' or '0x00000007', to value;
+      quoted values are unquoted and <NULL> becomes None
+  """
+
+  __slots__ = ('keychain', 'item_class', 'attributes')
+
+  def __init__(self, keychain):
+    self.keychain = keychain
+    self.item_class = None
+    self.attributes = {}
+
+
+_KEYCHAIN_ATTRIBUTE_RE = re.compile(
+    r'\s+(?:"(?P<name>[^"]*)"|(?P<number>0x[0-9A-Fa-f]+) )'
+    r'<[^>]*>=(?P<value>.*)$')
+
+
+def _KeychainValue(value):
+  """Converts a dump-keychain value to str or None.
+
+  Args:
+    value: str, e.g. '"text"', '<NULL>' or '0x0A00  "\\n"'
+  Returns:
+    str, or None for <NULL>
+  """
+  if value == '<NULL>':
+    return None
+  if len(value) > 1 and value.startswith('"') and value.endswith('"'):
+    return value[1:-1]
+  return value
+
+
+def _ReadKeychainItems(stream):
+  """Yields keychain items from a stream as soon as each one is complete.
+
+  Args:
+    stream: file-like object with security dump-keychain output
+  Yields:
+    KeychainItem objects
+  """
+  item = None
+  for line in iter(stream.readline, ''):
+    line = line.rstrip('\n')
+    if line.startswith('keychain: '):
+      if item is not None:
+        yield item
+      item = KeychainItem(_KeychainValue(line.split(': ', 1)[1]))
+    elif item is None:
+      continue
+    elif line.startswith('class: '):
+      item.item_class = _KeychainValue(line.split(': ', 1)[1])
+    else:
+      matches = _KEYCHAIN_ATTRIBUTE_RE.match(line)
+      if matches:
+        name = matches.group('name')
+        if name is None:
+          name = matches.group('number')
+        item.attributes[name] = _KeychainValue(matches.group('value'))
+  if item is not None:
+    yield item
+
+
+def DumpKeychain(keychain=None):
+  """Gets the items in a keychain, without their secrets.
+
+  The output of security dump-keychain is read as it arrives, and each item is
+  yielded as soon as it is complete.
+
+  Args:
+    keychain: str, keychain to dump; all keychains in the search list if None
+  Yields:
+    KeychainItem objects
+  Raises:
+    KeychainError: security dump-keychain failed
+  """
+  cmd = [CMD_SECURITY, 'dump-keychain']
+  if keychain is not None:
+    cmd.append(keychain)
+
+  task = gmacpyutil.RunProcessInBackground(cmd)
+  returncode = None
+  try:
+    for item in _ReadKeychainItems(task.stdout):
+      yield item
+    returncode = task.wait()
+  finally:
+    if returncode is None and task.poll() is None:
+      task.kill()
+      task.wait()
+
+  if returncode:
+    raise KeychainError('Unable to dump keychain. Exit code: %s, Output: %s'
+                        % (returncode, task.stderr.read()))
+
+
+def _QuoteSecurityArg(arg):
+  """Quotes an argument for a security -i command line."""
+  return '"%s"' % re.sub(r'(["\\])', r'\\\1', arg)
+
+
+def _RunSecurityBatch(commands, sudo=False, sudo_password=None):
+  """Runs several security commands in one security -i process.
+
+  Args:
+    commands: list of lists, each the arguments to one security command, e.g.
+              ['set-identity-preference', '-n', '-s', 'service']
+    sudo: bool, run security under sudo
+    sudo_password: str, optional, password for sudo
+  Returns:
+    tuple, (stdout, stderr, returncode) of security -i
+  Raises:
+    CertError: sudo_password was not accepted by sudo, or sudo wanted it
+               again to run security
+  """
+  script = ''.join('%s\n' % ' '.join(_QuoteSecurityArg(arg) for arg in command)
+                   for command in commands)
+  if not (sudo and sudo_password):
+    logging.debug('Running %d security command(s) in one batch',
+                  len(commands))
+    return gmacpyutil.RunProcess([CMD_SECURITY, '-i'], script, sudo=sudo)
+
+  # RunProcess cannot send both a password and commands on stdin, so have
+  # sudo accept the password first. security then runs with sudo -n, which
+  # fails instead of prompting if sudo did not keep the credentials, e.g.
+  # with timestamp_timeout=0.
+  (unused_stdout, stderr, status) = gmacpyutil.RunProcess(
+      ['-v'], sudo=True, sudo_password=sudo_password)
+  if status:
+    raise CertError('sudo did not accept the password: %s' % stderr)
+  logging.debug('Running %d security command(s) in one batch', len(commands))
+  (stdout, stderr, status) = gmacpyutil.RunProcess(
+      [CMD_SUDO, '-n', CMD_SECURITY, '-i'], script)
+  if status and stderr.startswith('sudo:'):
+    raise CertError('sudo would not run security without a password: %s' %
+                    stderr)
+  return (stdout, stderr, status)
+
+
 def ClearIdentityPreferences(sudo_password=None):
   """Deletes existing TLS identity preferences.
 
   There's no way to list all identity preferences without knowing the full name
   so it's necessary to dump all keychains and search for the desired
-  preferences.  All of the desired preferences have a line in the output like
-  the following:
+  preferences.  All of the desired preferences have a service like the
+  following:
 
       "svce"<blob>="com.apple.network.eap.user.identity.wlan.ssid.<SSID>"
 
@@ -322,22 +1528,37 @@ def ClearIdentityPreferences(sudo_password=None):
 
       "svce"<blob>="com.apple.network.eap.system.identity.profileid.B7392191"
 
+  The preferences are all removed by a single, batched security process.
+  Preferences that security fails to remove are only logged, but a
+  sudo_password that sudo rejects raises CertError before anything is
+  removed.
+
   Args:
     sudo_password: str, optional, for removing from system keychain
+  Raises:
+    CertError: sudo_password was not accepted by sudo, or sudo would not run
+               security without asking for it again
   """
-  service_re = re.compile(r'\s*"svce"<blob>="(com\.apple\.network\.eap\..*)"')
-
-  cmd = [CMD_SECURITY, 'dump-keychain']
-  (keychain_content, _, _) = gmacpyutil.RunProcess(cmd)
+  services = []
+  try:
+    for item in DumpKeychain():
+      service = item.attributes.get('svce')
+      if (service and service.startswith('com.apple.network.eap.') and
+          service not in services):
+        services.append(service)
+  except KeychainError, e:
+    logging.error('Unable to list all identity preferences: %s', e)
+  if not services:
+    return
 
-  for line in keychain_content.splitlines():
-    matches = service_re.match(line)
-    if matches:
-      cmd = [CMD_SECURITY, 'set-identity-preference',
-             '-n', '-s', matches.group(1)]
-      logging.debug('Removing identity preference: %s', cmd)
-      gmacpyutil.RunProcess(cmd, sudo=bool(sudo_password),
-                            sudo_password=sudo_password)
+  logging.debug('Removing identity preferences: %s', services)
+  commands = [['set-identity-preference', '-n', '-s', service]
+              for service in services]
+  (stdout, stderr, status) = _RunSecurityBatch(
+      commands, sudo=bool(sudo_password), sudo_password=sudo_password)
+  logging.debug('Identity preference removal output: %s', stdout)
+  if status:
+    logging.error('Unable to remove all identity preferences: %s', stderr)
 
 
 def CreateIdentityPreference(issuer_cn, service, keychain=login_keychain):
@@ -450,6 +1671,7 @@ def InstallPrivateKeyInKeychain(private_key, keychain=login_keychain,
     logging.debug('Command: %s', command)
     (stdout, stderr, status) = gmacpyutil.RunProcess(command, sudo=sudo,
                                                      sudo_password=sudo_pass)
+    _InvalidateKeychainIndex(keychain)
     logging.debug('Private key installation output: %s', stdout)
     if status:
       raise KeychainError(stdout, stderr)
@@ -508,6 +1730,7 @@ def InstallCertInKeychain(pem, private_key, keychain=login_keychain,
     logging.debug('Command: %s', command)
     (stdout, stderr, status) = gmacpyutil.RunProcess(command, sudo=sudo,
                                                      sudo_password=sudo_pass)
+    _InvalidateKeychainIndex(keychain)
     logging.debug('Certificate installation output: %s', stdout)
     if status:
       raise KeychainError(stdout, stderr)
@@ -559,6 +1782,7 @@ def InstallTrustedCertInKeychain(pem, root_ca=False, policies=None, gui=False,
     logging.debug('Command: %s', command)
     (stdout, stderr, status) = gmacpyutil.RunProcess(command, sudo=sudo,
                                                      sudo_password=sudo_pass)
+    _InvalidateKeychainIndex(keychain)
     logging.debug('Trusted certificate installation output: %s', stdout)
     if status:
       raise KeychainError(stdout, stderr)
@@ -568,12 +1792,185 @@ def InstallTrustedCertInKeychain(pem, root_ca=False, policies=None, gui=False,
     shutil.rmtree(temp_dir)
 
 
+class KeychainSession(object):
+  """Collects changes to a keychain and applies them together.
+
+  The Install* functions and DeleteCert each check for sudo and start their
+  own security process. A session checks for sudo once, when it is committed,
+  and applies all of its changes with a single security -i process:
+
+    session = KeychainSession(SYSTEM_KEYCHAIN, password=password)
+    session.RemoveIssuerCerts('Old Issuing CA')
+    session.InstallTrustedCert(pem, root_ca=True)
+    session.Commit()
+
+  Used in a with statement, the session is committed if the block completes.
+
+  Attributes:
+    keychain: str, the keychain to change
+    deleted: list of str, fingerprints of the certificates deleted so far
+  """
+
+  def __init__(self, keychain=login_keychain, gui=False, password=None):
+    """Initializes the session.
+
+    Args:
+      keychain: str, keychain to change
+      gui: True if running in a gui context
+      password: The user's password if already known.
+    """
+    self.keychain = keychain
+    self.gui = gui
+    self.password = password
+    self.deleted = []
+    # (file name or None, file contents, security arguments); None in the
+    # arguments is replaced by the path of the file.
+    self._changes = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, unused_exc_value, unused_traceback):
+    if exc_type is None:
+      self.Commit()
+
+  def InstallPrivateKey(self, private_key, trusted_app_path=None,
+                        passphrase=None):
+    """Queues installing a private key, as InstallPrivateKeyInKeychain."""
+    command = ['import', None, '-x', '-k', self.keychain]
+    if passphrase:
+      command.extend(['-P', passphrase])
+    if trusted_app_path:
+      for trusted_app in trusted_app_path:
+        if os.path.exists(trusted_app):
+          command.extend(['-T', trusted_app])
+    else:
+      command.extend(['-A'])
+    self._changes.append(('private.key', private_key, command))
+
+  def InstallCert(self, pem, private_key, trusted_app_path=None,
+                  passphrase=None):
+    """Queues installing a certificate and key, as InstallCertInKeychain."""
+    if type(trusted_app_path) == str:
+      trusted_app_path = [trusted_app_path]
+    self.InstallPrivateKey(private_key, trusted_app_path=trusted_app_path,
+                           passphrase=passphrase)
+    self._changes.append(('certificate.cer', pem,
+                          ['import', None, '-x', '-k', self.keychain]))
+
+  def InstallTrustedCert(self, pem, root_ca=False, policies=None):
+    """Queues installing a trusted cert, as InstallTrustedCertInKeychain."""
+    command = ['add-trusted-cert', '-d']
+    if root_ca:
+      command.extend(['-r', 'trustRoot'])
+    else:
+      command.extend(['-r', 'trustAsRoot'])
+    if policies:
+      for policy in policies:
+        command.extend(['-p', policy])
+    command.extend(['-k', self.keychain, None])
+    self._changes.append(('trusted_certificate.pem', pem, command))
+
+  def DeleteCert(self, osx_fingerprint):
+    """Queues deleting a certificate by SHA1 hash, as DeleteCert."""
+    command = ['delete-certificate', '-Z', osx_fingerprint]
+    if self.keychain:
+      command.append(self.keychain)
+    self._changes.append((None, None, command))
+
+  def RemoveIssuerCerts(self, issuer_cn):
+    """Queues deleting all certificates issued by a given CN.
+
+    Args:
+      issuer_cn: str, the certificate's issuer's CN
+    Returns:
+      list of the Certificate objects which will be deleted
+    Raises:
+      CertError: could not search for certificates
+    """
+    existing_certs = FindCertificates(issuer_cn=issuer_cn,
+                                      keychain=self.keychain)
+    for cert in existing_certs:
+      logging.debug('Removing cert with fingerprint %s from %s',
+                    cert.osx_fingerprint, self.keychain)
+      self.DeleteCert(cert.osx_fingerprint)
+    return existing_certs
+
+  def Commit(self):
+    """Applies the queued changes.
+
+    The exit status of security -i says little about the commands it ran, so
+    the keychain is searched afterwards: deleted certificates are added to
+    deleted if they are gone, and installed certificates must be present.
+    Installed private keys are not checked.
+
+    Raises:
+      KeychainError: sudo failed, or a change could not be applied
+      CertError: could not search for certificates
+    """
+    changes, self._changes = self._changes, []
+    if not changes:
+      return
+    sudo, sudo_pass = _GetSudoContext(self.keychain, gui=self.gui,
+                                      password=self.password)
+
+    temp_dir = tempfile.mkdtemp(prefix='keychain_session')
+    try:
+      commands = []
+      for position, (name, contents, command) in enumerate(changes):
+        if name is not None:
+          path = os.path.join(temp_dir, '%d-%s' % (position, name))
+          with open(path, 'w') as handle:
+            handle.write(contents)
+          command = [path if arg is None else arg for arg in command]
+        commands.append(command)
+
+      logging.info('Applying %d change(s) to the %s keychain',
+                   len(commands), self.keychain)
+      try:
+        (stdout, stderr, status) = _RunSecurityBatch(
+            commands, sudo=sudo, sudo_password=sudo_pass)
+      except CertError, e:
+        raise KeychainError(str(e))
+      finally:
+        _InvalidateKeychainIndex(self.keychain)
+      logging.debug('Keychain session output: %s', stdout)
+    except IOError:
+      raise KeychainError('Could not write to temp files in %s' % temp_dir)
+    finally:
+      shutil.rmtree(temp_dir)
+
+    deleting = [command[2] for _, _, command in changes
+                if command[0] == 'delete-certificate']
+    installing = []
+    for name, contents, _ in changes:
+      if name in ('certificate.cer', 'trusted_certificate.pem'):
+        try:
+          installing.append(Certificate(contents).osx_fingerprint)
+        except CertError, e:
+          logging.debug('Cannot check installed certificate: %s', e)
+    if deleting or installing:
+      present = set(cert.osx_fingerprint
+                    for cert in FindCertificates(keychain=self.keychain))
+      deleted = [f for f in deleting if f not in present]
+      self.deleted.extend(deleted)
+      if len(deleted) < len(deleting):
+        raise KeychainError('Unable to delete %d certificate(s): %s' % (
+            len(deleting) - len(deleted), stderr))
+      missing = [f for f in installing if f not in present]
+      if missing:
+        raise KeychainError('Unable to install certificate(s) %s: %s' % (
+            ', '.join(missing), stderr))
+    if status:
+      raise KeychainError(stdout, stderr)
+
+
 def RemoveIssuerCertsFromKeychain(issuer_cn, keychain=login_keychain, gui=False,
                                   password=None):
   """Removes all certificates issued from a given CN from the keychain.
 
-  DeleteCert tries to raise privileges to allow deletions from the System
-  keychain, so we try and log if it fails.
+  The certificates are deleted together by a KeychainSession, so sudo is only
+  needed once however many there are. Failures are logged.
 
   Args:
     issuer_cn: str, the certificate's issuer's CN
@@ -582,7 +1979,7 @@ def RemoveIssuerCertsFromKeychain(issuer_cn, keychain=login_keychain, gui=False,
     password: The user's password if already known.
 
   Raises:
-    KeychainError: if there are any errors removing
+    CertError: could not search for certificates
 
   Returns:
     Array of deleted serial numbers
@@ -590,27 +1987,276 @@ def RemoveIssuerCertsFromKeychain(issuer_cn, keychain=login_keychain, gui=False,
   if keychain is None:
     return []
 
-  existing_certs = FindCertificates(issuer_cn=issuer_cn, keychain=keychain)
-  deleted_certs = []
-  for cert in existing_certs:
+  session = KeychainSession(keychain, gui=gui, password=password)
+  existing_certs = session.RemoveIssuerCerts(issuer_cn)
+  try:
+    session.Commit()
+  except Error, e:
+    logging.error('Cannot delete old certificates: %s', str(e))
+  return [cert.serial for cert in existing_certs
+          if cert.osx_fingerprint in session.deleted]
+
+
+class KeyPool(object):
+  """A queue of pre-generated RSA private keys on disk.
+
+  Generating an RSA key is the slow part of GenerateCSR. A KeyPool keeps a
+  few unencrypted keys in a directory only the current user can read, and
+  refills itself on a background thread with openssl running under nice.
+
+    pool = KeyPool(enabled=True)
+    csr, key, passphrase = GenerateCSR(subject, key_pool=pool)
+
+  Keeping private keys on disk is opt-in: unless enabled, or
+  KEY_POOL_ENABLED, is set, a pool stays empty and writes nothing. The pool
+  lives outside ~/Library/Caches, which backup tools and cache cleaners
+  treat as disposable. Keys are taken by renaming them, so several processes
+  can share a pool. Using a pool requires pyOpenSSL.
+  """
+
+  def __init__(self, pool_dir=KEY_POOL_DIR, rsa_bits=2048, size=KEY_POOL_SIZE,
+               enabled=None):
+    """Initializes the pool.
+
+    Args:
+      pool_dir: str, directory holding the pools, one per key size
+      rsa_bits: int, size of the keys in the pool
+      size: int, how many keys to keep ready
+      enabled: bool, keep keys on disk; None for KEY_POOL_ENABLED
+    """
+    if enabled is None:
+      enabled = KEY_POOL_ENABLED
+    self.enabled = enabled
+    self.rsa_bits = rsa_bits
+    self.size = size
+    self.path = os.path.join(os.path.expanduser(pool_dir), str(rsa_bits))
+    self._refill_lock = threading.Lock()
+    self._refill_thread = None
+
+  def _CheckPath(self):
+    """Creates the pool directory, or checks that it is private.
+
+    Raises:
+      CertError: the pool directory is not private to the current user
+    """
+    if not os.path.isdir(self.path):
+      try:
+        os.makedirs(self.path, 0700)
+      except OSError, e:
+        if not os.path.isdir(self.path):
+          raise CertError('Cannot create key pool %s: %s' % (self.path, e))
+    stat = os.lstat(self.path)
+    if stat.st_uid != os.geteuid() or stat.st_mode & 0077:
+      raise CertError('Key pool %s is not private, not using it.' % self.path)
+
+  def _Sweep(self):
+    """Removes key files left behind by processes that died.
+
+    Keys being written (.new*) or taken (.taken-*) only keep those names
+    briefly, so any older than KEY_POOL_STALE_AGE are abandoned.
+    """
+    cutoff = time.time() - KEY_POOL_STALE_AGE
+    for name in os.listdir(self.path):
+      if not name.startswith(('.new', '.taken-')):
+        continue
+      path = os.path.join(self.path, name)
+      try:
+        if os.lstat(path).st_mtime < cutoff:
+          logging.debug('Removing stale pooled key %s', path)
+          os.remove(path)
+      except OSError:
+        pass  # Finished or removed by its owner meanwhile.
+
+  def _Keys(self):
+    """Returns the paths of the keys in the pool, oldest first."""
+    return [os.path.join(self.path, name)
+            for name in sorted(os.listdir(self.path))
+            if not name.startswith('.')]
+
+  def Count(self):
+    """Returns the number of keys ready in the pool."""
+    if not self.enabled:
+      return 0
     try:
-      logging.debug('Removing cert with fingerprint %s from %s',
-                    cert.osx_fingerprint, keychain)
-      DeleteCert(cert.osx_fingerprint, keychain=keychain, gui=gui,
-                 password=password)
-      deleted_certs.append(cert.serial)
+      self._CheckPath()
+      return len(self._Keys())
+    except (CertError, OSError):
+      return 0
+
+  def Take(self):
+    """Takes the oldest key out of the pool.
+
+    Returns:
+      str, private key in PEM format, or None if the pool is empty, disabled
+      or unusable
+    """
+    if not self.enabled:
+      return None
+    try:
+      self._CheckPath()
+      keys = self._Keys()
+    except (CertError, OSError), e:
+      logging.warning('Not using key pool: %s', e)
+      return None
+    for path in keys:
+      taken = os.path.join(self.path, '.taken-%s' % os.path.basename(path))
+      try:
+        os.rename(path, taken)
+      except OSError:
+        continue  # Another process took it first.
+      try:
+        with open(taken) as key_file:
+          return key_file.read()
+      except IOError, e:
+        logging.warning('Unable to read pooled key %s: %s', taken, e)
+      finally:
+        os.remove(taken)
+    return None
+
+  def Fill(self):
+    """Generates keys until the pool is full; does nothing if disabled.
+
+    Raises:
+      CertError: the pool is unusable or a key could not be generated
+    """
+    if not self.enabled:
+      return
+    self._CheckPath()
+    self._Sweep()
+    while len(self._Keys()) < self.size:
+      command = [CMD_NICE, '-n', '20', CMD_OPENSSL, 'genrsa',
+                 str(self.rsa_bits)]
+      (stdout, stderr, status) = gmacpyutil.RunProcess(command)
+      if status:
+        raise CertError('Error creating private key: %s' % stderr)
+      # mkstemp creates the file readable only by us; the key is only given
+      # its final name once it is complete.
+      fd, temp_path = tempfile.mkstemp(dir=self.path, prefix='.new')
+      try:
+        with os.fdopen(fd, 'w') as key_file:
+          key_file.write(stdout)
+        os.rename(temp_path, os.path.join(
+            self.path, '%017.6f%s.pem' % (time.time(),
+                                          os.path.basename(temp_path))))
+      except (IOError, OSError), e:
+        if os.path.exists(temp_path):
+          os.remove(temp_path)
+        raise CertError('Unable to add key to pool %s: %s' % (self.path, e))
+
+  def _Refill(self):
+    try:
+      self.Fill()
     except CertError, e:
-      logging.error('Cannot delete old certificate: %s', str(e))
-  return deleted_certs
+      logging.warning('Unable to refill key pool: %s', e)
+
+  def StartRefill(self):
+    """Refills the pool on a background thread, unless one is running."""
+    if not self.enabled:
+      return
+    with self._refill_lock:
+      if self._refill_thread is not None and self._refill_thread.is_alive():
+        return
+      self._refill_thread = threading.Thread(target=self._Refill,
+                                             name='KeyPool refill')
+      self._refill_thread.daemon = True
+      self._refill_thread.start()
+
+
+def _ParseSubject(subject):
+  """Splits an openssl -subj style subject into its components.
+
+  Args:
+    subject: str, e.g. '/C=US/O=Megacorp Inc./CN=host'; '/' and '=' may be
+             escaped with a backslash
+  Returns:
+    list of (name, value) tuples
+  Raises:
+    CertError: subject is malformed
+  """
+  if not subject.startswith('/'):
+    raise CertError('Malformed subject: %s' % subject)
+  components = []
+  for component in re.split(r'(?<!\\)/', subject)[1:]:
+    parts = re.split(r'(?<!\\)=', component, 1)
+    if len(parts) != 2 or not parts[0]:
+      raise CertError('Malformed subject: %s' % subject)
+    components.append(tuple(re.sub(r'\\(.)', r'\1', part) for part in parts))
+  return components
+
+
+def _GenerateCSRInProcess(subject, private_key, passphrase=None):
+  """Builds a CSR for a private key with pyOpenSSL.
+
+  Args:
+    subject: str, subject for csr, as for openssl req -subj
+    private_key: str, private key in PEM format
+    passphrase: str, optional passphrase the private key is encrypted with
 
+  Returns:
+    str, the CSR in PEM format
+
+  Raises:
+    CertError: the CSR could not be built
+  """
+  components = _ParseSubject(subject)
+  if len(set(name for name, _ in components)) != len(components):
+    # pyOpenSSL can only set each name attribute once.
+    raise CertError('Subject has repeated attributes: %s' % subject)
+  try:
+    if passphrase:
+      pkey = crypto.load_privatekey(crypto.FILETYPE_PEM, private_key,
+                                    passphrase)
+    else:
+      pkey = crypto.load_privatekey(crypto.FILETYPE_PEM, private_key)
+    request = crypto.X509Req()
+    name = request.get_subject()
+    for attr, value in components:
+      setattr(name, attr, value)
+    request.set_pubkey(pkey)
+    request.sign(pkey, 'sha256')
+    return crypto.dump_certificate_request(crypto.FILETYPE_PEM, request)
+  except (crypto.Error, AttributeError, TypeError, ValueError), e:
+    raise CertError('Error creating CSR: %s' % e)
+
+
+def _TakePooledKey(key_pool, rsa_bits, passphrase):
+  """Takes a key for GenerateCSR from a KeyPool and starts refilling it.
+
+  Args:
+    key_pool: KeyPool
+    rsa_bits: int, number of bits the key must have
+    passphrase: str, optional passphrase to encrypt the key with
+
+  Returns:
+    str, private key in PEM format, or None if no suitable key was pooled
+  """
+  if crypto is None or key_pool.rsa_bits != rsa_bits:
+    return None
+  private_key = key_pool.Take()
+  key_pool.StartRefill()
+  if private_key and passphrase:
+    try:
+      pkey = crypto.load_privatekey(crypto.FILETYPE_PEM, private_key)
+      private_key = crypto.dump_privatekey(crypto.FILETYPE_PEM, pkey, 'des3',
+                                           passphrase)
+    except crypto.Error, e:
+      logging.warning('Unable to use pooled key: %s', e)
+      return None
+  return private_key
 
-def GenerateCSR(subject, rsa_bits=2048, passphrase=None):
+
+def GenerateCSR(subject, rsa_bits=2048, passphrase=None, key_pool=None):
   """Generate a Certificate Signing Request.
 
+  With an enabled key_pool, a pre-generated key is used and the CSR is built
+  in process, so nothing needs to be spawned; the pool refills in the
+  background. Without one, or if the pool is empty, openssl is used.
+
   Args:
     subject: str, subject for csr
     rsa_bits: int, optional number of bits
     passphrase: str, optional passphrase to encrypt private key with
+    key_pool: KeyPool, optional pool of pre-generated keys
 
   Returns:
     tuple, cert and private key in PEM format and passphrase
@@ -618,6 +2264,15 @@ def GenerateCSR(subject, rsa_bits=2048, passphrase=None):
   Raises:
     CertError: Error generating a CSR.
   """
+  if key_pool is not None:
+    private_key = _TakePooledKey(key_pool, rsa_bits, passphrase)
+    if private_key:
+      try:
+        return (_GenerateCSRInProcess(subject, private_key, passphrase),
+                private_key, passphrase)
+      except CertError, e:
+        logging.warning('Unable to build CSR in process: %s', e)
+
   command = [CMD_OPENSSL, 'genrsa']
   env = {}
   if passphrase:
@@ -650,4 +2305,51 @@ def GenerateCSR(subject, rsa_bits=2048, passphrase=None):
   return (csr, private_key, passphrase)
 
 
+def ParseOptions(argv):
+  """Parse command-line options."""
+  parser = optparse.OptionParser(usage='%prog [options]')
+  parser.add_option('-D', '--debug', action='store_true', default=False)
+  parser.add_option(
+      '-k', '--keychain', action='append', dest='keychains', default=[],
+      help='Also scan this keychain. May be given more than once.')
+  parser.add_option(
+      '-n', '--top', action='store', type='int', default=EXPIRY_SCAN_TOP,
+      help='Number of soonest expiring certificates to list.')
+  opts, args = parser.parse_args(argv)
+  return opts, args
+
+
+def Output(text):
+  """Wrap print so it's mockable for testing."""
+  print text
+
+
+def main(argv):
+  opts, _ = ParseOptions(argv)
+  if opts.debug:
+    gmacpyutil.ConfigureLogging(debug_level=logging.DEBUG, stderr=opts.debug)
+  else:
+    gmacpyutil.ConfigureLogging()
+
+  report = ScanCertificateExpiry(
+      keychains=[SYSTEM_KEYCHAIN, login_keychain] + opts.keychains,
+      top=opts.top)
+  Output('%d certificates: %s' % (
+      report.total, ', '.join('%s: %d' % (name, report.counts[name])
+                              for name, _ in EXPIRY_BUCKETS)))
+  for keychain, cert in report.soonest:
+    name = (cert.get('subject_cn') or cert.get('subject') or
+            cert.osx_fingerprint)
+    Output('%s  %s  %s  %s' % (cert.enddate[0], name, cert.osx_fingerprint,
+                               keychain))
+  for keychain in sorted(report.errors):
+    Output('Unable to scan %s: %s' % (keychain, report.errors[keychain]))
+  if report.errors:
+    return 1
+
+
 LoginKeychain()
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -2,6 +2,15 @@
 
 import __builtin__
 import datetime
+import os
+import re
+import shutil
+import StringIO
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 
 
 import mox
@@ -13,6 +22,42 @@ from google.apputils import basetest
 import certs
 
 
+# Self-signed root CA.
+ROOT_PEM = (
+    '-----BEGIN CERTIFICATE-----\n'
+    'MIICDTCCAXagAwIBAgIBATANBgkqhkiG9w0BAQsFADBAMQswCQYDVQQGEwJVUzEW\n'
+    'MBQGA1UECgwNTWVnYWNvcnAgSW5jLjEZMBcGA1UEAwwQTWVnYWNvcnAgUm9vdCBD\n'
+    'QTAiGA8yMDE1MDEwMTAwMDAwMFoYDzIwMzUwMTAxMDAwMDAwWjBAMQswCQYDVQQG\n'
+    'EwJVUzEWMBQGA1UECgwNTWVnYWNvcnAgSW5jLjEZMBcGA1UEAwwQTWVnYWNvcnAg\n'
+    'Um9vdCBDQTCBnzANBgkqhkiG9w0BAQEFAAOBjQAwgYkCgYEA5aP3wCb/1bRIqh2k\n'
+    'xRsTt3EqhGSFx5onfj4plplXvjbFgZ6VbH/xDokaIQfGCMKlsXZST/R+iVhY/7LN\n'
+    'Pefk92+u/uj9W+A+P7j8Sjjdfw4uL78ILIWrmwoWTW+XyffPhx8iwq92WDZo2xI9\n'
+    'a8o/38o24mJAFTgUhTjVTejlvuECAwEAAaMTMBEwDwYDVR0TAQH/BAUwAwEB/zAN\n'
+    'BgkqhkiG9w0BAQsFAAOBgQC4McaFNcG4fOxMHXQKdcyLRmE3RIYBn2kcdWR9CfMr\n'
+    'TIl42NFYa2Vg5neOCVD8P1yrcj4DdMU8zybstlwU93ImEb8ApK/EuH4zmHard+V5\n'
+    'lBraRHbGKkNTQ7lEHs823rfQc3arWvt1G0CNOfSad3f3WAW3W80hR57ZXJbpTmzy\n'
+    'cw==\n'
+    '-----END CERTIFICATE-----\n')
+
+# Issued by ROOT_PEM, with an emailAddress and an email SAN.
+LEAF_PEM = (
+    '-----BEGIN CERTIFICATE-----\n'
+    'MIICXjCCAcegAwIBAgIIASNFZ4mrze8wDQYJKoZIhvcNAQELBQAwQDELMAkGA1UE\n'
+    'BhMCVVMxFjAUBgNVBAoMDU1lZ2Fjb3JwIEluYy4xGTAXBgNVBAMMEE1lZ2Fjb3Jw\n'
+    'IFJvb3QgQ0EwIhgPMjAxNTA2MDExMjM0NTZaGA8yMDE2MDYwMTEyMzQ1NlowZzEL\n'
+    'MAkGA1UEBhMCVVMxFjAUBgNVBAoMDU1lZ2Fjb3JwIEluYy4xHTAbBgNVBAMMFG1h\n'
+    'Y2hpbmUubWVnYWNvcnAuY29tMSEwHwYJKoZIhvcNAQkBFhJhZG1pbkBtZWdhY29y\n'
+    'cC5jb20wgZ8wDQYJKoZIhvcNAQEBBQADgY0AMIGJAoGBAKEcPVznr8C78VSk8G9T\n'
+    'vsK+TUw/K2k3nF7ck1zYeFyFg8/mUqDfjeJbo5E1KvbdsRSSwI94atjow+ZddjEk\n'
+    'CBjxmhVAmolFVXaia63d0uLsYgx8NCYVDWf5uUA6UJU5cay7FQvVZP6KKw37857Z\n'
+    '6ksIoyOy1+E9BO4nWpOjW7HXAgMBAAGjNjA0MDIGA1UdEQQrMCmBEXVzZXJAbWVn\n'
+    'YWNvcnAuY29tghRtYWNoaW5lLm1lZ2Fjb3JwLmNvbTANBgkqhkiG9w0BAQsFAAOB\n'
+    'gQCk/a5tdJ8iqN7c/SZ098uN7wN2pj5Sc60i54eK5g+VqKoQgRqXAE8j6YGm0OvZ\n'
+    'TYcjRWoYDJPinFCpHTwW/lI/wqn5PDBwy6gvjjymoDFs9OwnCt1N1jr97H9P3hmo\n'
+    'XJTTjeRIb4iTLvmzrEqcgdN1yoyy5OjJtGxWAhe3xqRYLw==\n'
+    '-----END CERTIFICATE-----\n')
+
+
 class CertificateTest(mox.MoxTestBase):
   """Test Certificate object functions."""
 
@@ -28,6 +73,12 @@ class CertificateTest(mox.MoxTestBase):
     """Set up stubs."""
     self.mox.StubOutWithMock(certs.gmacpyutil, 'RunProcess')
 
+  def Attributes(self, c):
+    """Returns the set attributes of a Certificate as a dict."""
+    return dict((attr, c.get(attr))
+                for attr in ('pem',) + certs.Certificate._ATTRIBUTES
+                if c.get(attr) is not None)
+
   def testget(self):  # pylint: disable=g-bad-name
     """Test get."""
     self.StubSetup()
@@ -37,11 +88,49 @@ class CertificateTest(mox.MoxTestBase):
 
     self.mox.ReplayAll()
     c = certs.Certificate('pem')
-    c.key = 'key'
-    self.assertEqual('key', c.get('key'))
+    c.subject = 'subject'
+    self.assertEqual('subject', c.get('subject'))
+    self.assertEqual(None, c.get('issuer'))
     self.assertEqual(None, c.get('missing'))
     self.mox.VerifyAll()
 
+  def testLazyFingerprint(self):
+    """Test fingerprints are available without parsing the certificate."""
+    self.StubSetup()
+    self.mox.StubOutWithMock(certs.Certificate, '_ParsePEMCertificate')
+
+    self.mox.ReplayAll()
+    c = certs.Certificate(LEAF_PEM)
+    self.assertEqual('DE73F99D3E493DA1D95452535F67DF0EFDA40151',
+                     c.osx_fingerprint)
+    self.assertEqual('DE:73:F9:9D:3E:49:3D:A1:D9:54:52:53:5F:67:DF:0E:FD:A4:'
+                     '01:51', c.get('fingerprint'))
+    self.mox.VerifyAll()
+
+  def testLazyFingerprintUndecodable(self):
+    """Test fingerprint raises CertError for data without a body."""
+    self.StubSetup()
+
+    self.mox.ReplayAll()
+    c = certs.Certificate('%s\n%s\n' % (certs.PEM_HEADER, certs.PEM_FOOTER))
+    self.assertRaises(certs.CertError, c.get, 'fingerprint')
+    self.mox.VerifyAll()
+
+  def testLazyParseOnce(self):
+    """Test the certificate is parsed once, on first access."""
+    self.StubSetup()
+    self.mox.StubOutWithMock(certs.Certificate,
+                             '_ParsePEMCertificateWithOpenSSL')
+    certs.Certificate._ParsePEMCertificateWithOpenSSL('pem').AndReturn(None)
+
+    self.mox.ReplayAll()
+    c = certs.Certificate('pem')
+    self.assertFalse(hasattr(c, '__dict__'))
+    self.assertEqual(None, c.get('subject'))
+    self.assertEqual(None, c.get('issuer'))
+    self.assertRaises(AttributeError, getattr, c, 'serial')
+    self.mox.VerifyAll()
+
   def testParsePEMCertificateFails(self):
     """Test _ParsePEMCertificate."""
     self.StubSetup()
@@ -49,9 +138,13 @@ class CertificateTest(mox.MoxTestBase):
     cmd = [certs.CMD_OPENSSL, 'x509', '-sha1', '-nameopt', 'compat', '-noout',
            '-hash', '-subject', '-issuer', '-startdate', '-enddate',
            '-fingerprint', '-serial', '-email']
-    certs.gmacpyutil.RunProcess(cmd, pem).AndReturn(('', '', 1))
+    certs.gmacpyutil.RunProcess(cmd, pem, close_fds=True).AndReturn(('', '', 1))
     self.mox.ReplayAll()
-    self.assertRaises(certs.CertError, certs.Certificate, pem)
+    c = certs.Certificate(pem)
+    self.assertRaises(certs.CertError, c.get, 'subject')
+    # The failure is remembered rather than running openssl again.
+    self.assertRaises(certs.CertError, c.get, 'issuer')
+    self.assertRaises(certs.CertError, c.Parse)
     self.mox.VerifyAll()
 
   def testParsePEMCertificateWithoutEmail(self):
@@ -70,11 +163,12 @@ class CertificateTest(mox.MoxTestBase):
     output = ('hash\nsubject= subject\nissuer= issuer\nnotBefore=%s\n'
               'notAfter=%s\nSHA1 Fingerprint=fing:er:print\nserial=87654321\n'
               % (date, date))
-    certs.gmacpyutil.RunProcess(cmd, pem).AndReturn((output, '', 0))
+    certs.gmacpyutil.RunProcess(cmd, pem, close_fds=True).AndReturn(
+        (output, '', 0))
 
     self.mox.ReplayAll()
     c = certs.Certificate(pem)
-    self.assertEqual(parsed, c.__dict__)
+    self.assertEqual(parsed, self.Attributes(c))
     self.mox.VerifyAll()
 
   def testParsePEMCertificateWithEmail(self):
@@ -93,11 +187,12 @@ class CertificateTest(mox.MoxTestBase):
     output_with_email = ('hash\nsubject= subject\nissuer= issuer\nnotBefore=%s'
                          '\nnotAfter=%s\nSHA1 Fingerprint=fing:er:print\n'
                          'serial=87654321\nuser@company.com\n' % (date, date))
-    certs.gmacpyutil.RunProcess(cmd, pem).AndReturn((output_with_email, '', 0))
+    certs.gmacpyutil.RunProcess(cmd, pem, close_fds=True).AndReturn(
+        (output_with_email, '', 0))
 
     self.mox.ReplayAll()
     c = certs.Certificate(pem)
-    self.assertEqual(parsed, c.__dict__)
+    self.assertEqual(parsed, self.Attributes(c))
     self.mox.VerifyAll()
 
   def testParsePEMCertificateWithMalformedDate(self):
@@ -114,11 +209,66 @@ class CertificateTest(mox.MoxTestBase):
     output_bad_date = ('hash\nsubject= subject\nissuer= issuer\nnotBefore=bad '
                        'date\nnotAfter=bad date\nSHA1 Fingerprint='
                        'fing:er:print\nserial=87654321\n')
-    certs.gmacpyutil.RunProcess(cmd, pem).AndReturn((output_bad_date, '', 0))
+    certs.gmacpyutil.RunProcess(cmd, pem, close_fds=True).AndReturn(
+        (output_bad_date, '', 0))
 
     self.mox.ReplayAll()
     c = certs.Certificate(pem)
-    self.assertEqual(parsed, c.__dict__)
+    self.assertEqual(parsed, self.Attributes(c))
+    self.mox.VerifyAll()
+
+  def testParsePEMCertificateInProcess(self):
+    """Test _ParsePEMCertificate matches openssl x509 without running it."""
+    self.StubSetup()
+    # Expected values are from openssl x509 -sha1 -nameopt compat.
+    parsed = {'subject': ('/C=US/O=Megacorp Inc./CN=machine.megacorp.com/'
+                          'emailAddress=admin@megacorp.com'),
+              'subject_cn': 'admin@megacorp.com',
+              'issuer': '/C=US/O=Megacorp Inc./CN=Megacorp Root CA',
+              'issuer_cn': 'Megacorp Root CA',
+              'certhash': '791cf1e2',
+              'startdate': ['Jun  1 12:34:56 2015 GMT',
+                            datetime.datetime(2015, 6, 1, 12, 34, 56)],
+              'enddate': ['Jun  1 12:34:56 2016 GMT',
+                          datetime.datetime(2016, 6, 1, 12, 34, 56)],
+              'fingerprint': ('DE:73:F9:9D:3E:49:3D:A1:D9:54:52:53:5F:67:DF:'
+                              '0E:FD:A4:01:51'),
+              'osx_fingerprint': 'DE73F99D3E493DA1D95452535F67DF0EFDA40151',
+              'serial': '0123456789ABCDEF',
+              'email': 'admin@megacorp.comuser@megacorp.com',
+              'pem': LEAF_PEM}
+
+    self.mox.ReplayAll()
+    c = certs.Certificate(LEAF_PEM)
+    self.assertEqual(parsed, self.Attributes(c))
+    self.mox.VerifyAll()
+
+  def testParsePEMCertificateInProcessSerialPadding(self):
+    """Test _ParsePEMCertificate pads serials and dates like openssl."""
+    self.StubSetup()
+
+    self.mox.ReplayAll()
+    c = certs.Certificate(ROOT_PEM)
+    self.assertEqual('01', c.serial)
+    self.assertEqual('482ded17', c.certhash)
+    self.assertEqual('Megacorp Root CA', c.subject_cn)
+    self.assertEqual('Jan  1 00:00:00 2015 GMT', c.startdate[0])
+    self.assertEqual('', c.email)
+    self.mox.VerifyAll()
+
+  def testParsePEMCertificateWithoutPyOpenSSL(self):
+    """Test _ParsePEMCertificate falls back to openssl x509."""
+    self.StubSetup()
+    self.stubs.Set(certs, 'crypto', None)
+    cmd = [certs.CMD_OPENSSL, 'x509', '-sha1', '-nameopt', 'compat', '-noout',
+           '-hash', '-subject', '-issuer', '-startdate', '-enddate',
+           '-fingerprint', '-serial', '-email']
+    certs.gmacpyutil.RunProcess(cmd, LEAF_PEM, close_fds=True).AndReturn(
+        ('', 'err', 1))
+
+    self.mox.ReplayAll()
+    c = certs.Certificate(LEAF_PEM)
+    self.assertRaises(certs.CertError, c.get, 'subject')
     self.mox.VerifyAll()
 
 
@@ -183,14 +333,24 @@ class CertsModuleTest(mox.MoxTestBase):
     self.assertEqual(None, certs.login_keychain)
     self.mox.VerifyAll()
 
+  def Task(self, output, returncode, stderr=''):
+    """Returns a mock background task for security find-certificate."""
+    task = self.mox.CreateMockAnything()
+    task.stdout = StringIO.StringIO(output)
+    task.stderr = StringIO.StringIO(stderr)
+    task.wait().AndReturn(returncode)
+    return task
+
   def testGetCertificatesNoKeychainSuccess(self):
     """Test _GetCertificates no keychain specified, successful search."""
     self.StubSetup()
+    self.mox.StubOutWithMock(certs.gmacpyutil, 'RunProcessInBackground')
     self.mox.StubOutWithMock(certs, 'Certificate')
     command = [certs.CMD_SECURITY, 'find-certificate', '-a', '-p']
     cert = '%s\n%s\n%s\n' % (certs.PEM_HEADER, 'cert_body', certs.PEM_FOOTER)
     output = cert * 2
-    certs.gmacpyutil.RunProcess(command).AndReturn((output, '', 0))
+    certs.gmacpyutil.RunProcessInBackground(command, close_fds=True).AndReturn(
+        self.Task(output, 0))
     certs.Certificate(cert.strip()).AndReturn('parsed cert')
     certs.Certificate(cert.strip()).AndReturn('parsed cert')
 
@@ -199,29 +359,14 @@ class CertsModuleTest(mox.MoxTestBase):
                      list(certs._GetCertificates()))
     self.mox.VerifyAll()
 
-  def testGetCertificatesNoKeychainCertError(self):
-    """Test _GetCertificates with CertError from Certificate class."""
-    self.StubSetup()
-    self.mox.StubOutWithMock(certs, 'Certificate')
-    command = [certs.CMD_SECURITY, 'find-certificate', '-a', '-p']
-    cert = '%s\n%s\n%s\n' % (certs.PEM_HEADER, 'cert_body', certs.PEM_FOOTER)
-    output = cert * 2
-    certs.gmacpyutil.RunProcess(command).AndReturn((output, '', 0))
-    certs.Certificate(cert.strip()).AndRaise(certs.CertError('err'))
-    certs.logging.info('Encountered an unparseable certificate, continuing.')
-    certs.logging.debug('err')
-    certs.Certificate(cert.strip()).AndReturn('parsed cert')
-
-    self.mox.ReplayAll()
-    self.assertEqual(['parsed cert'], list(certs._GetCertificates()))
-    self.mox.VerifyAll()
-
   def testGetCertificatesNewKeychain(self):
     """Test _GetCertificates with a newly-created keychain."""
     self.StubSetup()
+    self.mox.StubOutWithMock(certs.gmacpyutil, 'RunProcessInBackground')
     self.mox.StubOutWithMock(certs, 'Certificate')
     command = [certs.CMD_SECURITY, 'find-certificate', '-a', '-p']
-    certs.gmacpyutil.RunProcess(command).AndReturn(('', '', 9))
+    certs.gmacpyutil.RunProcessInBackground(command, close_fds=True).AndReturn(
+        self.Task('', 9))
 
     self.mox.ReplayAll()
     self.assertEqual([], list(certs._GetCertificates()))
@@ -230,24 +375,48 @@ class CertsModuleTest(mox.MoxTestBase):
   def testGetCertificatesNoKeychainSearchFailed(self):
     """Test _GetCertificates, no keychain, search failed."""
     self.StubSetup()
+    self.mox.StubOutWithMock(certs.gmacpyutil, 'RunProcessInBackground')
     self.mox.StubOutWithMock(certs, 'Certificate')
     command = [certs.CMD_SECURITY, 'find-certificate', '-a', '-p']
-    certs.gmacpyutil.RunProcess(command).AndReturn(('', '', 1))
+    certs.gmacpyutil.RunProcessInBackground(command, close_fds=True).AndReturn(
+        self.Task('', 1, stderr='err'))
 
     self.mox.ReplayAll()
     c = certs._GetCertificates()
     self.assertRaises(certs.CertError, c.next)
     self.mox.VerifyAll()
 
+  def testGetCertificatesLargeStderr(self):
+    """Test _GetCertificates reads stderr while it reads certificates."""
+    cert = '%s\n%s\n%s\n' % (certs.PEM_HEADER, 'cert_body', certs.PEM_FOOTER)
+    def RunProcessInBackground(unused_cmd, close_fds=False):
+      self.assertTrue(close_fds)
+      return subprocess.Popen(
+          [sys.executable, '-c',
+           'import sys; sys.stderr.write("warning\\n" * 100000); '
+           'sys.stdout.write(%r); sys.exit(1)' % cert],
+          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    self.mox.stubs.Set(certs.gmacpyutil, 'RunProcessInBackground',
+                       RunProcessInBackground)
+    certificates = certs._GetCertificates()
+    self.assertEqual(cert.strip(), certificates.next().pem)
+    try:
+      certificates.next()
+    except certs.CertError, e:
+      self.assertTrue('warning' in str(e))
+    else:
+      self.fail('CertError not raised')
+
   def testGetCertificatesKeychainSpecifiedSuccess(self):
     """Test _GetCertificates with keychain specified."""
     self.StubSetup()
+    self.mox.StubOutWithMock(certs.gmacpyutil, 'RunProcessInBackground')
     self.mox.StubOutWithMock(certs, 'Certificate')
-    command = [certs.CMD_SECURITY, 'find-certificate', '-a', '-p']
     cert = '%s\n%s\n%s\n' % (certs.PEM_HEADER, 'cert_body', certs.PEM_FOOTER)
     output = cert * 2
     command = [certs.CMD_SECURITY, 'find-certificate', '-a', '-p', 'keychain']
-    certs.gmacpyutil.RunProcess(command).AndReturn((output, '', 0))
+    certs.gmacpyutil.RunProcessInBackground(command, close_fds=True).AndReturn(
+        self.Task(output, 0))
     certs.Certificate(cert.strip()).AndReturn('parsed cert')
     certs.Certificate(cert.strip()).AndReturn('parsed cert')
 
@@ -256,6 +425,61 @@ class CertsModuleTest(mox.MoxTestBase):
                      list(certs._GetCertificates(keychain='keychain')))
     self.mox.VerifyAll()
 
+  def testGetCertificatesParse(self):
+    """Test _GetCertificates parsing in the pool, in order."""
+    self.StubSetup()
+    self.mox.StubOutWithMock(certs.gmacpyutil, 'RunProcessInBackground')
+    command = [certs.CMD_SECURITY, 'find-certificate', '-a', '-p']
+    bad = '%s\n%s\n%s\n' % (certs.PEM_HEADER, 'bad', certs.PEM_FOOTER)
+    # security indents nothing, but may print other lines between blocks.
+    output = 'noise\n' + (ROOT_PEM + bad + LEAF_PEM) * 10
+    certs.gmacpyutil.RunProcessInBackground(command, close_fds=True).AndReturn(
+        self.Task(output, 0))
+    certs.logging.info(
+        'Encountered %d unparseable certificate(s), skipped them.', 10)
+    certs.logging.debug('First unparseable certificate error: %s',
+                        mox.IsA(certs.CertError))
+    # Called from the pool's threads, so not a mox mock: mox is not
+    # thread-safe.
+    openssl_pems = []
+    lock = threading.Lock()
+
+    def FakeParseWithOpenSSL(unused_cert, pem):
+      with lock:
+        openssl_pems.append(pem)
+      raise certs.CertError('bad')
+
+    self.mox.stubs.Set(certs.Certificate, '_ParsePEMCertificateWithOpenSSL',
+                       FakeParseWithOpenSSL)
+
+    self.mox.ReplayAll()
+    parsed = list(certs._GetCertificates(parse=True))
+    self.assertEqual([ROOT_PEM.strip(), LEAF_PEM.strip()] * 10,
+                     [c.pem for c in parsed])
+    self.assertEqual([bad.strip()] * 10, openssl_pems)
+    self.assertEqual('791cf1e2', parsed[1].certhash)
+    self.mox.VerifyAll()
+
+  def testGetCertificatesStoppedEarly(self):
+    """Test _GetCertificates kills security when the caller stops early."""
+    self.StubSetup()
+    self.mox.StubOutWithMock(certs.gmacpyutil, 'RunProcessInBackground')
+    command = [certs.CMD_SECURITY, 'find-certificate', '-a', '-p']
+    task = self.mox.CreateMockAnything()
+    task.stdout = StringIO.StringIO(ROOT_PEM + LEAF_PEM)
+    task.stderr = StringIO.StringIO('')
+    certs.gmacpyutil.RunProcessInBackground(
+        command, close_fds=True).AndReturn(task)
+    task.poll().AndReturn(None)
+    task.kill()
+    task.wait().AndReturn(-9)
+
+    self.mox.ReplayAll()
+    c = certs._GetCertificates()
+    self.assertEqual(ROOT_PEM.strip(), c.next().pem)
+    c.close()
+    self.mox.VerifyAll()
+
   def testDeleteCert(self):
     """Test DeleteCert."""
     self.StubSetup()
@@ -292,11 +516,11 @@ class CertsModuleTest(mox.MoxTestBase):
     allcerts = [{'subject': 's1', 'issuer': 'i1', 'fingerprint': 'f1'},
                 {'subject': 's2', 'issuer': 'i1', 'fingerprint': 'f2'},
                 {'subject': 's3', 'issuer': 'i2', 'fingerprint': 'f3'}]
-    certs._GetCertificates(keychain=None).AndReturn(allcerts)
-    certs._GetCertificates(keychain=None).AndReturn(allcerts)
-    certs._GetCertificates(keychain=None).AndReturn(allcerts)
-    certs._GetCertificates(keychain=None).AndReturn(allcerts)
-    certs._GetCertificates(keychain=None).AndReturn(allcerts)
+    certs._GetCertificates(keychain=None, parse=False).AndReturn(allcerts)
+    certs._GetCertificates(keychain=None, parse=True).AndReturn(allcerts)
+    certs._GetCertificates(keychain=None, parse=True).AndReturn(allcerts)
+    certs._GetCertificates(keychain=None, parse=True).AndReturn(allcerts)
+    certs._GetCertificates(keychain=None, parse=True).AndReturn(allcerts)
     self.mox.ReplayAll()
     self.assertEqual(allcerts, certs.FindCertificates())
     self.assertEqual(allcerts[0:1], certs.FindCertificates(subject='s1'))
@@ -305,14 +529,72 @@ class CertsModuleTest(mox.MoxTestBase):
     self.assertEqual([], certs.FindCertificates(subject='s1', issuer='i2'))
     self.mox.VerifyAll()
 
+  def testFindCertificatesUnparseable(self):
+    """Test FindCertificates skips certificates which fail to parse."""
+    self.StubSetup()
+    self.mox.StubOutWithMock(certs, '_GetCertificates')
+    bad = self.mox.CreateMockAnything()
+    good = self.mox.CreateMockAnything()
+    certs._GetCertificates(keychain=None, parse=True).AndReturn([bad, good])
+    bad.get('subject').AndRaise(certs.CertError('err'))
+    good.get('subject').AndReturn('s1')
+    certs.logging.info(
+        'Encountered %d unparseable certificate(s), skipped them.', 1)
+    certs.logging.debug('First unparseable certificate error: %s',
+                        mox.IsA(certs.CertError))
+
+    self.mox.ReplayAll()
+    self.assertEqual([good], certs.FindCertificates(subject='s1'))
+    self.mox.VerifyAll()
+
+  def testFindCertificatesQuery(self):
+    """Test FindCertificates with Query criteria."""
+    self.StubSetup()
+    self.mox.StubOutWithMock(certs, '_GetCertificates')
+    allcerts = [{'subject_cn': 'host1.megacorp.com', 'issuer_cn': 'CA1'},
+                {'subject_cn': 'host2.megacorp.com', 'issuer_cn': 'CA2'},
+                {'subject_cn': 'user', 'issuer_cn': 'CA1'}]
+    for _ in range(3):
+      certs._GetCertificates(keychain=None, parse=True).AndReturn(allcerts)
+    self.mox.ReplayAll()
+    self.assertEqual(allcerts[0:2], certs.FindCertificates(
+        subject_cn=certs.Prefix('subject_cn', 'host')))
+    self.assertEqual(allcerts[0:1], certs.FindCertificates(
+        issuer_cn='CA1', query=certs.Regex('subject_cn', r'\.megacorp\.')))
+    self.assertEqual(allcerts[1:3], certs.FindCertificates(
+        query=certs.Equals('issuer_cn', 'CA2') | certs.Equals('subject_cn',
+                                                              'user')))
+    self.mox.VerifyAll()
+
+  def testFindFirstCertificate(self):
+    """Test FindFirstCertificate stops at the first match."""
+    self.StubSetup()
+    self.mox.StubOutWithMock(certs, '_GetCertificates')
+    scanned = []
+
+    def Certificates():
+      for subject in ('s1', 's2', 's3'):
+        scanned.append(subject)
+        yield {'subject': subject}
+
+    certs._GetCertificates(keychain=None, parse=True).AndReturn(Certificates())
+    certs._GetCertificates(keychain=None, parse=True).AndReturn([])
+    self.mox.ReplayAll()
+    self.assertEqual({'subject': 's2'},
+                     certs.FindFirstCertificate(subject='s2'))
+    self.assertEqual(['s1', 's2'], scanned)
+    self.assertEqual(None, certs.FindFirstCertificate(subject='s2'))
+    self.assertRaises(TypeError, certs.FindFirstCertificate, subjectcn='s2')
+    self.mox.VerifyAll()
+
   def testCertificateExpired(self):
     """Test CertificateExpired."""
     c = self.mox.CreateMockAnything()
     self.mox.ReplayAll()
-    expired = datetime.datetime.today() - datetime.timedelta(days=1)
+    expired = datetime.datetime.utcnow() - datetime.timedelta(days=1)
     c.enddate = [None, expired]
     self.assertTrue(certs.CertificateExpired(c))
-    unexpired = datetime.datetime.today() + datetime.timedelta(days=1)
+    unexpired = datetime.datetime.utcnow() + datetime.timedelta(days=1)
     c.enddate = [None, unexpired]
     self.assertFalse(certs.CertificateExpired(c))
     self.mox.VerifyAll()
@@ -379,19 +661,108 @@ class CertsModuleTest(mox.MoxTestBase):
             '    "svce"<blob>="com.apple.assistant"\n'
             '    "type"<uint32>=<NULL>\n')
 
+    dump += dump.replace('.wlan.ssid', '.wlan.ssid.Corp')
+    self.mox.StubOutWithMock(certs.gmacpyutil, 'RunProcessInBackground')
     cmd = [certs.CMD_SECURITY, 'dump-keychain']
-    certs.gmacpyutil.RunProcess(cmd).AndReturn((dump, None, 0))
-
-    cmd = [certs.CMD_SECURITY, 'set-identity-preference', '-n', '-s',
-           'com.apple.network.eap.user.identity.wlan.ssid']
-    certs.logging.debug('Removing identity preference: %s', cmd)
+    certs.gmacpyutil.RunProcessInBackground(cmd).AndReturn(self.Task(dump, 0))
+    services = ['com.apple.network.eap.user.identity.wlan.ssid',
+                'com.apple.network.eap.user.identity.wlan.ssid.Corp']
+    certs.logging.debug('Removing identity preferences: %s', services)
+    certs.logging.debug('Running %d security command(s) in one batch', 2)
+    script = ('"set-identity-preference" "-n" "-s" '
+              '"com.apple.network.eap.user.identity.wlan.ssid"\n'
+              '"set-identity-preference" "-n" "-s" '
+              '"com.apple.network.eap.user.identity.wlan.ssid.Corp"\n')
     certs.gmacpyutil.RunProcess(
-        cmd, sudo=False, sudo_password=None).AndReturn((None, None, 0))
+        [certs.CMD_SECURITY, '-i'], script, sudo=False).AndReturn(
+            ('', '', 0))
+    certs.logging.debug('Identity preference removal output: %s', '')
 
     self.mox.ReplayAll()
     certs.ClearIdentityPreferences()
     self.mox.VerifyAll()
 
+  def testClearIdentityPreferencesSudo(self):
+    """Test ClearIdentityPreferences authenticates sudo once."""
+    self.StubSetup()
+    self.mox.StubOutWithMock(certs, 'DumpKeychain')
+    item = certs.KeychainItem('k')
+    item.attributes['svce'] = 'com.apple.network.eap.system.identity.x'
+    certs.DumpKeychain().AndRaise(certs.KeychainError('dump'))
+    certs.logging.error(mox.IgnoreArg(), mox.IgnoreArg())
+    certs.DumpKeychain().AndReturn([item])
+    certs.logging.debug(mox.IgnoreArg(), [item.attributes['svce']])
+    certs.gmacpyutil.RunProcess(
+        ['-v'], sudo=True, sudo_password='pass').AndReturn(('', 'no', 1))
+
+    self.mox.ReplayAll()
+    certs.ClearIdentityPreferences(sudo_password='pass')
+    self.assertRaises(certs.CertError, certs.ClearIdentityPreferences,
+                      sudo_password='pass')
+    self.mox.VerifyAll()
+
+  def testRunSecurityBatchSudoWantsPassword(self):
+    """Test _RunSecurityBatch fails rather than let sudo prompt again."""
+    self.StubSetup()
+    certs.gmacpyutil.RunProcess(
+        ['-v'], sudo=True, sudo_password='pass').AndReturn(('', '', 0))
+    certs.logging.debug(mox.IgnoreArg(), 1)
+    certs.gmacpyutil.RunProcess(
+        [certs.CMD_SUDO, '-n', certs.CMD_SECURITY, '-i'],
+        '"list-keychains"\n').AndReturn(
+            ('', 'sudo: a password is required\n', 1))
+    certs.gmacpyutil.RunProcess(
+        ['-v'], sudo=True, sudo_password='pass').AndReturn(('', '', 0))
+    certs.logging.debug(mox.IgnoreArg(), 1)
+    certs.gmacpyutil.RunProcess(
+        [certs.CMD_SUDO, '-n', certs.CMD_SECURITY, '-i'],
+        '"list-keychains"\n').AndReturn(('', 'security: failed', 1))
+
+    self.mox.ReplayAll()
+    self.assertRaises(certs.CertError, certs._RunSecurityBatch,
+                      [['list-keychains']], sudo=True, sudo_password='pass')
+    self.assertEqual(('', 'security: failed', 1), certs._RunSecurityBatch(
+        [['list-keychains']], sudo=True, sudo_password='pass'))
+    self.mox.VerifyAll()
+
+  def testDumpKeychain(self):
+    """Test DumpKeychain parses items as they are read."""
+    self.StubSetup()
+    self.mox.StubOutWithMock(certs.gmacpyutil, 'RunProcessInBackground')
+    dump = ('keychain: "/k.keychain"\n'
+            'version: 512\n'
+            'class: "genp"\n'
+            'attributes:\n'
+            '    0x00000007 <blob>="name"\n'
+            '    "acct"<blob>=<NULL>\n'
+            '    "svce"<blob>="say \\"hi\\""\n'
+            'keychain: "/k.keychain"\n'
+            'class: 0x80001000 \n'
+            'attributes:\n'
+            '    "alis"<blob>=0x0A00  "\\012"\n')
+    certs.gmacpyutil.RunProcessInBackground(
+        [certs.CMD_SECURITY, 'dump-keychain', '/k.keychain']).AndReturn(
+            self.Task(dump, 0))
+    certs.gmacpyutil.RunProcessInBackground(
+        [certs.CMD_SECURITY, 'dump-keychain']).AndReturn(
+            self.Task('', 50, stderr='error'))
+
+    self.mox.ReplayAll()
+    items = list(certs.DumpKeychain('/k.keychain'))
+    self.assertEqual(['/k.keychain', '/k.keychain'],
+                     [i.keychain for i in items])
+    self.assertEqual(['genp', '0x80001000 '], [i.item_class for i in items])
+    self.assertEqual({'0x00000007': 'name', 'acct': None,
+                      'svce': 'say \\"hi\\"'}, items[0].attributes)
+    self.assertEqual({'alis': '0x0A00  "\\012"'}, items[1].attributes)
+    self.assertRaises(certs.KeychainError, list, certs.DumpKeychain())
+    self.mox.VerifyAll()
+
+  def testQuoteSecurityArg(self):
+    """Test _QuoteSecurityArg."""
+    self.assertEqual('"a b"', certs._QuoteSecurityArg('a b'))
+    self.assertEqual(r'"a\"b\\c"', certs._QuoteSecurityArg(r'a"b\c'))
+
   def testCreateIdentityPreference(self):
     """Test CreateIdentityPreference."""
     self.StubSetup()
@@ -783,30 +1154,156 @@ class CertsModuleTest(mox.MoxTestBase):
   def testRemoveIssuerCertsFromKeycahin(self):
     """Test RemoveIssuerCertsFromKeychain."""
     self.StubSetup()
-    self.mox.StubOutWithMock(certs, 'DeleteCert')
     self.mox.StubOutWithMock(certs, 'FindCertificates')
-    c = self.mox.CreateMockAnything()
-    c.osx_fingerprint = 'f'
-
-    # Remove is successful
-    certs.FindCertificates(issuer_cn='i', keychain='k').AndReturn([c])
+    self.mox.StubOutWithMock(certs, '_RunSecurityBatch')
+    c1 = self.mox.CreateMockAnything()
+    c1.osx_fingerprint = 'f1'
+    c1.serial = 's1'
+    c2 = self.mox.CreateMockAnything()
+    c2.osx_fingerprint = 'f2'
+    c2.serial = 's2'
+    commands = [['delete-certificate', '-Z', 'f1', 'k'],
+                ['delete-certificate', '-Z', 'f2', 'k']]
+
+    # Remove is successful, with one security process
+    certs.FindCertificates(issuer_cn='i', keychain='k').AndReturn([c1, c2])
     certs.logging.debug(
-        'Removing cert with fingerprint %s from %s', 'f', 'k').AndReturn(None)
-    certs.DeleteCert('f', password=None,
-                     gui=False, keychain='k').AndReturn(None)
-    # Remove fails
-    certs.FindCertificates(issuer_cn='i', keychain='k').AndReturn([c])
+        'Removing cert with fingerprint %s from %s', 'f1', 'k').AndReturn(None)
     certs.logging.debug(
-        'Removing cert with fingerprint %s from %s', 'f', 'k').AndReturn(None)
-    certs.DeleteCert('f', password=None,
-                     gui=False, keychain='k').AndRaise(certs.CertError('err'))
-    certs.logging.error('Cannot delete old certificate: %s', 'err')
+        'Removing cert with fingerprint %s from %s', 'f2', 'k').AndReturn(None)
+    certs.tempfile.mkdtemp(prefix=mox.IgnoreArg()).AndReturn('tempdir')
+    certs.logging.info(mox.IgnoreArg(), 2, 'k')
+    certs._RunSecurityBatch(commands, sudo=False, sudo_password=None).AndReturn(
+        ('out', '', 0))
+    certs.logging.debug('Keychain session output: %s', 'out')
+    certs.shutil.rmtree('tempdir')
+    certs.FindCertificates(keychain='k').AndReturn([])
+    # Remove partly fails
+    certs.FindCertificates(issuer_cn='i', keychain='k').AndReturn([c1, c2])
+    certs.logging.debug(mox.IgnoreArg(), 'f1', 'k').AndReturn(None)
+    certs.logging.debug(mox.IgnoreArg(), 'f2', 'k').AndReturn(None)
+    certs.tempfile.mkdtemp(prefix=mox.IgnoreArg()).AndReturn('tempdir')
+    certs.logging.info(mox.IgnoreArg(), 2, 'k')
+    certs._RunSecurityBatch(commands, sudo=False, sudo_password=None).AndReturn(
+        ('out', 'err', 1))
+    certs.logging.debug('Keychain session output: %s', 'out')
+    certs.shutil.rmtree('tempdir')
+    certs.FindCertificates(keychain='k').AndReturn([c2])
+    certs.logging.error('Cannot delete old certificates: %s',
+                        'Unable to delete 1 certificate(s): err')
+
+    self.mox.ReplayAll()
+    self.assertEqual(['s1', 's2'],
+                     certs.RemoveIssuerCertsFromKeychain('i', keychain='k'))
+    self.assertEqual(['s1'],
+                     certs.RemoveIssuerCertsFromKeychain('i', keychain='k'))
+    self.mox.VerifyAll()
+
+  def testKeychainSession(self):
+    """Test KeychainSession applies all changes with one sudo and process."""
+    self.StubSetup()
+    self.mox.StubOutWithMock(certs, 'FindCertificates')
+    certs.os.path.exists('app').AndReturn(True)
+    certs.gmacpyutil.RunProcess(
+        ['-v'], sudo=True, sudo_password='pass').AndReturn(('', '', 0))
+    certs.tempfile.mkdtemp(prefix=mox.IgnoreArg()).AndReturn('tempdir')
+    for name, contents in (('0-private.key', 'key'),
+                           ('1-certificate.cer', 'cert'),
+                           ('2-trusted_certificate.pem', 'root')):
+      mock_file = self.mox.CreateMockAnything()
+      open('tempdir/%s' % name, 'w').AndReturn(mock_file)
+      mock_file.__enter__().AndReturn(mock_file)
+      mock_file.write(contents)
+      mock_file.__exit__(None, None, None)
+    certs.logging.info(mox.IgnoreArg(), 4, certs.SYSTEM_KEYCHAIN)
+    # _RunSecurityBatch
+    certs.gmacpyutil.RunProcess(
+        ['-v'], sudo=True, sudo_password='pass').AndReturn(('', '', 0))
+    certs.logging.debug(mox.IgnoreArg(), 4)
+    script = ('"import" "tempdir/0-private.key" "-x" "-k" "%(k)s" '
+              '"-P" "p\\"w" "-T" "app"\n'
+              '"import" "tempdir/1-certificate.cer" "-x" "-k" "%(k)s"\n'
+              '"add-trusted-cert" "-d" "-r" "trustRoot" "-p" "ssl" '
+              '"-k" "%(k)s" "tempdir/2-trusted_certificate.pem"\n'
+              '"delete-certificate" "-Z" "f" "%(k)s"\n'
+              % {'k': certs.SYSTEM_KEYCHAIN})
+    certs.gmacpyutil.RunProcess(
+        [certs.CMD_SUDO, '-n', certs.CMD_SECURITY, '-i'], script).AndReturn(
+            ('out', '', 0))
+    certs.logging.debug('Keychain session output: %s', 'out')
+    certs.shutil.rmtree('tempdir')
+    certs.FindCertificates(keychain=certs.SYSTEM_KEYCHAIN).AndReturn(
+        [certs.Certificate('cert'), certs.Certificate('root')])
 
     self.mox.ReplayAll()
-    # Remove is sucessful
-    certs.RemoveIssuerCertsFromKeychain('i', keychain='k')
-    # Remove fails
-    certs.RemoveIssuerCertsFromKeychain('i', keychain='k')
+    with certs.KeychainSession(certs.SYSTEM_KEYCHAIN,
+                               password='pass') as session:
+      session.InstallCert('cert', 'key', trusted_app_path='app',
+                          passphrase='p"w')
+      session.InstallTrustedCert('root', root_ca=True, policies=['ssl'])
+      session.DeleteCert('f')
+    self.assertEqual(['f'], session.deleted)
+    # Nothing left to commit
+    session.Commit()
+    self.mox.VerifyAll()
+
+  def testKeychainSessionFailure(self):
+    """Test KeychainSession raises KeychainError when security fails."""
+    self.StubSetup()
+    self.mox.StubOutWithMock(certs, '_RunSecurityBatch')
+    self.mox.StubOutWithMock(certs, 'FindCertificates')
+    certs.tempfile.mkdtemp(prefix=mox.IgnoreArg()).AndReturn('tempdir')
+    mock_file = self.mox.CreateMockAnything()
+    open('tempdir/0-trusted_certificate.pem', 'w').AndReturn(mock_file)
+    mock_file.__enter__().AndReturn(mock_file)
+    mock_file.write('root')
+    mock_file.__exit__(None, None, None)
+    certs.logging.info(mox.IgnoreArg(), 1, 'k')
+    certs._RunSecurityBatch(mox.IgnoreArg(), sudo=False,
+                            sudo_password=None).AndReturn(('out', 'err', 1))
+    certs.logging.debug('Keychain session output: %s', 'out')
+    certs.shutil.rmtree('tempdir')
+    certs.FindCertificates(keychain='k').AndReturn(
+        [certs.Certificate('root')])
+
+    self.mox.ReplayAll()
+    session = certs.KeychainSession('k')
+    session.InstallTrustedCert('root')
+    self.assertRaises(certs.KeychainError, session.Commit)
+    self.mox.VerifyAll()
+
+  def testKeychainSessionInstallFailure(self):
+    """Test KeychainSession notices an install that failed in the batch."""
+    self.StubSetup()
+    self.mox.StubOutWithMock(certs, '_RunSecurityBatch')
+    self.mox.StubOutWithMock(certs, 'FindCertificates')
+    certs.tempfile.mkdtemp(prefix=mox.IgnoreArg()).AndReturn('tempdir')
+    for name, contents in (('0-trusted_certificate.pem', ROOT_PEM),
+                           ('1-trusted_certificate.pem', LEAF_PEM)):
+      mock_file = self.mox.CreateMockAnything()
+      open('tempdir/%s' % name, 'w').AndReturn(mock_file)
+      mock_file.__enter__().AndReturn(mock_file)
+      mock_file.write(contents)
+      mock_file.__exit__(None, None, None)
+    certs.logging.info(mox.IgnoreArg(), 2, 'k')
+    # security -i exits 0 even though one of its commands failed.
+    certs._RunSecurityBatch(mox.IgnoreArg(), sudo=False,
+                            sudo_password=None).AndReturn(('out', 'err', 0))
+    certs.logging.debug('Keychain session output: %s', 'out')
+    certs.shutil.rmtree('tempdir')
+    certs.FindCertificates(keychain='k').AndReturn(
+        [certs.Certificate(ROOT_PEM)])
+
+    self.mox.ReplayAll()
+    session = certs.KeychainSession('k')
+    session.InstallTrustedCert(ROOT_PEM, root_ca=True)
+    session.InstallTrustedCert(LEAF_PEM)
+    try:
+      session.Commit()
+      self.fail('KeychainError not raised')
+    except certs.KeychainError, e:
+      self.assertTrue(certs.Certificate(LEAF_PEM).osx_fingerprint in str(e))
+      self.assertFalse(certs.Certificate(ROOT_PEM).osx_fingerprint in str(e))
     self.mox.VerifyAll()
 
   def testGenerateCSRNoPassphrase(self):
@@ -949,6 +1446,555 @@ class CertsModuleTest(mox.MoxTestBase):
     self.assertEqual(sudo_pass, None)
 
 
+class QueryTest(basetest.TestCase):
+  """Test the certificate query engine."""
+
+  def setUp(self):
+    today = datetime.datetime.today()
+    self.cert = {'subject_cn': 'machine.megacorp.com',
+                 'fingerprint': 'AB:CD',
+                 'enddate': ['end', today + datetime.timedelta(days=10)]}
+
+  def testEquals(self):
+    self.assertTrue(certs.Equals('subject_cn', 'machine.megacorp.com')(
+        self.cert))
+    self.assertFalse(certs.Equals('subject_cn', 'machine')(self.cert))
+    self.assertFalse(certs.Equals('issuer_cn', 'machine')(self.cert))
+
+  def testPrefix(self):
+    self.assertTrue(certs.Prefix('subject_cn', 'machine.')(self.cert))
+    self.assertFalse(certs.Prefix('subject_cn', 'megacorp')(self.cert))
+    self.assertFalse(certs.Prefix('issuer_cn', 'machine')(self.cert))
+
+  def testRegex(self):
+    self.assertTrue(certs.Regex('subject_cn', r'\.megacorp\.com$')(self.cert))
+    self.assertTrue(certs.Regex('subject_cn', 'MEGACORP', re.I)(self.cert))
+    self.assertFalse(certs.Regex('subject_cn', '^megacorp')(self.cert))
+    self.assertFalse(certs.Regex('issuer_cn', '.*')(self.cert))
+
+  def testDateWindow(self):
+    today = datetime.datetime.today()
+    self.assertTrue(certs.DateWindow('enddate', after=today)(self.cert))
+    self.assertFalse(certs.DateWindow(
+        'enddate', before=today + datetime.timedelta(days=1))(self.cert))
+    self.assertFalse(certs.DateWindow('startdate', after=today)(self.cert))
+
+  def testExpiresWithin(self):
+    self.assertTrue(certs.ExpiresWithin(days=30)(self.cert))
+    self.assertFalse(certs.ExpiresWithin(days=7)(self.cert))
+    self.cert['enddate'] = ['bad date', None]
+    self.assertRaises(certs.CertError, certs.ExpiresWithin(days=7), self.cert)
+
+  def testAllOfAnyOfShortCircuit(self):
+    calls = []
+
+    def Recorder(name, result):
+      def Predicate(unused_cert):
+        calls.append(name)
+        return result
+      return certs.Query(Predicate, name)
+
+    self.assertFalse(certs.AllOf(Recorder('a', False),
+                                 Recorder('b', True))(self.cert))
+    self.assertTrue(certs.AnyOf(Recorder('c', True),
+                                Recorder('d', False))(self.cert))
+    self.assertTrue((Recorder('e', True) & Recorder('f', True))(self.cert))
+    self.assertEqual(['a', 'c', 'e', 'f'], calls)
+
+  def testCompileQueryOrdersCheapCriteriaFirst(self):
+    query = certs.CompileQuery(subject_cn='machine.megacorp.com', issuer=None,
+                               fingerprint='AB:CD')
+    self.assertEqual("(fingerprint == 'AB:CD' and "
+                     "subject_cn == 'machine.megacorp.com')", query.description)
+    self.assertTrue(query(self.cert))
+    self.assertTrue(certs.CompileQuery()(self.cert))
+
+
+class KeychainIndexTest(mox.MoxTestBase):
+  """Test KeychainIndex."""
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.tempdir = tempfile.mkdtemp()
+    self.keychain = os.path.join(self.tempdir, 'test.keychain')
+    with open(self.keychain, 'w') as keychain:
+      keychain.write('keychain')
+    self.index_dir = os.path.join(self.tempdir, 'index')
+    self.mox.StubOutWithMock(certs, '_GetCertificates')
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    shutil.rmtree(self.tempdir)
+
+  def testRefreshBuildsAndSaves(self):
+    """Test Refresh builds the index once and later loads it from disk."""
+    certs._GetCertificates(keychain=self.keychain, parse=True).AndReturn(
+        [certs.Certificate(LEAF_PEM), certs.Certificate(ROOT_PEM)])
+
+    self.mox.ReplayAll()
+    index = certs.KeychainIndex(self.keychain, index_dir=self.index_dir)
+    index.Refresh()
+    self.assertTrue(os.path.exists(index.path))
+    loaded = certs.KeychainIndex(self.keychain, index_dir=self.index_dir)
+    loaded.Refresh()
+    found = loaded.Find('issuer_cn', 'Megacorp Root CA')
+    self.assertEqual([LEAF_PEM, ROOT_PEM], [c.pem for c in found])
+    self.assertEqual('791cf1e2', found[0].certhash)
+    self.assertEqual(str, type(found[0].pem))
+    self.assertEqual(['Jun  1 12:34:56 2016 GMT',
+                      datetime.datetime(2016, 6, 1, 12, 34, 56)],
+                     found[0].enddate)
+    self.mox.VerifyAll()
+
+  def testFind(self):
+    """Test Find for each indexed attribute."""
+    certs._GetCertificates(keychain=self.keychain, parse=True).AndReturn(
+        [certs.Certificate(LEAF_PEM), certs.Certificate(ROOT_PEM)])
+
+    self.mox.ReplayAll()
+    index = certs.KeychainIndex(self.keychain, index_dir=self.index_dir)
+    index.Refresh()
+    leaf = index.Find('fingerprint', 'DE:73:F9:9D:3E:49:3D:A1:D9:54:52:53:5F:'
+                      '67:DF:0E:FD:A4:01:51')
+    self.assertEqual([LEAF_PEM], [c.pem for c in leaf])
+    self.assertEqual('DE73F99D3E493DA1D95452535F67DF0EFDA40151',
+                     leaf[0].osx_fingerprint)
+    self.assertEqual([ROOT_PEM],
+                     [c.pem for c in index.Find('certhash', '482ded17')])
+    self.assertEqual([ROOT_PEM], [c.pem for c in index.Find(
+        'subject_cn', 'Megacorp Root CA')])
+    enddate = ['Jun  1 12:34:56 2016 GMT', None]
+    self.assertEqual([LEAF_PEM],
+                     [c.pem for c in index.Find('enddate', enddate)])
+    self.assertEqual([], index.Find('subject_cn', 'missing'))
+    self.assertEqual(2, len(index.All()))
+    self.mox.VerifyAll()
+
+  def testRefreshRebuildsWhenKeychainChanges(self):
+    """Test Refresh rebuilds the index when the keychain size changes."""
+    certs._GetCertificates(keychain=self.keychain, parse=True).AndReturn(
+        [certs.Certificate(LEAF_PEM)])
+    certs._GetCertificates(keychain=self.keychain, parse=True).AndReturn(
+        [certs.Certificate(LEAF_PEM), certs.Certificate(ROOT_PEM)])
+
+    self.mox.ReplayAll()
+    index = certs.KeychainIndex(self.keychain, index_dir=self.index_dir)
+    index.Refresh()
+    index.Refresh()
+    self.assertEqual(1, len(index.All()))
+    with open(self.keychain, 'a') as keychain:
+      keychain.write('more')
+    index.Refresh()
+    self.assertEqual(2, len(index.All()))
+    self.mox.VerifyAll()
+
+  def testInvalidate(self):
+    """Test Invalidate forces a rebuild."""
+    certs._GetCertificates(keychain=self.keychain, parse=True).AndReturn([])
+    certs._GetCertificates(keychain=self.keychain, parse=True).AndReturn([])
+
+    self.mox.ReplayAll()
+    index = certs.KeychainIndex(self.keychain, index_dir=self.index_dir)
+    index.Refresh()
+    index.Invalidate()
+    self.assertFalse(os.path.exists(index.path))
+    index.Refresh()
+    self.mox.VerifyAll()
+
+  def testGetKeychainIndexNotAFile(self):
+    """Test _GetKeychainIndex without a keychain file."""
+    self.mox.ReplayAll()
+    self.assertEqual(None, certs._GetKeychainIndex(None))
+    self.assertEqual(None, certs._GetKeychainIndex(
+        os.path.join(self.tempdir, 'missing.keychain')))
+    self.mox.VerifyAll()
+
+  def testUsableNotPrivate(self):
+    """Test Usable is False for an index directory others can write to."""
+    self.mox.ReplayAll()
+    os.makedirs(self.index_dir)
+    os.chmod(self.index_dir, 0777)
+    index = certs.KeychainIndex(self.keychain, index_dir=self.index_dir)
+    self.assertFalse(index.Usable())
+    self.mox.VerifyAll()
+
+  def testGetKeychainIndexUnusable(self):
+    """Test _GetKeychainIndex does not use an index that is not Usable."""
+    self.mox.StubOutWithMock(certs.KeychainIndex, 'Usable')
+    certs.KeychainIndex.Usable().AndReturn(False)
+    self.mox.ReplayAll()
+    self.assertEqual(None, certs._GetKeychainIndex(self.keychain))
+    self.mox.VerifyAll()
+
+  def testUsableOtherOwner(self):
+    """Test Usable is False for another user's keychain."""
+    self.mox.StubOutWithMock(certs.os, 'geteuid')
+    certs.os.geteuid().MultipleTimes().AndReturn(os.getuid() + 1)
+    self.mox.ReplayAll()
+    index = certs.KeychainIndex(self.keychain, index_dir=self.index_dir)
+    self.assertFalse(index.Usable())
+    self.assertFalse(os.path.exists(self.index_dir))
+    self.mox.VerifyAll()
+
+  def testRefreshIgnoresWritableIndexFile(self):
+    """Test Refresh rebuilds rather than load an index others can write."""
+    certs._GetCertificates(keychain=self.keychain, parse=True).AndReturn(
+        [certs.Certificate(LEAF_PEM)])
+    certs._GetCertificates(keychain=self.keychain, parse=True).AndReturn(
+        [certs.Certificate(LEAF_PEM)])
+
+    self.mox.ReplayAll()
+    index = certs.KeychainIndex(self.keychain, index_dir=self.index_dir)
+    index.Refresh()
+    os.chmod(index.path, 0666)
+    certs.KeychainIndex(self.keychain, index_dir=self.index_dir).Refresh()
+    self.mox.VerifyAll()
+
+  def testFindCertificatesUsesIndex(self):
+    """Test FindCertificates looks up candidates in the index."""
+    self.mox.StubOutWithMock(certs, '_GetKeychainIndex')
+    index = self.mox.CreateMock(certs.KeychainIndex)
+    leaf = certs.Certificate(LEAF_PEM)
+    certs._GetKeychainIndex('k').AndReturn(index)
+    index.Find('certhash', '791cf1e2').AndReturn([leaf])
+    certs._GetKeychainIndex('k').AndReturn(index)
+    index.All().AndReturn([leaf, certs.Certificate(ROOT_PEM)])
+
+    self.mox.ReplayAll()
+    self.assertEqual([leaf], certs.FindCertificates(
+        certhash='791cf1e2', subject_cn='admin@megacorp.com', keychain='k'))
+    self.assertEqual([leaf], certs.FindCertificates(
+        email='admin@megacorp.comuser@megacorp.com', keychain='k'))
+    self.mox.VerifyAll()
+
+
+class ScanCertificateExpiryTest(mox.MoxTestBase):
+  """Test ScanCertificateExpiry and the expiry scanner CLI."""
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.stubs = stubout.StubOutForTesting()
+    self.now = datetime.datetime(2016, 1, 1)
+    self.keychains = {}
+    self.stubs.Set(certs, '_GetKeychainIndex', lambda keychain: None)
+    self.stubs.Set(certs, '_GetCertificates', self.GetCertificates)
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    self.stubs.UnsetAll()
+
+  def GetCertificates(self, keychain=None, parse=False):
+    self.assertTrue(parse)
+    certificates = self.keychains[keychain]
+    if isinstance(certificates, Exception):
+      raise certificates
+    return iter(certificates)
+
+  def Cert(self, days, name):
+    cert = certs.Certificate(LEAF_PEM)
+    cert.subject_cn = name
+    enddate = self.now + datetime.timedelta(days=days)
+    cert.enddate = [enddate.strftime('%b %d %H:%M:%S %Y GMT'), enddate]
+    return cert
+
+  def testScan(self):
+    """Test top-K and bucket counts across keychains."""
+    self.keychains['a'] = [self.Cert(100, 'a100'), self.Cert(-1, 'a-1'),
+                           self.Cert(3, 'a3')]
+    self.keychains['b'] = [self.Cert(20, 'b20'), self.Cert(29, 'b29'),
+                           self.Cert(-30, 'b-30')]
+
+    self.mox.ReplayAll()
+    report = certs.ScanCertificateExpiry(keychains=['a', 'b', 'a', None],
+                                         top=3, now=self.now)
+    self.assertEqual([('b', 'b-30'), ('a', 'a-1'), ('a', 'a3')],
+                     [(k, c.subject_cn) for k, c in report.soonest])
+    self.assertEqual({'expired': 2, '7d': 1, '30d': 2}, report.counts)
+    self.assertEqual(6, report.total)
+    self.assertEqual({}, report.errors)
+    self.mox.VerifyAll()
+
+  def testScanNoTop(self):
+    """Test buckets are still counted when no certificates are listed."""
+    self.keychains['a'] = [self.Cert(-1, 'a-1'), self.Cert(3, 'a3')]
+
+    self.mox.ReplayAll()
+    report = certs.ScanCertificateExpiry(keychains=['a'], top=0, now=self.now)
+    self.assertEqual([], report.soonest)
+    self.assertEqual({'expired': 1, '7d': 1, '30d': 0}, report.counts)
+    self.mox.VerifyAll()
+
+  def testScanErrors(self):
+    """Test a keychain which cannot be scanned does not stop the others."""
+    self.mox.StubOutWithMock(certs.logging, 'error')
+    self.mox.StubOutWithMock(certs.logging, 'info')
+    self.mox.StubOutWithMock(certs.logging, 'debug')
+    self.keychains['a'] = [self.Cert(3, 'a3'), certs.Certificate('garbage')]
+    self.keychains['b'] = certs.CertError('boom')
+    certs.logging.error(mox.IgnoreArg(), 'b', self.keychains['b'])
+    certs.logging.info(mox.IgnoreArg(), 1)
+    certs.logging.debug(mox.IgnoreArg(), mox.IgnoreArg())
+
+    self.mox.ReplayAll()
+    report = certs.ScanCertificateExpiry(keychains=['a', 'b'], now=self.now)
+    self.assertEqual(['a3'], [c.subject_cn for _, c in report.soonest])
+    self.assertEqual(1, report.total)
+    self.assertEqual({'b': 'boom'}, report.errors)
+    self.mox.VerifyAll()
+
+  def testMain(self):
+    """Test the CLI prints the counts and soonest expiring certificates."""
+    self.mox.StubOutWithMock(certs.gmacpyutil, 'ConfigureLogging')
+    self.mox.StubOutWithMock(certs, 'ScanCertificateExpiry')
+    self.mox.StubOutWithMock(certs, 'Output')
+    report = certs.ExpiryReport()
+    report.soonest = [('k', certs.Certificate(LEAF_PEM))]
+    report.counts['expired'] = 1
+    report.total = 2
+    report.errors['bad'] = 'boom'
+    certs.gmacpyutil.ConfigureLogging()
+    certs.ScanCertificateExpiry(
+        keychains=[certs.SYSTEM_KEYCHAIN, certs.login_keychain, 'k'],
+        top=5).AndReturn(report)
+    certs.Output('2 certificates: expired: 1, 7d: 0, 30d: 0')
+    certs.Output('Jun  1 12:34:56 2016 GMT  admin@megacorp.com  '
+                 'DE73F99D3E493DA1D95452535F67DF0EFDA40151  k')
+    certs.Output('Unable to scan bad: boom')
+
+    self.mox.ReplayAll()
+    self.assertEqual(1, certs.main(['', '-k', 'k', '-n', '5']))
+    self.mox.VerifyAll()
+
+  def testMainNoSubjectCN(self):
+    """Test the CLI lists a certificate whose subject has no CN."""
+    self.mox.StubOutWithMock(certs.gmacpyutil, 'ConfigureLogging')
+    self.mox.StubOutWithMock(certs, 'ScanCertificateExpiry')
+    self.mox.StubOutWithMock(certs, 'Output')
+    cert = self.Cert(3, None)
+    del cert.subject_cn
+    cert.subject = '/O=Megacorp/OU=Devices'
+    cert._parsed = True
+    report = certs.ExpiryReport()
+    report.soonest = [('k', cert)]
+    report.total = 1
+    certs.gmacpyutil.ConfigureLogging()
+    certs.ScanCertificateExpiry(
+        keychains=[certs.SYSTEM_KEYCHAIN, certs.login_keychain],
+        top=certs.EXPIRY_SCAN_TOP).AndReturn(report)
+    certs.Output('1 certificates: expired: 0, 7d: 0, 30d: 0')
+    certs.Output('Jan 04 00:00:00 2016 GMT  /O=Megacorp/OU=Devices  '
+                 'DE73F99D3E493DA1D95452535F67DF0EFDA40151  k')
+
+    self.mox.ReplayAll()
+    self.assertEqual(None, certs.main(['']))
+    self.mox.VerifyAll()
+
+  def testExpiryTimeBase(self):
+    """Test the scan and the expiry predicates measure from the same time."""
+    self.now = datetime.datetime.utcnow()
+    cert = self.Cert(0, 'edge')
+    cert.enddate[1] += datetime.timedelta(minutes=30)
+    self.keychains['a'] = [cert]
+    report = certs.ScanCertificateExpiry(keychains=['a'])
+    self.assertEqual(1, report.counts['7d'])
+    self.assertFalse(certs.CertificateExpired(cert))
+    self.assertFalse(certs.ExpiresWithin(seconds=0)(cert))
+    self.assertTrue(certs.ExpiresWithin(days=1)(cert))
+
+
+class IssuerIndexTest(mox.MoxTestBase):
+  """Test IssuerIndex and GetIssuerIndex."""
+
+  def testBuildChain(self):
+    """Test chains are built and verified from the index."""
+    self.mox.StubOutWithMock(certs, '_ReportUnparseable')
+    certs._ReportUnparseable([])
+    certs._ReportUnparseable([])
+
+    self.mox.ReplayAll()
+    root = certs.Certificate(ROOT_PEM)
+    leaf = certs.Certificate(LEAF_PEM)
+    index = certs.IssuerIndex([leaf, root, certs.Certificate(ROOT_PEM)])
+
+    chain = index.BuildChain(root)
+    self.assertEqual([root], chain.certificates)
+    self.assertTrue(chain.complete)
+    self.assertTrue(chain.verified)
+    self.assertEqual(None, chain.error)
+
+    # The leaf expired in 2016.
+    chain = index.BuildChain(leaf)
+    self.assertEqual([leaf, root], chain.certificates)
+    self.assertTrue(chain.complete)
+    self.assertFalse(chain.verified)
+    self.assertTrue('expired' in chain.error)
+
+    chain = certs.IssuerIndex([leaf]).BuildChain(leaf)
+    self.assertEqual([leaf], chain.certificates)
+    self.assertFalse(chain.complete)
+    self.assertFalse(chain.verified)
+    self.assertEqual('/C=US/O=Megacorp Inc./CN=Megacorp Root CA',
+                     chain.missing_issuer)
+    self.mox.VerifyAll()
+
+  def testGetIssuerIndex(self):
+    """Test GetIssuerIndex reads each keychain once."""
+    self.mox.StubOutWithMock(certs, '_GetKeychainIndex')
+    self.mox.StubOutWithMock(certs, '_GetCertificates')
+    self.mox.StubOutWithMock(certs.logging, 'info')
+    self.mox.StubOutWithMock(certs.logging, 'debug')
+    index = self.mox.CreateMock(certs.KeychainIndex)
+    certs._GetKeychainIndex('a').AndReturn(index)
+    index.All().AndReturn([certs.Certificate(ROOT_PEM)])
+    certs._GetKeychainIndex('b').AndReturn(None)
+    certs._GetCertificates(keychain='b').AndReturn(
+        iter([certs.Certificate(LEAF_PEM), certs.Certificate('garbage')]))
+    certs.logging.info(mox.IgnoreArg(), 1)
+    certs.logging.debug(mox.IgnoreArg(), mox.IgnoreArg())
+
+    self.mox.ReplayAll()
+    issuers = certs.GetIssuerIndex(keychains=['a', None, 'b'])
+    self.assertTrue(issuers.BuildChain(certs.Certificate(LEAF_PEM)).complete)
+    self.mox.VerifyAll()
+
+  def testNoPyOpenSSL(self):
+    """Test IssuerIndex without pyOpenSSL."""
+    self.stubs = stubout.StubOutForTesting()
+    self.stubs.Set(certs, 'crypto', None)
+    try:
+      self.assertRaises(certs.CertError, certs.IssuerIndex, [])
+    finally:
+      self.stubs.UnsetAll()
+
+
+class KeyPoolTest(mox.MoxTestBase):
+  """Test KeyPool and GenerateCSR with a key pool."""
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.tempdir = tempfile.mkdtemp()
+    self.pool = certs.KeyPool(pool_dir=self.tempdir, rsa_bits=1024, size=2,
+                              enabled=True)
+    pkey = certs.crypto.PKey()
+    pkey.generate_key(certs.crypto.TYPE_RSA, 1024)
+    self.key = certs.crypto.dump_privatekey(certs.crypto.FILETYPE_PEM, pkey)
+    self.mox.StubOutWithMock(certs.gmacpyutil, 'RunProcess')
+    self.command = [certs.CMD_NICE, '-n', '20', certs.CMD_OPENSSL, 'genrsa',
+                    '1024']
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+    shutil.rmtree(self.tempdir)
+
+  def testFillAndTake(self):
+    """Test Fill writes private keys and Take returns them oldest first."""
+    certs.gmacpyutil.RunProcess(self.command).AndReturn(('key1', '', 0))
+    certs.gmacpyutil.RunProcess(self.command).AndReturn(('key2', '', 0))
+
+    self.mox.ReplayAll()
+    self.pool.Fill()
+    self.pool.Fill()
+    self.assertEqual(2, self.pool.Count())
+    self.assertEqual(0700, os.stat(self.pool.path).st_mode & 0777)
+    for name in os.listdir(self.pool.path):
+      self.assertEqual(
+          0600, os.stat(os.path.join(self.pool.path, name)).st_mode & 0777)
+    self.assertEqual('key1', self.pool.Take())
+    self.assertEqual('key2', self.pool.Take())
+    self.assertEqual(None, self.pool.Take())
+    self.assertEqual([], os.listdir(self.pool.path))
+    self.mox.VerifyAll()
+
+  def testFillFailure(self):
+    """Test Fill raises CertError when openssl fails."""
+    certs.gmacpyutil.RunProcess(self.command).AndReturn(('', 'err', 1))
+
+    self.mox.ReplayAll()
+    self.assertRaises(certs.CertError, self.pool.Fill)
+    self.mox.VerifyAll()
+
+  def testNotPrivate(self):
+    """Test a pool other users can read is not used."""
+    self.mox.StubOutWithMock(certs.logging, 'warning')
+    certs.logging.warning(mox.IgnoreArg(), mox.IgnoreArg())
+
+    self.mox.ReplayAll()
+    os.makedirs(self.pool.path)
+    os.chmod(self.pool.path, 0755)
+    with open(os.path.join(self.pool.path, 'key.pem'), 'w') as key_file:
+      key_file.write(self.key)
+    self.assertEqual(None, self.pool.Take())
+    self.assertRaises(certs.CertError, self.pool.Fill)
+    self.mox.VerifyAll()
+
+  def testDisabledByDefault(self):
+    """Test a pool keeps no keys unless enabled."""
+    self.mox.ReplayAll()
+    pool = certs.KeyPool(pool_dir=self.tempdir, rsa_bits=1024)
+    self.assertFalse(pool.enabled)
+    pool.Fill()
+    pool.StartRefill()
+    self.assertEqual(None, pool.Take())
+    self.assertEqual(0, pool.Count())
+    self.assertEqual([], os.listdir(self.tempdir))
+    self.assertFalse('Caches' in certs.KEY_POOL_DIR)
+    self.mox.VerifyAll()
+
+  def testFillSweepsStaleFiles(self):
+    """Test Fill removes key files abandoned by processes that died."""
+    certs.gmacpyutil.RunProcess(self.command).AndReturn(('key1', '', 0))
+
+    self.mox.ReplayAll()
+    self.pool.size = 1
+    os.makedirs(self.pool.path, 0700)
+    stale = time.time() - certs.KEY_POOL_STALE_AGE - 1
+    for name in ('.newabc', '.taken-1.pem', '.newrecent'):
+      path = os.path.join(self.pool.path, name)
+      with open(path, 'w') as key_file:
+        key_file.write('partial')
+      if name != '.newrecent':
+        os.utime(path, (stale, stale))
+    self.pool.Fill()
+    names = os.listdir(self.pool.path)
+    self.assertEqual(2, len(names))
+    self.assertTrue('.newrecent' in names)
+    self.mox.VerifyAll()
+
+  def testGenerateCSR(self):
+    """Test GenerateCSR builds the CSR in process from a pooled key."""
+    self.mox.StubOutWithMock(self.pool, 'StartRefill')
+    self.pool.StartRefill()
+    self.pool.StartRefill()
+    certs.gmacpyutil.RunProcess(self.command).AndReturn((self.key, '', 0))
+
+    self.mox.ReplayAll()
+    self.pool.size = 1
+    self.pool.Fill()
+    csr, key, passphrase = certs.GenerateCSR(
+        '/C=US/O=Megacorp Inc./CN=host\\/1', rsa_bits=1024,
+        passphrase='pass', key_pool=self.pool)
+    self.assertEqual('pass', passphrase)
+    pkey = certs.crypto.load_privatekey(certs.crypto.FILETYPE_PEM, key, 'pass')
+    request = certs.crypto.load_certificate_request(certs.crypto.FILETYPE_PEM,
+                                                    csr)
+    self.assertTrue(request.verify(pkey))
+    self.assertEqual([('C', 'US'), ('O', 'Megacorp Inc.'), ('CN', 'host/1')],
+                     request.get_subject().get_components())
+    # The pool is empty now
+    self.assertEqual(None, certs._TakePooledKey(self.pool, 1024, None))
+    self.mox.VerifyAll()
+
+  def testParseSubject(self):
+    """Test _ParseSubject."""
+    self.mox.ReplayAll()
+    self.assertEqual([('CN', 'a=b/c'), ('OU', 'd')],
+                     certs._ParseSubject('/CN=a\\=b\\/c/OU=d'))
+    self.assertRaises(certs.CertError, certs._ParseSubject, 'CN=a')
+    self.assertRaises(certs.CertError, certs._ParseSubject, '/CN')
+    self.assertRaises(certs.CertError, certs._GenerateCSRInProcess,
+                      '/OU=a/OU=b', self.key)
+
+
 def main(unused_argv):
   basetest.main()
 
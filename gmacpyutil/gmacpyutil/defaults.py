@@ -9,18 +9,30 @@ IMAGEINFO = '/Library/Preferences/com.megacorp.imageinfo.plist'
 GUEST_NETWORKS = ['MegacorpGuest', 'MegacorpGuestPSK']
 GUEST_PSKS = ['hunter2', 'publicpassword']
 
+# certs module
+CERTS_INDEX_DIR = '~/Library/Caches/com.megacorp.gmacpyutil/certs'
+CERTS_KEY_POOL = False
+CERTS_KEY_POOL_DIR = (
+    '~/Library/Application Support/com.megacorp.gmacpyutil/keys')
+CERTS_KEY_POOL_SIZE = 2
+
 # cocoadialog module
 COCOADIALOG_PATH = '/Library/MegacorpSupport/Utilities/CocoaDialog.app'
 
 # experiments module
 EXPERIMENTS_YAML = '/var/db/puppet/experiments.yaml'
 
+# macdisk module
+MACDISK_IMAGE_CACHE_DIR = '~/Library/Caches/com.megacorp.gmacpyutil/images'
+
 # profiles module
 NETWORK_PROFILE_ID = 'com.megacorp.networkprofile'
 ORGANIZATION_NAME = 'Megacorp Inc.'
 
 # systemconfig module
 CORP_PROXY = 'https://proxyconfig.megacorp.com/proxy.pac'
+SYSTEM_PROFILER_CACHE_DIR = (
+    '~/Library/Caches/com.megacorp.gmacpyutil/system_profiler')
 
 # wifi_network_order module
 SSIDS = ['MegaWifi$WPA2E']
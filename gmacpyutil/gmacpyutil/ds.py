@@ -1,10 +1,20 @@
 """Module to read and configure directoryservice related data."""
 
+import contextlib
 import filecmp
+from multiprocessing import pool as thread_pool
 from optparse import OptionParser
 import os
 import plistlib
+import pty
+import Queue
+import re
+import select
 import shutil
+import subprocess
+import termios
+import threading
+import time
 
 # pylint: disable=g-import-not-at-top
 try:
@@ -17,6 +27,12 @@ except ImportError:
   else:
     raise
 
+try:
+  import ldap
+  import ldap.controls
+except ImportError:
+  ldap = None
+
 from . import gmacpyutil
 # pylint: enable=g-import-not-at-top
 
@@ -24,6 +40,21 @@ _DSCL = '/usr/bin/dscl'
 _DSCACHEUTIL = '/usr/bin/dscacheutil'
 _DSEDITGROUP = '/usr/sbin/dseditgroup'
 _EDITGROUPACTIONS = {'add': '-a', 'delete': '-d'}
+# Seconds records read in bulk from each node stay in the record cache; nodes
+# not listed here are not cached.
+RECORD_CACHE_TTLS = {'.': 60}
+# Number of nested group lookups to run at once.
+GROUP_RESOLVER_THREADS = 8
+# Seconds to wait for a DSSession's dscl to answer a command.
+DSSESSION_TIMEOUT = 60
+# Whether nested group lookups against an LDAP server ask it directly with an
+# LDAPResolver, when python-ldap is available, rather than through dscl.
+USE_LDAP_RESOLVER = False
+# Connections an LDAPResolver keeps open, entries per page of its searches
+# and seconds it waits for the server.
+LDAP_POOL_SIZE = GROUP_RESOLVER_THREADS
+LDAP_PAGE_SIZE = 500
+LDAP_TIMEOUT = 30
 
 
 class DSException(Exception):
@@ -31,6 +62,312 @@ class DSException(Exception):
   pass
 
 
+class _DSCLExited(DSException):
+  """dscl exited while a DSSession was waiting for it."""
+  pass
+
+
+class DSSession(object):
+  """One dscl process in interactive mode, taking commands over stdin.
+
+  dscl runs on a pty, so that it prints its prompt and flushes its output
+  after every command; the prompt marks the end of each response. Output and
+  errors arrive together, and a "DS Error" line in a response is taken as the
+  command failing. The process is started on first use, and started again if
+  it has died by the time the next command is sent. A read (-read, -readall,
+  -list or -search) during which dscl exits is sent once more to a new
+  process; other commands may have changed the directory before dscl died,
+  so they are not sent again and fail instead. Commands from several threads
+  are run one at a time.
+  """
+
+  _DS_ERROR_RE = re.compile(r'DS Error: (-?\d+)')
+  _REPLAYABLE = ('-read', '-readall', '-list', '-search')
+
+  def __init__(self, node='.', plist=False):
+    """Initializes the session.
+
+    Args:
+      node: the node to run commands against
+      plist: whether dscl should answer in plist form
+    """
+    self.node = node
+    self.plist = plist
+    self._lock = threading.Lock()
+    self._process = None
+    self._fd = None
+    self._prompt = None
+
+  def _Start(self):
+    """Starts dscl and waits for its first prompt."""
+    self.Close()
+    cmd = [_DSCL]
+    if self.plist:
+      cmd.append('-plist')
+    cmd.append(self.node)
+    master, slave = pty.openpty()
+    attributes = termios.tcgetattr(slave)
+    attributes[1] &= ~termios.OPOST  # no \r\n line endings
+    attributes[3] &= ~termios.ECHO  # don't repeat our commands back
+    termios.tcsetattr(slave, termios.TCSANOW, attributes)
+    try:
+      self._process = subprocess.Popen(cmd, stdin=slave, stdout=slave,
+                                       stderr=slave, close_fds=True)
+    except OSError, e:
+      os.close(master)
+      raise DSException('Cannot start %s: %s' % (cmd, e))
+    finally:
+      os.close(slave)
+    self._fd = master
+    self._prompt = None
+    self._ReadResponse()
+
+  def _ReadResponse(self):
+    """Reads output up to the next prompt.
+
+    The first prompt, which dscl prints before reading any command, is the
+    last line of the output so far once it ends with "> ".
+
+    Returns:
+      str, the output before the prompt
+    Raises:
+      DSException: dscl exited or did not answer in DSSESSION_TIMEOUT
+    """
+    output = ''
+    while True:
+      if self._prompt is None:
+        if output.endswith('> '):
+          self._prompt = output.rsplit('\n', 1)[-1]
+          return output[:-len(self._prompt)]
+      elif output == self._prompt or output.endswith('\n' + self._prompt):
+        return output[:-len(self._prompt)]
+      ready, _, _ = select.select([self._fd], [], [], DSSESSION_TIMEOUT)
+      if not ready:
+        self.Close()
+        raise DSException('dscl did not answer within %d seconds' %
+                          DSSESSION_TIMEOUT)
+      try:
+        data = os.read(self._fd, 65536)
+      except OSError:
+        data = ''
+      if not data:
+        self.Close()
+        raise _DSCLExited('dscl exited: %s' % output)
+      output += data
+
+  @staticmethod
+  def _Quote(arg):
+    if arg and not re.search(r'[\s"\\\']', arg):
+      return arg
+    return '"%s"' % arg.replace('\\', '\\\\').replace('"', '\\"')
+
+  def Run(self, args):
+    """Runs one dscl command in the session.
+
+    Args:
+      args: list, the command and its arguments, e.g. ['-read', '/Users/foo']
+    Returns:
+      (stdout, stderr, returncode) like gmacpyutil.RunProcess
+    Raises:
+      DSException: dscl could not be started, exited while running the
+                   command (twice, for a read) or did not answer
+    """
+    if [arg for arg in args if '\n' in arg]:
+      raise DSException('Cannot send multi-line arguments to dscl: %s' % args)
+    line = ' '.join(self._Quote(arg) for arg in args) + '\n'
+    attempts = 2 if args and args[0] in self._REPLAYABLE else 1
+    with self._lock:
+      while True:
+        attempts -= 1
+        if self._process is None or self._process.poll() is not None:
+          self._Start()
+        try:
+          try:
+            os.write(self._fd, line)
+          except OSError, e:
+            self.Close()
+            raise _DSCLExited('dscl exited: %s' % e)
+          output = self._ReadResponse()
+          break
+        except _DSCLExited:
+          if not attempts:
+            raise
+    match = self._DS_ERROR_RE.search(output)
+    if match:
+      return '', output, abs(int(match.group(1))) or 1
+    return output, '', 0
+
+  def Close(self):
+    """Stops the dscl process, if there is one."""
+    if self._fd is not None:
+      os.close(self._fd)
+      self._fd = None
+    if self._process is not None:
+      if self._process.poll() is None:
+        self._process.kill()
+      self._process.wait()
+      self._process = None
+
+
+# (node, plist) to DSSession while sessions are in use, see Sessions().
+_sessions = None
+_sessions_users = 0
+_sessions_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def Sessions():
+  """Runs the dscl commands of this module through shared DSSessions.
+
+  Inside the block, DSQuery, DSSearch, DSList, DSSet, DSAppend and DSDelete
+  share one dscl process per node instead of starting one each. Blocks may
+  be nested, and the processes are stopped when the outermost one ends.
+  """
+  global _sessions, _sessions_users
+  with _sessions_lock:
+    if _sessions is None:
+      _sessions = {}
+    _sessions_users += 1
+  try:
+    yield
+  finally:
+    with _sessions_lock:
+      _sessions_users -= 1
+      if not _sessions_users:
+        for session in _sessions.values():
+          session.Close()
+        _sessions = None
+
+
+def _RunDscl(node, args, plist=False):
+  """Runs dscl, through a DSSession inside a Sessions() block.
+
+  Without a session, dscl is started with no other file descriptors, as
+  GroupResolver runs lookups from several threads at once and a dscl which
+  inherited another thread's pipes could hold them open.
+
+  Args:
+    node: the node to run the command against
+    args: list, the command and its arguments
+    plist: whether to ask for plist output
+  Returns:
+    (stdout, stderr, returncode)
+  """
+  with _sessions_lock:
+    session = None
+    if _sessions is not None and not [arg for arg in args if '\n' in arg]:
+      session = _sessions.get((node, plist))
+      if session is None:
+        session = _sessions[(node, plist)] = DSSession(node, plist=plist)
+  if session is not None:
+    try:
+      return session.Run(args)
+    except DSException, e:
+      return '', str(e), 1
+  cmd = [_DSCL]
+  if plist:
+    cmd.append('-plist')
+  cmd.append(node)
+  return gmacpyutil.RunProcess(cmd + args, close_fds=True)
+
+
+class RecordCache(object):
+  """In-process cache of directory records.
+
+  The first lookup of a record type on a node reads every record of that type
+  with one dscl -readall, and later lookups are dictionary reads until the
+  node's TTL runs out. Records are found by any of their RecordNames. Only
+  nodes with a TTL in ttls are cached; DSSet, DSAppend, DSDelete and
+  EditLocalGroup invalidate what they change, but changes made by other
+  processes are not seen until the TTL runs out. Not used unless installed as
+  the module's record_cache.
+  """
+
+  def __init__(self, ttls=None):
+    """Initializes the cache.
+
+    Args:
+      ttls: dict of node to seconds its records are kept, defaults to
+            RECORD_CACHE_TTLS
+    """
+    if ttls is None:
+      ttls = RECORD_CACHE_TTLS
+    self.ttls = dict(ttls)
+    self._lock = threading.Lock()
+    # (node, dstype) to (time loaded, {record name: record})
+    self._records = {}
+
+  def _Load(self, dstype, node):
+    """Reads all records of a type from a node.
+
+    Returns:
+      dict of record name to record
+    Raises:
+      DSException: Cannot read the records.
+    """
+    ds_path = '/%ss' % dstype.capitalize()
+    (stdout, stderr, returncode) = _RunDscl(node, ['-readall', ds_path],
+                                            plist=True)
+    if returncode:
+      raise DSException('Cannot read %s: %s' % (ds_path, stderr))
+    records = {}
+    for record in NSString.stringWithString_(stdout).propertyList() or []:
+      for name in record.get('dsAttrTypeStandard:RecordName') or []:
+        records.setdefault(name, record)
+    return records
+
+  def Records(self, dstype, node='.'):
+    """Returns the records of a type on a node, reading them if needed.
+
+    Args:
+      dstype: The type of records. user, group.
+      node: the node to read.
+    Returns:
+      dict of record name to record, or None if the node is not cached.
+    Raises:
+      DSException: Cannot read the records.
+    """
+    ttl = self.ttls.get(node)
+    if not ttl:
+      return None
+    key = (node, dstype.lower())
+    with self._lock:
+      loaded = self._records.get(key)
+      if loaded and time.time() - loaded[0] < ttl:
+        return loaded[1]
+      records = self._Load(dstype, node)
+      self._records[key] = (time.time(), records)
+      return records
+
+  def Record(self, dstype, objectname, node='.'):
+    """Returns a cached record, or None if it is not in the cache."""
+    try:
+      records = self.Records(dstype, node=node)
+    except DSException:
+      return None
+    if records:
+      return records.get(objectname)
+    return None
+
+  def Invalidate(self, dstype=None, node='.'):
+    """Forgets cached records of a type, or of all types, on a node."""
+    with self._lock:
+      for key in self._records.keys():
+        if key[0] == node and dstype in (None, key[1]):
+          del self._records[key]
+
+
+# The cache DSQuery uses. None, the default, always runs dscl; set it to a
+# RecordCache() to serve repeated lookups from memory, at the cost of missing
+# changes made by other processes for up to the node's TTL.
+record_cache = None
+
+
+def _InvalidateRecords(dstype, node='.'):
+  if record_cache is not None:
+    record_cache.Invalidate(dstype.lower(), node=node)
+
+
 def FlushCache():
   """Flushes the DirectoryService cache."""
   command = [_DSCACHEUTIL, '-flushcache']
@@ -48,8 +385,8 @@ def _GetCSPSearchPathForPath(path):
     DSException: Unable to retrieve search nodes in path.
   """
 
-  command = [_DSCL, '-plist', path, '-read', '/', 'CSPSearchPath']
-  (stdout, stderr, unused_returncode) = gmacpyutil.RunProcess(command)
+  (stdout, stderr, unused_returncode) = _RunDscl(
+      path, ['-read', '/', 'CSPSearchPath'], plist=True)
   result = plistlib.readPlistFromString(stdout)
   if 'dsAttrTypeStandard:CSPSearchPath' in result:
     search_nodes = result['dsAttrTypeStandard:CSPSearchPath']
@@ -63,7 +400,7 @@ def _ModifyCSPSearchPathForPath(action, node, path):
 
   Args:
     action: one of (["append", "delete"]) only.
-    node: the node to append or delete.
+    node: the node, or list of nodes, to append or delete.
     path: the DS path to modify.
   Returns:
     True on success
@@ -71,8 +408,12 @@ def _ModifyCSPSearchPathForPath(action, node, path):
     DSException: Could not modify nodes for path.
   """
 
-  command = [_DSCL, path, '-%s' % action, '/', 'CSPSearchPath', node]
-  (unused_stdout, stderr, returncode) = gmacpyutil.RunProcess(command)
+  if isinstance(node, list):
+    nodes = node
+  else:
+    nodes = [node]
+  (unused_stdout, stderr, returncode) = _RunDscl(
+      path, ['-%s' % action, '/', 'CSPSearchPath'] + nodes)
   if returncode:
     raise DSException('Unable to perform %s on CSPSearchPath '
                       'for node: %s on path: %s '
@@ -110,6 +451,56 @@ def DeleteNodeFromContactsPath(node):
   _ModifyCSPSearchPathForPath('delete', node, '/Search/Contacts')
 
 
+def _SearchPathChanges(current, desired):
+  """Works out how to turn one search path into another.
+
+  dscl can only append to a search path, so the nodes at the start of the
+  desired path which already appear in that order are kept, every other node
+  is deleted, and the rest of the desired path is appended.
+
+  Args:
+    current: list of the nodes in the search path now
+    desired: list of the nodes the search path should have, in order
+  Returns:
+    (delete, append): lists of the nodes to delete, then to append
+  """
+  kept = 0
+  for node in current:
+    if kept < len(desired) and node == desired[kept]:
+      kept += 1
+  delete = [node for node in current if node not in desired[:kept]]
+  return delete, desired[kept:]
+
+
+def SetSearchPath(path, desired_nodes):
+  """Makes a search path hold exactly the given nodes, in order.
+
+  The search path is read once, all deletions and all appends are each made
+  with one dscl command, and the DirectoryService cache is flushed once if
+  anything changed.
+
+  Args:
+    path: One of '/Search' or '/Search/Contacts' only.
+    desired_nodes: list of the nodes the search path should have, in order,
+                   including built-in nodes such as /Local/Default.
+  Returns:
+    True if the search path was changed, False if it was already as desired
+  Raises:
+    DSException: Unable to read or modify the search path.
+  """
+  with Sessions():
+    delete, append = _SearchPathChanges(_GetCSPSearchPathForPath(path),
+                                        list(desired_nodes))
+    if delete:
+      _ModifyCSPSearchPathForPath('delete', delete, path)
+    if append:
+      _ModifyCSPSearchPathForPath('append', append, path)
+  if delete or append:
+    FlushCache()
+    return True
+  return False
+
+
 def EnsureSearchNodePresent(node):
   """Ensures a given DS node is present in the /Search path."""
   if node not in GetSearchNodes():
@@ -144,20 +535,30 @@ def DSQuery(dstype, objectname, attribute=None, node='.'):
     node: the node to query.
   Returns:
     If an attribute is specified, the value of the attribute. Otherwise, the
-    entire plist.
+    entire plist. When record_cache is set, this may be up to the node's TTL
+    old, and miss changes made outside this process in that time.
   Raises:
     DSException: Cannot query DirectoryServices.
   """
-  ds_path = '/%ss/%s' % (dstype.capitalize(), objectname)
-  cmd = [_DSCL, '-plist', node, '-read', ds_path]
-  if attribute:
-    cmd.append(attribute)
-  (stdout, stderr, returncode) = gmacpyutil.RunProcess(cmd)
-  if returncode:
-    raise DSException('Cannot query %s for %s: %s' % (ds_path,
-                                                      attribute,
-                                                      stderr))
-  plist = NSString.stringWithString_(stdout).propertyList()
+  plist = None
+  if record_cache is not None:
+    plist = record_cache.Record(dstype, objectname, node=node)
+    if (plist is not None and attribute and
+        'dsAttrTypeStandard:%s' % attribute not in plist and
+        attribute not in plist):
+      # Let dscl answer, or fail, just as it would without the cache.
+      plist = None
+  if plist is None:
+    ds_path = '/%ss/%s' % (dstype.capitalize(), objectname)
+    args = ['-read', ds_path]
+    if attribute:
+      args.append(attribute)
+    (stdout, stderr, returncode) = _RunDscl(node, args, plist=True)
+    if returncode:
+      raise DSException('Cannot query %s for %s: %s' % (ds_path,
+                                                        attribute,
+                                                        stderr))
+    plist = NSString.stringWithString_(stdout).propertyList()
   if attribute:
     value = None
     if 'dsAttrTypeStandard:%s' % attribute in plist:
@@ -175,8 +576,7 @@ def DSQuery(dstype, objectname, attribute=None, node='.'):
 
 
 def DSSearch(path, key, value, node='.'):
-  cmd = [_DSCL, node, '-search', path, key, value]
-  (stdout, stderr, returncode) = gmacpyutil.RunProcess(cmd)
+  (stdout, stderr, returncode) = _RunDscl(node, ['-search', path, key, value])
   if returncode:
     raise DSException('Cannot search %s for %s:%s. %s' % (path,
                                                           key,
@@ -201,8 +601,7 @@ def DSList(dstype, objectname=None):
   ds_path = '/%ss' % dstype.capitalize()
   if objectname:
     ds_path = ds_path + '/' + objectname
-  cmd = [_DSCL, '.', '-list', ds_path]
-  stdout, stderr, rc = gmacpyutil.RunProcess(cmd)
+  stdout, stderr, rc = _RunDscl('.', ['-list', ds_path])
   if rc:
     raise DSException('Cannot list %s: %s' % (ds_path, stderr))
   if stdout:
@@ -233,15 +632,16 @@ def DSSet(dstype, objectname, attribute=None, value=None):
     DSException: Cannot modify DirectoryServices.
   """
   ds_path = '/%ss/%s' % (dstype.capitalize(), objectname)
-  cmd = [_DSCL, '.', '-create', ds_path]
+  args = ['-create', ds_path]
   if attribute:
-    cmd.append(attribute)
+    args.append(attribute)
     if value:
       if type(value) == type(list()):
-        cmd.extend(value)
+        args.extend(value)
       else:
-        cmd.append(value)
-  (unused_stdout, stderr, returncode) = gmacpyutil.RunProcess(cmd)
+        args.append(value)
+  (unused_stdout, stderr, returncode) = _RunDscl('.', args)
+  _InvalidateRecords(dstype)
   if returncode:
     raise DSException('Cannot set %s for %s: %s' % (attribute,
                                                     ds_path,
@@ -263,12 +663,13 @@ def DSAppend(dstype, objectname, attribute, value):
     DSException: Cannot modify DirectoryServices.
   """
   ds_path = '/%ss/%s' % (dstype.capitalize(), objectname)
-  cmd = [_DSCL, '.', '-append', ds_path, attribute]
+  args = ['-append', ds_path, attribute]
   if type(value) == type(list()):
-    cmd.extend(value)
+    args.extend(value)
   else:
-    cmd.append(value)
-  (unused_stdout, stderr, returncode) = gmacpyutil.RunProcess(cmd)
+    args.append(value)
+  (unused_stdout, stderr, returncode) = _RunDscl('.', args)
+  _InvalidateRecords(dstype)
   if returncode:
     raise DSException('Cannot append %s for %s: %s' % (attribute,
                                                        ds_path,
@@ -282,17 +683,21 @@ def DSDelete(dstype, objectname, attribute=None, value=None):
     dstype: The type of objects to delete. user, group.
     objectname: the object to delete.
     attribute: the attribute to delete.
-    value: the value to delete
+    value: the value to delete, only handles strings and simple lists
   Raises:
     DSException: Cannot modify DirectoryServices.
   """
   ds_path = '/%ss/%s' % (dstype.capitalize(), objectname)
-  cmd = [_DSCL, '.', '-delete', ds_path]
+  args = ['-delete', ds_path]
   if attribute:
-    cmd.append(attribute)
+    args.append(attribute)
     if value:
-      cmd.extend([value])
-  (unused_stdout, stderr, returncode) = gmacpyutil.RunProcess(cmd)
+      if type(value) == type(list()):
+        args.extend(value)
+      else:
+        args.append(value)
+  (unused_stdout, stderr, returncode) = _RunDscl('.', args)
+  _InvalidateRecords(dstype)
   if returncode:
     raise DSException('Cannot delete %s for %s: %s' % (attribute,
                                                        ds_path,
@@ -346,6 +751,7 @@ def EditLocalGroup(action, recordtype, account, group):
   cmd = [_DSEDITGROUP, '-o', 'edit', '-n', '.',
          operation, account, '-t', recordtype, group]
   (stdout, stderr, rc) = gmacpyutil.RunProcess(cmd)
+  _InvalidateRecords('group')
   if rc is not 0:
     raise DSException('Error modifying group %s with %s %s -t %s,'
                       'returned %s\n%s' %
@@ -408,6 +814,92 @@ def RemoveGroupFromLocalGroup(delgroup, group):
   EditLocalGroup('delete', 'group', delgroup, group)
 
 
+def _GeneratedUID(dstype, name):
+  """Returns the GeneratedUID of a local record, or None if there is none."""
+  try:
+    uuids = DSQuery(dstype, name, attribute='GeneratedUID')
+  except DSException:
+    return None
+  if uuids:
+    return uuids[0]
+  return None
+
+
+def EditLocalGroupMembers(group, add_users=(), remove_users=(), add_groups=(),
+                          remove_groups=()):
+  """Edits the members of a local group in one batch.
+
+  The group's current members are read once and only the differences are
+  applied: each of GroupMembership, GroupMembers and NestedGroups gets at most
+  one dscl delete and one dscl append, all in one DSSession, where
+  EditLocalGroup would run dseditgroup once per account.
+
+  Args:
+    group: local group to modify
+    add_users: users that should be members
+    remove_users: users that should not be members
+    add_groups: groups that should be nested in the group
+    remove_groups: groups that should not be nested in the group
+  Returns:
+    True if the group was changed, False if it was already as asked
+  Raises:
+    DSException: an account is both added and removed, an account to add
+                 does not exist, or the group can't be read or modified
+  """
+  for added, removed in ((add_users, remove_users),
+                         (add_groups, remove_groups)):
+    both = set(added) & set(removed)
+    if both:
+      raise DSException('Cannot both add and remove %s' %
+                        ', '.join(sorted(both)))
+
+  with Sessions():
+    membership = GroupAttribute(group, 'GroupMembership') or []
+    members = GroupAttribute(group, 'GroupMembers') or []
+    nested = GroupAttribute(group, 'NestedGroups') or []
+
+    def UUIDs(dstype, names, required):
+      uuids = []
+      for name in names:
+        uuid = _GeneratedUID(dstype, name)
+        if uuid:
+          uuids.append(uuid)
+        elif required:
+          raise DSException('Cannot add %s %s to %s: no such %s' %
+                            (dstype, name, group, dstype))
+      return uuids
+
+    changes = [
+        ('delete', 'GroupMembership',
+         [user for user in remove_users if user in membership]),
+        ('delete', 'GroupMembers',
+         [uuid for uuid in UUIDs('user', remove_users, False)
+          if uuid in members]),
+        ('delete', 'NestedGroups',
+         [uuid for uuid in UUIDs('group', remove_groups, False)
+          if uuid in nested]),
+        ('append', 'GroupMembership',
+         [user for user in add_users if user not in membership]),
+        ('append', 'GroupMembers',
+         [uuid for uuid in UUIDs('user', add_users, True)
+          if uuid not in members]),
+        ('append', 'NestedGroups',
+         [uuid for uuid in UUIDs('group', add_groups, True)
+          if uuid not in nested])]
+    changes = [(action, attribute, sorted(set(values), key=values.index))
+               for action, attribute, values in changes if values]
+    for action, attribute, values in changes:
+      if action == 'delete':
+        DSDelete('group', group, attribute, values)
+      else:
+        DSAppend('group', group, attribute, values)
+
+  if changes:
+    FlushCache()
+    return True
+  return False
+
+
 def CreateShadowAccount(username, shadow_name):
   """Creates a shadow user account."""
   shadow_account = {'PrimaryGID': '80', 'UniqueID': '497',
@@ -415,10 +907,11 @@ def CreateShadowAccount(username, shadow_name):
                     'AuthenticationAuthority': ';ShadowHash;',
                     'NFSHomeDirectory': '/var/empty', 'UserShell': '/bin/bash'}
 
-  DSSet('user', shadow_name)
+  with Sessions():
+    DSSet('user', shadow_name)
 
-  for key in shadow_account:
-    DSSet('user', shadow_name, key, shadow_account[key])
+    for key in shadow_account:
+      DSSet('user', shadow_name, key, shadow_account[key])
 
   AddUserToLocalGroup(shadow_name, 'admin')
   AddUserToLocalGroup(shadow_name, '_appserveradm')
@@ -447,36 +940,369 @@ def SyncShadowHash(username, shadow_name):
                       '%s-admin: %s' % (username, err))
 
 
-def _GetNameFromGroupUID(groupuid, ldap_server=None):
-  """Get a human readable name from a groupuid, try ldap_server if provided.
+def _EscapeLDAPFilter(value):
+  """Escapes a value for use in an LDAP search filter (RFC 4515)."""
+  for char in ('\\', '*', '(', ')', '\x00'):
+    value = value.replace(char, '\\%02x' % ord(char))
+  return value
 
-  Try resolving the uid locally, then with ldap if a server is specified.
+
+class LDAPResolver(object):
+  """Resolves groups on an LDAP server over pooled, persistent connections.
+
+  This talks to the server directly with python-ldap rather than through
+  dscl, keeping up to pool_size connections bound and open between lookups,
+  and uses paged searches so large results come back a page at a time. The
+  attribute names are those of an Open Directory server and can be changed
+  in a subclass for other schemas.
+  """
+
+  GROUP_FILTER = '(objectClass=posixGroup)'
+  NAME_ATTRIBUTE = 'cn'
+  UUID_ATTRIBUTE = 'apple-generateduid'
+  MEMBERS_ATTRIBUTE = 'memberUid'
+  NESTED_ATTRIBUTE = 'apple-group-nestedgroup'
+
+  def __init__(self, server, base_dn=None, bind_dn=None, bind_password=None,
+               pool_size=LDAP_POOL_SIZE, page_size=LDAP_PAGE_SIZE,
+               timeout=LDAP_TIMEOUT):
+    """Initializes the resolver.
+
+    Args:
+      server: str, LDAP server name, or an ldap:// or ldaps:// URI
+      base_dn: str, base of the searches; the server's default naming
+               context if not given
+      bind_dn: str, DN to bind as; anonymous if not given
+      bind_password: str, password for bind_dn
+      pool_size: number of connections to keep open
+      page_size: number of entries per page of a search
+      timeout: seconds to wait for the server
+    Raises:
+      DSException: python-ldap is not available
+    """
+    if ldap is None:
+      raise DSException('python-ldap is not available')
+    if '://' in server:
+      self.uri = server
+    else:
+      self.uri = 'ldap://%s' % server
+    self.base_dn = base_dn
+    self.bind_dn = bind_dn
+    self.bind_password = bind_password
+    self.page_size = page_size
+    self.timeout = timeout
+    self._idle = Queue.Queue()
+    # Limits the connections open at once, idle or in use.
+    self._slots = threading.Semaphore(pool_size)
+
+  def _Connect(self):
+    """Opens and binds a new connection."""
+    conn = ldap.initialize(self.uri)
+    conn.set_option(ldap.OPT_REFERRALS, 0)
+    conn.set_option(ldap.OPT_NETWORK_TIMEOUT, self.timeout)
+    conn.simple_bind_s(self.bind_dn or '', self.bind_password or '')
+    return conn
+
+  @contextlib.contextmanager
+  def _Connection(self):
+    """Lends a connection from the pool, opening one if none is idle.
+
+    A connection which raises an LDAP error is closed rather than returned to
+    the pool.
+    """
+    self._slots.acquire()
+    conn = None
+    try:
+      try:
+        conn = self._idle.get_nowait()
+      except Queue.Empty:
+        conn = self._Connect()
+      yield conn
+      self._idle.put(conn)
+      conn = None
+    finally:
+      if conn is not None:
+        try:
+          conn.unbind_s()
+        except ldap.LDAPError:
+          pass
+      self._slots.release()
+
+  def _PagedSearch(self, conn, base_dn, filterstr, attributes):
+    """Runs a paged subtree search on a connection.
+
+    Returns:
+      list of the attribute dictionaries of the entries found
+    """
+    page = ldap.controls.SimplePagedResultsControl(
+        True, size=self.page_size, cookie='')
+    results = []
+    while True:
+      msgid = conn.search_ext(base_dn, ldap.SCOPE_SUBTREE, filterstr,
+                              attributes, serverctrls=[page])
+      _, entries, _, controls = conn.result3(msgid, timeout=self.timeout)
+      # Entries without a DN are referrals.
+      results.extend(entry for dn, entry in entries if dn)
+      cookies = [control.cookie for control in controls or []
+                 if control.controlType == page.controlType]
+      if not cookies or not cookies[0]:
+        return results
+      page.cookie = cookies[0]
+
+  def _BaseDN(self, conn):
+    """Returns base_dn, reading the server's naming context if needed."""
+    if self.base_dn is None:
+      entries = conn.search_st('', ldap.SCOPE_BASE, '(objectClass=*)',
+                               ['defaultNamingContext', 'namingContexts'],
+                               timeout=self.timeout)
+      for _, entry in entries:
+        contexts = (entry.get('defaultNamingContext') or
+                    entry.get('namingContexts') or [])
+        if contexts:
+          self.base_dn = contexts[0]
+          break
+      else:
+        raise DSException('Cannot find the naming context of %s' % self.uri)
+    return self.base_dn
+
+  def Search(self, filterstr, attributes):
+    """Searches the server, reconnecting once if the connection went away.
+
+    Args:
+      filterstr: str, LDAP search filter
+      attributes: list of attribute names to return
+    Returns:
+      list of the attribute dictionaries of the entries found
+    Raises:
+      DSException: the search failed
+    """
+    for attempt in range(2):
+      try:
+        with self._Connection() as conn:
+          return self._PagedSearch(conn, self._BaseDN(conn), filterstr,
+                                   attributes)
+      except ldap.SERVER_DOWN, e:
+        if attempt:
+          raise DSException('Cannot reach %s: %s' % (self.uri, e))
+      except ldap.LDAPError, e:
+        raise DSException('Cannot search %s for %s: %s' % (self.uri,
+                                                           filterstr, e))
+
+  def _Group(self, attribute, value, attributes):
+    entries = self.Search('(&%s(%s=%s))' % (self.GROUP_FILTER, attribute,
+                                            _EscapeLDAPFilter(value)),
+                          attributes)
+    if entries:
+      return entries[0]
+    return None
+
+  def GroupName(self, groupuid):
+    """Returns the name of the group with a GeneratedUID, or None."""
+    entry = self._Group(self.UUID_ATTRIBUTE, groupuid, [self.NAME_ATTRIBUTE])
+    if entry and entry.get(self.NAME_ATTRIBUTE):
+      return entry[self.NAME_ATTRIBUTE][0]
+    return None
+
+  def GroupMembership(self, groupname):
+    """Returns (GroupMembership, NestedGroups) of a group.
+
+    Raises:
+      DSException: the group does not exist or the search failed
+    """
+    entry = self._Group(self.NAME_ATTRIBUTE, groupname,
+                        [self.MEMBERS_ATTRIBUTE, self.NESTED_ATTRIBUTE])
+    if entry is None:
+      raise DSException('No group %s on %s' % (groupname, self.uri))
+    return (entry.get(self.MEMBERS_ATTRIBUTE, []),
+            entry.get(self.NESTED_ATTRIBUTE, []))
+
+  def Close(self):
+    """Closes the idle connections."""
+    while True:
+      try:
+        conn = self._idle.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        conn.unbind_s()
+      except ldap.LDAPError:
+        pass
+
+
+# LDAP server to the LDAPResolver nested group lookups use for it.
+_ldap_resolvers = {}
+_ldap_resolvers_lock = threading.Lock()
+
+
+def _LDAPResolverFor(ldap_server):
+  """Returns the shared LDAPResolver for a server, or None if not in use."""
+  if ldap is None or not USE_LDAP_RESOLVER:
+    return None
+  with _ldap_resolvers_lock:
+    if ldap_server not in _ldap_resolvers:
+      _ldap_resolvers[ldap_server] = LDAPResolver(ldap_server)
+    return _ldap_resolvers[ldap_server]
+
+
+# GeneratedUID to (name, node) of every group resolved so far.
+_group_names = {}
+_group_names_lock = threading.Lock()
+
+
+def _ResolveGroupUID(groupuid, ldap_server=None):
+  """Finds a group by UUID, locally and then with ldap if a server is given.
+
+  Groups which are found are remembered for the life of the process. With
+  USE_LDAP_RESOLVER set and python-ldap available, the LDAP server is asked
+  directly first, and dscl is used if that fails or finds nothing.
 
   Args:
     groupuid: UID to resolve
     ldap_server: use ldap_server if defined
   Returns:
-    human-readable name or None if it couldn't be resolved
+    (name, node) of the group, or (None, None) if it couldn't be resolved
   """
-  name = None
+  with _group_names_lock:
+    if groupuid in _group_names:
+      return _group_names[groupuid]
+  name = node = None
   try:
     name = DSGetRecordNameFromUUID('group', groupuid)
+    node = '.'
     if not name and ldap_server:
-      name = DSGetRecordNameFromUUID('group',
-                                     groupuid,
-                                     node='/LDAPv3/%s' % ldap_server)
+      node = '/LDAPv3/%s' % ldap_server
+      resolver = _LDAPResolverFor(ldap_server)
+      if resolver is not None:
+        try:
+          name = resolver.GroupName(groupuid)
+        except DSException:
+          name = None
+      if not name:
+        name = DSGetRecordNameFromUUID('group', groupuid, node=node)
   except DSException:
-    pass
-  return name
+    name = None
+  if not name:
+    return None, None
+  with _group_names_lock:
+    _group_names[groupuid] = (name, node)
+  return name, node
+
+
+def _GetNameFromGroupUID(groupuid, ldap_server=None):
+  """Get a human readable name from a groupuid, try ldap_server if provided.
+
+  Try resolving the uid locally, then with ldap if a server is specified.
 
+  Args:
+    groupuid: UID to resolve
+    ldap_server: use ldap_server if defined
+  Returns:
+    human-readable name or None if it couldn't be resolved
+  """
+  return _ResolveGroupUID(groupuid, ldap_server=ldap_server)[0]
 
-def GetGroupMembership(groupname, ldap_server=None):
+
+class GroupResolver(object):
+  """Resolves and expands nested groups, GROUP_RESOLVER_THREADS at a time."""
+
+  def __init__(self, ldap_server=None, threads=GROUP_RESOLVER_THREADS):
+    """Initializes the resolver.
+
+    Args:
+      ldap_server: LDAP server to look up groups which aren't local
+      threads: number of lookups to run at once
+    """
+    self.ldap_server = ldap_server
+    self.threads = threads
+
+  def _Map(self, function, items):
+    if len(items) < 2:
+      return map(function, items)
+    pool = thread_pool.ThreadPool(min(len(items), self.threads))
+    try:
+      return pool.map(function, items)
+    finally:
+      pool.terminate()
+
+  def Names(self, groupuids):
+    """Returns the names of groups, or their UUID where unresolved."""
+    names = self._Map(
+        lambda groupuid: _GetNameFromGroupUID(groupuid,
+                                              ldap_server=self.ldap_server),
+        groupuids)
+    return [name or groupuid for name, groupuid in zip(names, groupuids)]
+
+  def _Resolve(self, groupuid):
+    return _ResolveGroupUID(groupuid, ldap_server=self.ldap_server)
+
+  def _Contents(self, group):
+    """Returns (GroupMembership, NestedGroups) of a (name, node) group."""
+    name, node = group
+    resolver = None
+    if node.startswith('/LDAPv3/'):
+      resolver = _LDAPResolverFor(node[len('/LDAPv3/'):])
+    if resolver is not None:
+      try:
+        return resolver.GroupMembership(name)
+      except DSException:
+        pass
+    contents = []
+    for attribute in ('GroupMembership', 'NestedGroups'):
+      try:
+        contents.append(DSQuery('group', name, attribute=attribute,
+                                node=node) or [])
+      except DSException:
+        contents.append([])
+    return contents
+
+  def Expand(self, membership, groupuids):
+    """Expands nested groups recursively.
+
+    Each level of nesting is resolved concurrently; groups seen before, such
+    as those in a cycle, are only expanded once.
+
+    Args:
+      membership: list of the direct members of the group
+      groupuids: list of the UUIDs of the group's direct nested groups
+    Returns:
+      (membership, groups)
+      membership: the members of the group and all its nested groups
+      groups: names of all nested groups, or their UUID where unresolved
+    """
+    members = list(membership or [])
+    seen_members = set(members)
+    groups = []
+    seen = set()
+    level = groupuids
+    while level:
+      level = [groupuid for groupuid in sorted(set(level))
+               if groupuid not in seen]
+      seen.update(level)
+      resolved = self._Map(self._Resolve, level)
+      found = []
+      for groupuid, group in zip(level, resolved):
+        groups.append(group[0] or groupuid)
+        if group[0]:
+          found.append(group)
+      level = []
+      for group_members, nested in self._Map(self._Contents, found):
+        for member in group_members:
+          if member not in seen_members:
+            seen_members.add(member)
+            members.append(member)
+        level.extend(nested)
+    return members, groups
+
+
+def GetGroupMembership(groupname, ldap_server=None, recursive=False):
   """Get membership of a group.
 
   Args:
     groupname: name of the group to query
     ldap_server: use this LDAP server to try to convert nested group UUIDs to
                  human-readable form.
+    recursive: whether to expand nested groups all the way down, including
+               their members in membership.
 
   Returns:
     (membership, groups)
@@ -491,14 +1317,11 @@ def GetGroupMembership(groupname, ldap_server=None):
   try:
     nested_groups = DSQuery('group', groupname, attribute='NestedGroups')
     if nested_groups:
-      groups = []
-      for groupuid in nested_groups:
-        groupname = _GetNameFromGroupUID(groupuid,
-                                         ldap_server=ldap_server)
-        if not groupname:
-          groupname = groupuid
-
-        groups.append(groupname)
+      resolver = GroupResolver(ldap_server=ldap_server)
+      if recursive and membership != 'UNKNOWN':
+        membership, groups = resolver.Expand(membership, nested_groups)
+      else:
+        groups = resolver.Names(nested_groups)
     else:
       groups = None
   except DSException:
@@ -515,9 +1338,13 @@ def main():
   parser.add_option('-l', '--ldapserver', dest='ldap_server',
                     help='LDAP server to query for nested groups',
                     default=None)
+  parser.add_option('-r', '--recursive', dest='recursive',
+                    action='store_true', default=False,
+                    help='Expand nested groups recursively')
   (options, unused_args) = parser.parse_args()
   if options.groupname:
-    print GetGroupMembership(options.groupname, ldap_server=options.ldap_server)
+    print GetGroupMembership(options.groupname, ldap_server=options.ldap_server,
+                             recursive=options.recursive)
   else:
     parser.print_help()
 
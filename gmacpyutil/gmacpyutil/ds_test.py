@@ -1,6 +1,11 @@
 """Tests for ds module."""
 
 import os
+import plistlib
+import re
+import shutil
+import sys
+import tempfile
 
 import mox
 import stubout
@@ -15,6 +20,7 @@ class DsTest(mox.MoxTestBase):
   def setUp(self):
     self.mox = mox.Mox()
     self.mox.StubOutWithMock(ds.gmacpyutil, 'RunProcess')
+    ds._group_names.clear()
     if os.uname()[0] == 'Linux':
       self.InitMockFoundation()
     elif os.uname()[0] == 'Darwin':
@@ -38,7 +44,8 @@ class DsTest(mox.MoxTestBase):
     return [ds._DSCL, '.', '-search', self.path, self.key, self.value]
 
   def testDSSearchNotFound(self):
-    ds.gmacpyutil.RunProcess(self._DScmd()).AndReturn((None, None, None))
+    ds.gmacpyutil.RunProcess(self._DScmd(), close_fds=True).AndReturn(
+        (None, None, None))
     ds.NSString.stringWithString_(mox.IgnoreArg()).AndReturn(None)
 
     self.mox.ReplayAll()
@@ -47,7 +54,8 @@ class DsTest(mox.MoxTestBase):
     self.assertEqual(result, None)
 
   def testDSSearchError(self):
-    ds.gmacpyutil.RunProcess(self._DScmd()).AndReturn(('blah', 'someerror', 5))
+    ds.gmacpyutil.RunProcess(self._DScmd(), close_fds=True).AndReturn(
+        ('blah', 'someerror', 5))
 
     self.mox.ReplayAll()
     self.assertRaises(ds.DSException, ds.DSSearch,
@@ -56,8 +64,8 @@ class DsTest(mox.MoxTestBase):
 
   def testDSSearch(self):
     result = 'groupname\t\tblah'
-    ds.gmacpyutil.RunProcess(self._DScmd()).AndReturn((result,
-                                                       None, 0))
+    ds.gmacpyutil.RunProcess(self._DScmd(), close_fds=True).AndReturn(
+        (result, None, 0))
 
     ds.NSString.stringWithString_(result).AndReturn(result)
     self.mox.ReplayAll()
@@ -136,7 +144,6 @@ class DsTest(mox.MoxTestBase):
     members = [u'asdf', u'asdfaaa']
     guids = [u'000-111-aaa', u'121123-aaaa']
     ldap = 'ldap.corp'
-    self.mox.StubOutWithMock(ds, '_GetNameFromGroupUID')
     self.mox.StubOutWithMock(ds, 'DSQuery')
 
     ds.DSQuery('group', groupname,
@@ -144,14 +151,54 @@ class DsTest(mox.MoxTestBase):
     ds.DSQuery('group', groupname,
                attribute='NestedGroups').AndReturn(guids)
 
-    ds._GetNameFromGroupUID(guids[0], ldap_server=ldap).AndReturn(None)
-    ds._GetNameFromGroupUID(guids[1],
-                            ldap_server=ldap).AndReturn('humanreadable')
+    names = {guids[1]: 'humanreadable'}
+    # Nested groups are resolved concurrently, so in no particular order.
+    self.mox.stubs.Set(ds, '_GetNameFromGroupUID',
+                       lambda groupuid, ldap_server: names.get(groupuid))
     self.mox.ReplayAll()
     result = ds.GetGroupMembership(groupname, ldap_server=ldap)
     self.assertEqual(result, (members, [guids[0], 'humanreadable']))
     self.mox.VerifyAll()
 
+  def testResolveGroupUIDRemembered(self):
+    self.mox.StubOutWithMock(ds, 'DSGetRecordNameFromUUID')
+    ds.DSGetRecordNameFromUUID('group', 'uid-1').AndReturn(None)
+    ds.DSGetRecordNameFromUUID('group', 'uid-1',
+                               node='/LDAPv3/ldap.corp').AndReturn('remote')
+    self.mox.ReplayAll()
+    for _ in range(2):
+      self.assertEqual(('remote', '/LDAPv3/ldap.corp'),
+                       ds._ResolveGroupUID('uid-1', ldap_server='ldap.corp'))
+    self.mox.VerifyAll()
+
+  def testGetGroupMembershipRecursive(self):
+    groups = {'top': (['a'], ['uid-1', 'uid-2']),
+              'one': (['b', 'a'], ['uid-3']),
+              'two': (['c'], ['uid-1', 'uid-4']),
+              'three': (['d'], ['uid-2'])}
+    uids = {'uid-1': 'one', 'uid-2': 'two', 'uid-3': 'three'}
+    queries = []
+
+    def DSQuery(unused_dstype, name, attribute=None, node='.'):
+      queries.append((name, node))
+      members, nested = groups[name]
+      return attribute == 'GroupMembership' and members or nested
+
+    def DSGetRecordNameFromUUID(unused_dstype, groupuid, node='.'):
+      if node == '.':
+        return uids.get(groupuid)
+
+    self.mox.stubs.Set(ds, 'DSQuery', DSQuery)
+    self.mox.stubs.Set(ds, 'DSGetRecordNameFromUUID', DSGetRecordNameFromUUID)
+    self.mox.ReplayAll()
+    members, nested = ds.GetGroupMembership('top', ldap_server='ldap.corp',
+                                            recursive=True)
+    self.assertEqual(['a', 'b', 'c', 'd'], sorted(members))
+    self.assertEqual(['one', 'two', 'three', 'uid-4'], nested)
+    # Each group is expanded once even though uid-1 and uid-2 form a cycle.
+    self.assertEqual(8, len(queries))
+    self.mox.VerifyAll()
+
   def testGetGroupMembershipError(self):
     groupname = 'somegroup'
     ldap = 'ldap.corp'
@@ -182,6 +229,202 @@ class DsTest(mox.MoxTestBase):
     self.assertEqual(result, (None, None))
     self.mox.VerifyAll()
 
+  def _ExpectReadAll(self, dstype, records):
+    cmd = [ds._DSCL, '-plist', '.', '-readall', '/%ss' % dstype.capitalize()]
+    ds.gmacpyutil.RunProcess(cmd, close_fds=True).AndReturn(('readall', '', 0))
+    plist = self.mox.CreateMockAnything()
+    ds.NSString.stringWithString_('readall').AndReturn(plist)
+    plist.propertyList().AndReturn(records)
+
+  def testDSQueryCached(self):
+    self.mox.stubs.Set(ds, 'record_cache', ds.RecordCache())
+    self._ExpectReadAll('user', [
+        {'dsAttrTypeStandard:RecordName': ['alice', 'al'],
+         'dsAttrTypeStandard:UniqueID': ['501']},
+        {'dsAttrTypeStandard:RecordName': ['bob'],
+         'dsAttrTypeStandard:UniqueID': ['502']}])
+    self.mox.ReplayAll()
+    self.assertEqual(['501'], ds.DSQuery('user', 'alice', 'UniqueID'))
+    self.assertEqual(['501'], ds.UserAttribute('al', 'UniqueID'))
+    self.assertEqual(['502'], ds.UserAttribute('bob', 'UniqueID'))
+    self.mox.VerifyAll()
+
+  def testDSQueryCachedAttributeMissing(self):
+    self.mox.stubs.Set(ds, 'record_cache', ds.RecordCache())
+    self._ExpectReadAll('user', [
+        {'dsAttrTypeStandard:RecordName': ['bob'],
+         'dsAttrTypeStandard:UniqueID': ['502']}])
+    cmd = [ds._DSCL, '-plist', '.', '-read', '/Users/bob', 'RealName']
+    ds.gmacpyutil.RunProcess(cmd, close_fds=True).AndReturn(
+        ('', 'No such key: RealName', 181))
+    self.mox.ReplayAll()
+    self.assertEqual(['502'], ds.UserAttribute('bob', 'UniqueID'))
+    self.assertRaises(ds.DSException, ds.UserAttribute, 'bob', 'RealName')
+    self.mox.VerifyAll()
+
+  def testDSQueryNotCached(self):
+    self.mox.stubs.Set(ds, 'record_cache', ds.RecordCache())
+    self._ExpectReadAll('group', [])
+    cmd = [ds._DSCL, '-plist', '.', '-read', '/Groups/new', 'PrimaryGroupID']
+    ds.gmacpyutil.RunProcess(cmd, close_fds=True).AndReturn(('read', '', 0))
+    plist = self.mox.CreateMockAnything()
+    ds.NSString.stringWithString_('read').AndReturn(plist)
+    plist.propertyList().AndReturn(
+        {'dsAttrTypeStandard:PrimaryGroupID': ['600']})
+    self.mox.ReplayAll()
+    self.assertEqual(['600'], ds.GroupAttribute('new', 'PrimaryGroupID'))
+    self.mox.VerifyAll()
+
+  def testDSSetInvalidatesCache(self):
+    self.mox.stubs.Set(ds, 'record_cache', ds.RecordCache())
+    name = {'dsAttrTypeStandard:RecordName': ['alice']}
+    self._ExpectReadAll(
+        'user', [dict(name, **{'dsAttrTypeStandard:UserShell': ['/bin/sh']})])
+    ds.gmacpyutil.RunProcess(
+        [ds._DSCL, '.', '-create', '/Users/alice', 'UserShell', '/bin/bash'],
+        close_fds=True).AndReturn(('', '', 0))
+    self._ExpectReadAll(
+        'user', [dict(name, **{'dsAttrTypeStandard:UserShell': ['/bin/bash']})])
+    self.mox.ReplayAll()
+    self.assertEqual(['/bin/sh'], ds.UserAttribute('alice', 'UserShell'))
+    ds.DSSet('user', 'alice', 'UserShell', '/bin/bash')
+    self.assertEqual(['/bin/bash'], ds.UserAttribute('alice', 'UserShell'))
+    self.mox.VerifyAll()
+
+  def testRecordCacheUncachedNode(self):
+    self.mox.ReplayAll()
+    cache = ds.RecordCache()
+    self.assertEqual(None, cache.Records('user', node='/LDAPv3/ldap.corp'))
+    self.mox.VerifyAll()
+
+  def testDSQueryUncachedByDefault(self):
+    self.assertEqual(None, ds.record_cache)
+    cmd = [ds._DSCL, '-plist', '.', '-read', '/Users/alice', 'UniqueID']
+    ds.gmacpyutil.RunProcess(cmd, close_fds=True).AndReturn(('read', '', 0))
+    ds.gmacpyutil.RunProcess(cmd, close_fds=True).AndReturn(('read', '', 0))
+    plist = self.mox.CreateMockAnything()
+    ds.NSString.stringWithString_('read').MultipleTimes().AndReturn(plist)
+    plist.propertyList().MultipleTimes().AndReturn(
+        {'dsAttrTypeStandard:UniqueID': ['501']})
+    self.mox.ReplayAll()
+    self.assertEqual(['501'], ds.UserAttribute('alice', 'UniqueID'))
+    self.assertEqual(['501'], ds.UserAttribute('alice', 'UniqueID'))
+    self.mox.VerifyAll()
+
+  def testSearchPathChanges(self):
+    self.mox.ReplayAll()
+    self.assertEqual(([], []), ds._SearchPathChanges(['a', 'b'], ['a', 'b']))
+    self.assertEqual((['x'], ['c']),
+                     ds._SearchPathChanges(['a', 'x', 'b'], ['a', 'b', 'c']))
+    self.assertEqual((['b'], ['b']), ds._SearchPathChanges(['b', 'a'],
+                                                           ['a', 'b']))
+    self.assertEqual((['a', 'b'], []), ds._SearchPathChanges(['a', 'b'], []))
+    self.mox.VerifyAll()
+
+  def _StubRunDscl(self, search_path):
+    commands = []
+
+    def RunDscl(node, args, plist=False):
+      commands.append((node, args, plist))
+      if args[0] == '-read':
+        return (plistlib.writePlistToString(
+            {'dsAttrTypeStandard:CSPSearchPath': search_path}), '', 0)
+      return '', '', 0
+
+    self.mox.stubs.Set(ds, '_RunDscl', RunDscl)
+    return commands
+
+  def testSetSearchPath(self):
+    commands = self._StubRunDscl(['/Local/Default', '/LDAPv3/old',
+                                  '/Active Directory/CORP'])
+    self.mox.StubOutWithMock(ds, 'FlushCache')
+    ds.FlushCache()
+    self.mox.ReplayAll()
+    self.assertTrue(ds.SetSearchPath(
+        '/Search', ['/Local/Default', '/Active Directory/CORP',
+                    '/LDAPv3/new', '/LDAPv3/other']))
+    self.assertEqual(
+        [('/Search', ['-read', '/', 'CSPSearchPath'], True),
+         ('/Search', ['-delete', '/', 'CSPSearchPath', '/LDAPv3/old'], False),
+         ('/Search', ['-append', '/', 'CSPSearchPath', '/LDAPv3/new',
+                      '/LDAPv3/other'], False)],
+        commands)
+    self.mox.VerifyAll()
+
+  def testSetSearchPathUnchanged(self):
+    commands = self._StubRunDscl(['/Local/Default', '/LDAPv3/ldap'])
+    self.mox.StubOutWithMock(ds, 'FlushCache')
+    self.mox.ReplayAll()
+    self.assertFalse(ds.SetSearchPath('/Search/Contacts',
+                                      ['/Local/Default', '/LDAPv3/ldap']))
+    self.assertEqual(1, len(commands))
+    self.mox.VerifyAll()
+
+  def _StubGroupEdit(self):
+    records = {
+        ('group', 'admin'): {'GroupMembership': ['root', 'alice', 'old'],
+                             'GroupMembers': ['UID-ROOT', 'UID-ALICE',
+                                              'UID-OLD'],
+                             'NestedGroups': ['UID-STAFF']},
+        ('user', 'root'): {'GeneratedUID': ['UID-ROOT']},
+        ('user', 'alice'): {'GeneratedUID': ['UID-ALICE']},
+        ('user', 'old'): {'GeneratedUID': ['UID-OLD']},
+        ('user', 'bob'): {'GeneratedUID': ['UID-BOB']},
+        ('user', 'carol'): {'GeneratedUID': ['UID-CAROL']},
+        ('group', 'staff'): {'GeneratedUID': ['UID-STAFF']},
+        ('group', 'ops'): {'GeneratedUID': ['UID-OPS']}}
+    edits = []
+
+    def DSQuery(dstype, name, attribute=None, node='.'):
+      self.assertEqual('.', node)
+      if (dstype, name) not in records:
+        raise ds.DSException('no such record')
+      return records[(dstype, name)].get(attribute)
+
+    self.mox.stubs.Set(ds, 'DSQuery', DSQuery)
+    self.mox.stubs.Set(ds, 'DSAppend', lambda *args: edits.append(args))
+    self.mox.stubs.Set(ds, 'DSDelete', lambda *args: edits.append(args))
+    return edits
+
+  def testEditLocalGroupMembers(self):
+    edits = self._StubGroupEdit()
+    self.mox.StubOutWithMock(ds, 'FlushCache')
+    ds.FlushCache()
+    self.mox.ReplayAll()
+    self.assertTrue(ds.EditLocalGroupMembers(
+        'admin', add_users=['alice', 'bob', 'carol', 'bob'],
+        remove_users=['old', 'nobody'], add_groups=['ops'],
+        remove_groups=['staff']))
+    self.assertEqual(
+        [('group', 'admin', 'GroupMembership', ['old']),
+         ('group', 'admin', 'GroupMembers', ['UID-OLD']),
+         ('group', 'admin', 'NestedGroups', ['UID-STAFF']),
+         ('group', 'admin', 'GroupMembership', ['bob', 'carol']),
+         ('group', 'admin', 'GroupMembers', ['UID-BOB', 'UID-CAROL']),
+         ('group', 'admin', 'NestedGroups', ['UID-OPS'])],
+        edits)
+    self.mox.VerifyAll()
+
+  def testEditLocalGroupMembersUnchanged(self):
+    edits = self._StubGroupEdit()
+    self.mox.StubOutWithMock(ds, 'FlushCache')
+    self.mox.ReplayAll()
+    self.assertFalse(ds.EditLocalGroupMembers(
+        'admin', add_users=['root'], remove_users=['bob'],
+        add_groups=['staff']))
+    self.assertEqual([], edits)
+    self.mox.VerifyAll()
+
+  def testEditLocalGroupMembersErrors(self):
+    edits = self._StubGroupEdit()
+    self.mox.ReplayAll()
+    self.assertRaises(ds.DSException, ds.EditLocalGroupMembers, 'admin',
+                      add_users=['bob'], remove_users=['bob'])
+    self.assertRaises(ds.DSException, ds.EditLocalGroupMembers, 'admin',
+                      add_users=['bob', 'nobody'])
+    self.assertEqual([], edits)
+    self.mox.VerifyAll()
+
   def testDSList(self):
     dscl_list_output = ('_www\n'
                         '_xcsbuildagent\n'
@@ -192,12 +435,284 @@ class DsTest(mox.MoxTestBase):
                         'puppet\n'
                         'root\n')
     cmd = [ds._DSCL, '.', '-list', '/Users']
-    ds.gmacpyutil.RunProcess(cmd).AndReturn(
+    ds.gmacpyutil.RunProcess(cmd, close_fds=True).AndReturn(
         (dscl_list_output, '', 0))
     self.mox.ReplayAll()
     result = ds.DSList('user')
     self.assertEqual(result, dscl_list_output.rstrip('\n').split('\n'))
     self.mox.VerifyAll()
 
+FAKE_DSCL = """#!%s
+import os
+import shlex
+import sys
+sys.stdout.write('> ')
+sys.stdout.flush()
+for line in iter(sys.stdin.readline, ''):
+  args = shlex.split(line)
+  crashed = os.path.join(os.path.dirname(sys.argv[0]), 'crashed')
+  if args == ['-exit']:
+    sys.exit(0)
+  elif args[1:2] == ['/Users/crash'] and not os.path.exists(crashed):
+    open(crashed, 'w').close()
+    sys.exit(1)
+  elif args[0] == '-pid':
+    sys.stdout.write('%%d\\n' %% os.getpid())
+  elif args[0] == '-fail':
+    sys.stdout.write('<dscl_cmd> DS Error: -14136 (eDSRecordNotFound)\\n')
+  elif args == ['-list', '/Users']:
+    sys.stdout.write('alice\\nbob\\n')
+  else:
+    sys.stdout.write('|'.join(sys.argv[1:] + args) + '\\n')
+  sys.stdout.write('> ')
+  sys.stdout.flush()
+""" % sys.executable
+
+
+class DSSessionTest(mox.MoxTestBase):
+  """Test ds.DSSession against a stand-in for interactive dscl."""
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.tempdir = tempfile.mkdtemp()
+    dscl = os.path.join(self.tempdir, 'dscl')
+    with open(dscl, 'w') as f:
+      f.write(FAKE_DSCL)
+    os.chmod(dscl, 0755)
+    self.stubs.Set(ds, '_DSCL', dscl)
+    self.session = ds.DSSession('.', plist=True)
+
+  def tearDown(self):
+    self.session.Close()
+    mox.MoxTestBase.tearDown(self)
+    shutil.rmtree(self.tempdir)
+
+  def testRun(self):
+    self.assertEqual(('-plist|.|-read|/Users/foo|RealName\n', '', 0),
+                     self.session.Run(['-read', '/Users/foo', 'RealName']))
+    self.assertEqual(
+        ('-plist|.|-create|/Users/foo|RealName|Foo "The" Bar\\\n', '', 0),
+        self.session.Run(['-create', '/Users/foo', 'RealName',
+                          'Foo "The" Bar\\']))
+
+  def testRunError(self):
+    stdout, stderr, returncode = self.session.Run(['-fail'])
+    self.assertEqual('', stdout)
+    self.assertTrue('eDSRecordNotFound' in stderr)
+    self.assertEqual(14136, returncode)
+
+  def testOneProcess(self):
+    pid = self.session.Run(['-pid'])[0]
+    self.assertEqual(pid, self.session.Run(['-pid'])[0])
+
+  def testRestartedAfterExit(self):
+    pid = self.session.Run(['-pid'])[0]
+    self.assertRaises(ds.DSException, self.session.Run, ['-exit'])
+    self.assertNotEqual(pid, self.session.Run(['-pid'])[0])
+
+  def testReadReplayedAfterExit(self):
+    pid = self.session.Run(['-pid'])[0]
+    self.assertEqual(('-plist|.|-read|/Users/crash\n', '', 0),
+                     self.session.Run(['-read', '/Users/crash']))
+    self.assertNotEqual(pid, self.session.Run(['-pid'])[0])
+
+  def testWriteNotReplayedAfterExit(self):
+    self.assertRaises(ds.DSException, self.session.Run,
+                      ['-create', '/Users/crash', 'UserShell', '/bin/sh'])
+    self.assertEqual(
+        ('-plist|.|-create|/Users/crash|UserShell|/bin/sh\n', '', 0),
+        self.session.Run(['-create', '/Users/crash', 'UserShell', '/bin/sh']))
+
+  def testMultiLineArgument(self):
+    self.assertRaises(ds.DSException, self.session.Run,
+                      ['-create', '/Users/foo', 'RealName', 'a\nb'])
+
+  def testSessions(self):
+    self.mox.StubOutWithMock(ds.gmacpyutil, 'RunProcess')
+    self.mox.ReplayAll()
+    with ds.Sessions():
+      with ds.Sessions():
+        self.assertEqual(['alice', 'bob'], ds.DSList('user'))
+      ds.DSSet('user', 'foo', 'UserShell', '/bin/bash')
+      self.assertEqual(1, len(ds._sessions))
+    self.assertEqual(None, ds._sessions)
+    self.mox.VerifyAll()
+
+
+class FakeLDAPError(Exception):
+  pass
+
+
+class FakeServerDown(FakeLDAPError):
+  pass
+
+
+class FakePagedResultsControl(object):
+  controlType = '1.2.840.113556.1.4.319'
+
+  def __init__(self, criticality, size, cookie):
+    self.criticality = criticality
+    self.size = size
+    self.cookie = cookie
+
+
+class FakeLDAPServer(object):
+  """Stand-in for the parts of python-ldap and a server that ds uses."""
+
+  LDAPError = FakeLDAPError
+  SERVER_DOWN = FakeServerDown
+  SCOPE_BASE = 0
+  SCOPE_SUBTREE = 2
+  OPT_REFERRALS = 8
+  OPT_NETWORK_TIMEOUT = 20485
+
+  class controls(object):  # pylint: disable=invalid-name
+    SimplePagedResultsControl = FakePagedResultsControl
+
+  def __init__(self, entries):
+    self.entries = entries
+    self.connections = 0
+    self.searches = 0
+    self.down = 0
+
+  def initialize(self, uri):  # pylint: disable=g-bad-name
+    assert uri == 'ldap://ldap.corp'
+    self.connections += 1
+    return FakeLDAPConnection(self)
+
+
+class FakeLDAPConnection(object):
+
+  def __init__(self, server):
+    self.server = server
+    self.results = {}
+
+  def set_option(self, unused_option, unused_value):
+    pass
+
+  def simple_bind_s(self, unused_dn, unused_password):
+    pass
+
+  def unbind_s(self):
+    pass
+
+  def search_st(self, base, scope, unused_filterstr, unused_attributes,
+                timeout=None):
+    assert (base, scope, timeout) == ('', 0, 30)
+    return [('', {'namingContexts': ['dc=corp']})]
+
+  def search_ext(self, base, unused_scope, filterstr, attributes,
+                 serverctrls=None):
+    assert base == 'dc=corp'
+    if self.server.down:
+      self.server.down -= 1
+      raise FakeServerDown('gone')
+    self.server.searches += 1
+    match = re.search(r'\(([\w-]+)=([^)]*)\)$', filterstr[:-1])
+    entries = []
+    for entry in self.server.entries:
+      if match and match.group(1) != 'objectClass':
+        value = re.sub(r'\\([0-9a-f]{2})',
+                       lambda m: chr(int(m.group(1), 16)), match.group(2))
+        if value not in entry.get(match.group(1), []):
+          continue
+      entries.append(('cn=%s,dc=corp' % entry['cn'][0],
+                      dict((a, entry[a]) for a in attributes if a in entry)))
+    page = serverctrls[0]
+    start = int(page.cookie or 0)
+    end = start + page.size
+    control = FakePagedResultsControl(False, 0, '')
+    if end < len(entries):
+      control.cookie = str(end)
+    msgid = len(self.results)
+    self.results[msgid] = (entries[start:end] + [(None, ['ldap://ref'])],
+                           control)
+    return msgid
+
+  def result3(self, msgid, timeout=None):
+    assert timeout == 30
+    entries, control = self.results.pop(msgid)
+    return 101, entries, msgid, [control]
+
+
+class LDAPResolverTest(basetest.TestCase):
+  """Test ds.LDAPResolver against a stand-in server."""
+
+  def setUp(self):
+    self.stubs = stubout.StubOutForTesting()
+    members = ['user%d' % i for i in range(5000)]
+    self.server = FakeLDAPServer(
+        [{'cn': ['big'], 'apple-generateduid': ['uid-big'],
+          'memberUid': members, 'apple-group-nestedgroup': ['uid-0']}] +
+        [{'cn': ['group%d' % i], 'apple-generateduid': ['uid-%d' % i],
+          'memberUid': ['user%d' % i]} for i in range(7)] +
+        [{'cn': ['odd(*)'], 'apple-generateduid': ['uid-odd']}])
+    self.stubs.Set(ds, 'ldap', self.server)
+    self.stubs.Set(ds, '_ldap_resolvers', {})
+    self.stubs.Set(ds, 'USE_LDAP_RESOLVER', True)
+    self.resolver = ds.LDAPResolver('ldap.corp', page_size=3)
+
+  def tearDown(self):
+    self.stubs.UnsetAll()
+
+  def testGroupName(self):
+    self.assertEqual('group5', self.resolver.GroupName('uid-5'))
+    self.assertEqual(None, self.resolver.GroupName('uid-missing'))
+    self.assertEqual(1, self.server.connections)
+
+  def testGroupMembership(self):
+    members, nested = self.resolver.GroupMembership('big')
+    self.assertEqual(5000, len(members))
+    self.assertEqual(['uid-0'], nested)
+    self.assertEqual((['user3'], []), self.resolver.GroupMembership('group3'))
+    self.assertEqual(([], []), self.resolver.GroupMembership('odd(*)'))
+    self.assertRaises(ds.DSException, self.resolver.GroupMembership, 'none')
+
+  def testPagedSearch(self):
+    entries = self.resolver.Search('(objectClass=posixGroup)', ['cn'])
+    self.assertEqual(9, len(entries))
+    self.assertEqual(3, self.server.searches)
+
+  def testReconnect(self):
+    self.resolver.GroupName('uid-1')
+    self.server.down = 1
+    self.assertEqual('group2', self.resolver.GroupName('uid-2'))
+    self.assertEqual(2, self.server.connections)
+    self.server.down = 2
+    self.assertRaises(ds.DSException, self.resolver.GroupName, 'uid-3')
+
+  def testResolveGroupUID(self):
+    ds._group_names.clear()
+    self.stubs.Set(ds, 'DSGetRecordNameFromUUID',
+                   lambda unused_dstype, unused_groupuid: None)
+    self.assertEqual(('group4', '/LDAPv3/ldap.corp'),
+                     ds._ResolveGroupUID('uid-4', ldap_server='ldap.corp'))
+
+  def testResolveGroupUIDFallsBackToDscl(self):
+    ds._group_names.clear()
+    def FakeDSGetRecordNameFromUUID(unused_dstype, groupuid, node='.'):
+      if node == '/LDAPv3/ldap.corp' and groupuid == 'uid-other':
+        return 'other'
+      return None
+    self.stubs.Set(ds, 'DSGetRecordNameFromUUID', FakeDSGetRecordNameFromUUID)
+    self.assertEqual(None, self.resolver.GroupName('uid-other'))
+    self.assertEqual(('other', '/LDAPv3/ldap.corp'),
+                     ds._ResolveGroupUID('uid-other', ldap_server='ldap.corp'))
+
+  def testResolverOptIn(self):
+    self.assertNotEqual(None, ds._LDAPResolverFor('ldap.corp'))
+    self.stubs.Set(ds, 'USE_LDAP_RESOLVER', False)
+    self.assertEqual(None, ds._LDAPResolverFor('other.corp'))
+
+  def testExpand(self):
+    ds._group_names.clear()
+    self.stubs.Set(ds, 'DSGetRecordNameFromUUID',
+                   lambda unused_dstype, unused_groupuid: None)
+    resolver = ds.GroupResolver(ldap_server='ldap.corp')
+    members, groups = resolver.Expand(['local'], ['uid-big'])
+    self.assertEqual(5001, len(members))
+    self.assertEqual(['big', 'group0'], groups)
+
+
 if __name__ == '__main__':
   basetest.main()
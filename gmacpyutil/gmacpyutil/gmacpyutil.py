@@ -13,6 +13,7 @@ import signal
 import socket
 import subprocess
 import sys
+import threading
 import time
 from . import defaults
 from distutils import version as distutils_version
@@ -206,7 +207,7 @@ def SetFileNonBlocking(f, non_blocking=True):
 
 def _RunProcess(cmd, stdinput=None, env=None, cwd=None, sudo=False,
                 sudo_password=None, background=False, stream_output=False,
-                timeout=0, waitfor=0):
+                timeout=0, waitfor=0, close_fds=False):
   """Executes cmd using suprocess.
 
   Args:
@@ -224,6 +225,9 @@ def _RunProcess(cmd, stdinput=None, env=None, cwd=None, sudo=False,
       values <1 will be crudely rounded off because of select() sleep time.
     waitfor: An optional int or float, if >0, Exec() will wait waitfor seconds
       before asking for the process exit status one more time.
+    close_fds: An optional boolean on whether to close all other file
+      descriptors in the child. Set this when running processes from several
+      threads at once, so that no child holds on to another's pipes.
   Returns:
     Tuple: two strings and an integer: (stdout, stderr, returncode);
     stdout/stderr may also be None. If the process is set to launch in
@@ -273,7 +277,8 @@ def _RunProcess(cmd, stdinput=None, env=None, cwd=None, sudo=False,
     environment.update(env)
   try:
     task = subprocess.Popen(cmd, stdout=stdoutput, stderr=stderror,
-                            stdin=subprocess.PIPE, env=environment, cwd=cwd)
+                            stdin=subprocess.PIPE, env=environment, cwd=cwd,
+                            close_fds=close_fds)
   except OSError, e:
     raise GmacpyutilException('Could not execute: %s' % e.strerror)
   if timeout == 0:
@@ -339,6 +344,28 @@ def RunProcessInBackground(*args, **kwargs):
   return _RunProcess(*args, **kwargs)
 
 
+def ReadInBackground(stream):
+  """Reads a stream to its end on another thread.
+
+  Use this for a pipe of a background process, such as its stderr, while
+  reading another of its pipes; otherwise the process may block writing to
+  a full pipe that is not read until the other one is done.
+
+  Args:
+    stream: file-like object to read
+  Returns:
+    callable which waits for the stream to be read and returns its contents
+  """
+  contents = []
+  thread = threading.Thread(target=lambda: contents.append(stream.read()))
+  thread.daemon = True
+  thread.start()
+  def Contents():
+    thread.join()
+    return ''.join(contents)
+  return Contents
+
+
 def GetConsoleUser():
   """Returns current console user."""
   stat_info = os.stat('/dev/console')
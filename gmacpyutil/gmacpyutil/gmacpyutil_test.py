@@ -258,7 +258,7 @@ class GmacpytutilModuleTest(mox.MoxTestBase):
     mock_env.copy().AndReturn(mock_env)
     gmacpyutil.subprocess.Popen(
         ['cmd'], stdout='pipe', stderr='pipe', stdin='pipe', env=mock_env,
-        cwd=None).AndReturn(mock_task)
+        cwd=None, close_fds=False).AndReturn(mock_task)
     mock_task.communicate(input=None).AndReturn(('out', 'err'))
     mock_task.returncode = 0
     self.mox.ReplayAll()
@@ -280,7 +280,7 @@ class GmacpytutilModuleTest(mox.MoxTestBase):
     mock_env.copy().AndReturn(env_copy)
     gmacpyutil.subprocess.Popen(
         ['cmd'], stdout='pipe', stderr='pipe', stdin='pipe', env=used_env,
-        cwd=None).AndReturn(mock_task)
+        cwd=None, close_fds=False).AndReturn(mock_task)
     mock_task.communicate(input=None).AndReturn(('out', 'err'))
     mock_task.returncode = 0
     self.mox.ReplayAll()
@@ -350,7 +350,7 @@ class GmacpytutilModuleTest(mox.MoxTestBase):
     gmacpyutil.subprocess.Popen(
         ['sudo', '-p', "%u's password is required for admin access: ", 'cmd'],
         stdout='pipe', stderr='pipe', stdin='pipe', env=mock_env,
-        cwd=None).AndReturn(mock_task)
+        cwd=None, close_fds=False).AndReturn(mock_task)
     mock_task.communicate(input=None).AndReturn(('out', 'err'))
     mock_task.returncode = 0
     self.mox.ReplayAll()
@@ -368,7 +368,7 @@ class GmacpytutilModuleTest(mox.MoxTestBase):
     mock_env.copy().AndReturn(mock_env)
     gmacpyutil.subprocess.Popen(
         ['sudo', '-S', 'cmd'], stdout='pipe', stderr='pipe', stdin='pipe',
-        env=mock_env, cwd=None).AndReturn(mock_task)
+        env=mock_env, cwd=None, close_fds=False).AndReturn(mock_task)
     mock_task.communicate(input='password\n').AndReturn(('out', 'err'))
     mock_task.returncode = 0
     self.mox.ReplayAll()
@@ -386,7 +386,7 @@ class GmacpytutilModuleTest(mox.MoxTestBase):
     mock_env.copy().AndReturn(mock_env)
     gmacpyutil.subprocess.Popen(
         ['cmd'], stdout='pipe', stderr='pipe', stdin='pipe', env=mock_env,
-        cwd=None).AndReturn(mock_task)
+        cwd=None, close_fds=False).AndReturn(mock_task)
     self.mox.ReplayAll()
     self.assertEqual(mock_task,
                      gmacpyutil._RunProcess(['cmd'], background=True))
@@ -403,7 +403,7 @@ class GmacpytutilModuleTest(mox.MoxTestBase):
     mock_env.copy().AndReturn(mock_env)
     gmacpyutil.subprocess.Popen(
         ['cmd'], stdout='pipe', stderr='pipe', stdin='pipe', env=mock_env,
-        cwd=None).AndReturn(mock_task)
+        cwd=None, close_fds=False).AndReturn(mock_task)
     mock_task.stdin = mock_write
     mock_write.write('input').AndReturn(None)
     self.mox.ReplayAll()
@@ -422,7 +422,7 @@ class GmacpytutilModuleTest(mox.MoxTestBase):
     mock_env.copy().AndReturn(mock_env)
     gmacpyutil.subprocess.Popen(
         ['cmd'], stdout=None, stderr=None, stdin='pipe', env=mock_env,
-        cwd=None).AndReturn(mock_task)
+        cwd=None, close_fds=False).AndReturn(mock_task)
     mock_task.communicate(input=None).AndReturn((None, None))
     mock_task.returncode = 0
     self.mox.ReplayAll()
@@ -447,7 +447,7 @@ class GmacpytutilModuleTest(mox.MoxTestBase):
     mock_env.copy().AndReturn(mock_env)
     gmacpyutil.subprocess.Popen(
         ['cmd'], stdout='pipe', stderr='pipe', stdin='pipe', env=mock_env,
-        cwd=None).AndReturn(mock_task)
+        cwd=None, close_fds=False).AndReturn(mock_task)
     gmacpyutil.SetFileNonBlocking(mock_task.stdout).AndReturn(None)
     gmacpyutil.SetFileNonBlocking(mock_task.stderr).AndReturn(None)
     gmacpyutil.select.select(
@@ -481,7 +481,7 @@ class GmacpytutilModuleTest(mox.MoxTestBase):
     mock_env.copy().AndReturn(mock_env)
     gmacpyutil.subprocess.Popen(
         ['cmd'], stdout='pipe', stderr='pipe', stdin='pipe', env=mock_env,
-        cwd=None).AndReturn(mock_task)
+        cwd=None, close_fds=False).AndReturn(mock_task)
     gmacpyutil.SetFileNonBlocking(mock_task.stdout).AndReturn(None)
     gmacpyutil.SetFileNonBlocking(mock_task.stderr).AndReturn(None)
     gmacpyutil.select.select(
@@ -519,7 +519,7 @@ class GmacpytutilModuleTest(mox.MoxTestBase):
     mock_env.copy().AndReturn(mock_env)
     gmacpyutil.subprocess.Popen(
         ['cmd'], stdout='pipe', stderr='pipe', stdin='pipe', env=mock_env,
-        cwd=None).AndReturn(mock_task)
+        cwd=None, close_fds=False).AndReturn(mock_task)
     gmacpyutil.SetFileNonBlocking(mock_task.stdout).AndReturn(None)
     gmacpyutil.SetFileNonBlocking(mock_task.stderr).AndReturn(None)
     gmacpyutil.select.select(
@@ -569,6 +569,14 @@ class GmacpytutilModuleTest(mox.MoxTestBase):
     gmacpyutil.RunProcessInBackground(['cmd'])
     self.mox.VerifyAll()
 
+  def testReadInBackground(self):
+    read_fd, write_fd = os.pipe()
+    contents = gmacpyutil.ReadInBackground(os.fdopen(read_fd))
+    # More than a pipe holds, so this only returns if the pipe is being read.
+    with os.fdopen(write_fd, 'w') as pipe:
+      pipe.write('e' * 1000000)
+    self.assertEqual('e' * 1000000, contents())
+
   def testGetPlistKey(self):
     """Test GetPlistKey."""
     self.StubSetup()
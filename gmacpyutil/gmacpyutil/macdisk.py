@@ -4,62 +4,148 @@ This is basically a convenience wrapper around hdiutil, diskutil and asr to
 unify the three tools so you can easily refer to objects.
 """
 
+import contextlib
+import hashlib
+import logging
+from multiprocessing import pool as thread_pool
+import os
 import plistlib
-import re
 import subprocess
+import tempfile
+import threading
+import time
 import xml.parsers.expat
+from . import defaults
 from . import gmacpyutil
 
 
+# Number of diskutil info calls to run at once.
+DISKUTIL_INFO_THREADS = 8
+# Number of images UnmountAllDiskImages detaches at once.
+DETACH_THREADS = 4
+# How often a busy image is retried, and the first delay between tries; the
+# delay doubles each time.
+DETACH_RETRIES = 4
+DETACH_BACKOFF = 1.0
+IMAGE_CACHE_DIR = defaults.MACDISK_IMAGE_CACHE_DIR
+# Seconds an unused image stays attached in an ImagePool, and how many images
+# a pool keeps attached while they are not in use.
+IMAGE_POOL_IDLE_TIMEOUT = 300
+IMAGE_POOL_MAX_ATTACHED = 8
+# The content digest of an image covers this many blocks of this size, spread
+# evenly over the file from its first to its last block.
+IMAGE_DIGEST_SAMPLES = 32
+IMAGE_DIGEST_BLOCK = 64 * 1024
+
+
 class MacDiskError(Exception):
   """Module specific exception class."""
   pass
 
 
+# The diskutil info keys Disk exposes as attributes, e.g. MountPoint as
+# mountpoint. This includes DeviceIdentifier even though we're using deviceid
+# internally for init, and is why the rest of the code has gratuitous use of
+# disable=no-member.
+DISKUTIL_INFO_KEYS = (
+    "Content", "Internal", "CanBeMadeBootableRequiresDestroy", "MountPoint",
+    "DeviceNode", "SystemImage", "CanBeMadeBootable",
+    "SupportsGlobalPermissionsDisable", "VolumeName", "DeviceTreePath",
+    "DeviceIdentifier", "VolumeUUID", "Bootable", "BusProtocol", "Ejectable",
+    "MediaType", "RAIDSlice", "FilesystemName", "RAIDMaster", "WholeDisk",
+    "FreeSpace", "TotalSize", "GlobalPermissionsEnabled", "SMARTStatus",
+    "Writable", "ParentWholeDisk", "MediaName", "JournalSize")
+
+
+def _AttributeName(key):
+  return key.lower().replace(" ", "")
+
+
 class Disk(object):
   """Represents a disk object.
 
   Note that this also is used for currently mounted disk images as they
   really are just 'disks'. Mostly. Can take device ids of the form "disk1" or
   of the form "/dev/disk1".
+
+  A Disk can be made from data already in hand, such as an entry from
+  diskutil list, by passing partial=True; diskutil info then only runs when
+  an attribute outside that data is first read. refreshed is the time.time()
+  of the last diskutil info, or None if there has not been one yet.
   """
 
-  def __init__(self, deviceid):
+  __slots__ = (("deviceid", "refreshed", "diskimage", "_attributes",
+                "_partial") +
+               tuple(_AttributeName(key) for key in DISKUTIL_INFO_KEYS))
+
+  def __init__(self, deviceid, attributes=None, partial=False):
     if deviceid.startswith("/dev/"):
       deviceid = deviceid.replace("/dev/", "", 1)
     self.deviceid = deviceid
-    self.Refresh()
+    self.refreshed = None
+    self._partial = False
+    if attributes is None:
+      self.Refresh()
+    else:
+      self._SetAttributes(attributes, partial=partial)
+
+  def __getattr__(self, name):
+    # Only called for attributes which have not been set. Copies and
+    # unpickled Disks have no _partial until their state is restored, so
+    # look it up without coming back here.
+    try:
+      partial = object.__getattribute__(self, "_partial")
+    except AttributeError:
+      raise AttributeError(name)
+    if name in Disk.__slots__ and partial:
+      self._Complete()
+      return getattr(self, name)
+    raise AttributeError("%s has no attribute %s" % (self.deviceid, name))
 
   def Refresh(self):
     """convenience attrs for direct querying really."""
+    self._SetAttributes(_DictFromDiskutilInfo(self.deviceid))
 
-    self._attributes = _DictFromDiskutilInfo(self.deviceid)
-    # We iterate over all known keys, yes this includes DeviceIdentifier
-    # even though we"re using deviceid internally for init.
-    # This is why the rest of the code has gratuitous use of
-    # disable-msg=E1101 due to constructing the attributes this way.
-    keys = ["Content", "Internal", "CanBeMadeBootableRequiresDestroy",
-            "MountPoint", "DeviceNode", "SystemImage", "CanBeMadeBootable",
-            "SupportsGlobalPermissionsDisable", "VolumeName",
-            "DeviceTreePath", "DeviceIdentifier", "VolumeUUID", "Bootable",
-            "BusProtocol", "Ejectable", "MediaType", "RAIDSlice",
-            "FilesystemName", "RAIDMaster", "WholeDisk", "FreeSpace",
-            "TotalSize", "GlobalPermissionsEnabled", "SMARTStatus",
-            "Writable", "ParentWholeDisk", "MediaName"]
+  def _Complete(self):
+    """Reads diskutil info for a Disk made from partial data."""
+    self._SetAttributes(_DictFromDiskutilInfo(self.deviceid, validate=False))
 
-    for key in keys:
-      try:
-        attribute = key.lower().replace(" ", "")
-        setattr(self, attribute, self._attributes[key])
-      # pylint: disable=pointless-except
-      except KeyError:  # not all objects have all these attributes
-        pass
+  def _SetAttributes(self, attributes, partial=False):
+    """Sets the convenience attrs from a diskutil info dict.
 
-    if self.busprotocol == "Disk Image":  # pylint: disable=no-member
-      self.diskimage = True
-    else:
+    Args:
+      attributes: dict, diskutil info output, or part of it
+      partial: bool, whether attributes only holds some of the keys
+    """
+    self._attributes = attributes
+    self._partial = partial
+    if not partial:
+      self.refreshed = time.time()
+    for key in DISKUTIL_INFO_KEYS:
+      attribute = _AttributeName(key)
+      if key in attributes:
+        setattr(self, attribute, attributes[key])
+      elif not partial:
+        # not all objects have all these attributes
+        try:
+          object.__delattr__(self, attribute)
+        except AttributeError:
+          pass
+    if "BusProtocol" in attributes:
+      self.diskimage = attributes["BusProtocol"] == "Disk Image"
+    elif not partial:
       self.diskimage = False
 
+  def IsStale(self, max_age):
+    """Whether diskutil info was last read more than max_age seconds ago.
+
+    Args:
+      max_age: int or float, seconds
+    Returns:
+      boolean, True if it has never been read
+    """
+    return self.refreshed is None or time.time() - self.refreshed > max_age
+
   def Mounted(self):
     """Is it mounted."""
     try:
@@ -67,22 +153,34 @@ class Disk(object):
         return True
       else:
         return False
-    except KeyError:
+    except AttributeError:
       return False
 
   def Partitions(self):
-    """Child partitions of a whole disk."""
+    """Child partitions of a whole disk.
+
+    The partitions are made from diskutil list, so reading their device ids
+    or mount points does not run diskutil info. Like diskutil info, the mount
+    point of a partition which is not mounted is "".
+    """
     if not self.wholedisk:  # pylint: disable=no-member
       raise MacDiskError("%s is not a whole disk" % self.deviceid)
-    else:
-      partitions = []
-      for p in PartitionDeviceIds():
-        if re.compile("^%ss" % self.deviceid).search(p):
-          partitions.append(Disk(p))
-      return partitions
+    for disk in _DictFromDiskutilList().get("AllDisksAndPartitions", []):
+      if disk.get("DeviceIdentifier") == self.deviceid:
+        return [
+            Disk(partition["DeviceIdentifier"],
+                 attributes=dict(partition, ParentWholeDisk=self.deviceid,
+                                 WholeDisk=False,
+                                 MountPoint=partition.get("MountPoint", "")),
+                 partial=True)
+            for partition in (disk.get("Partitions", []) +
+                              disk.get("APFSVolumes", []))]
+    return []
 
   def Info(self):
     """info."""
+    if self._partial:
+      self._Complete()
     return self._attributes
 
   def Mount(self):
@@ -128,7 +226,8 @@ class Disk(object):
         command.insert(2, "force")
       if self.wholedisk:  # pylint: disable=no-member
         command[1] = "unmountDisk"
-      rc = gmacpyutil.RunProcess(command)[2]
+      # Clone unmounts its target on a thread pool.
+      rc = gmacpyutil.RunProcess(command, close_fds=True)[2]
       if rc == 0:
         self.Refresh()
         return True
@@ -192,6 +291,152 @@ class Disk(object):
   # resizeVolume, splitPartition, mergePartitions
 
 
+def _ImageDigest(imagepath, size):
+  """Returns a fast digest of an image file's contents.
+
+  Rather than reading the whole file, this hashes IMAGE_DIGEST_SAMPLES blocks
+  spread evenly over it, which is enough to notice an image being replaced or
+  rewritten in place with the same size and mtime.
+
+  Args:
+    imagepath: str, path to the image file
+    size: int, size of the image file
+  Returns:
+    str, hex digest
+  Raises:
+    IOError: the image could not be read
+  """
+  digest = hashlib.sha1(str(size))
+  last = max(size - IMAGE_DIGEST_BLOCK, 0)
+  offsets = sorted(set(last * i // (IMAGE_DIGEST_SAMPLES - 1)
+                       for i in range(IMAGE_DIGEST_SAMPLES)))
+  with open(imagepath, "rb") as image_file:
+    for offset in offsets:
+      image_file.seek(offset)
+      digest.update(image_file.read(IMAGE_DIGEST_BLOCK))
+  return digest.hexdigest()
+
+
+class ImageCache(object):
+  """On-disk cache of what hdiutil has told us about image files.
+
+  For each image this remembers whether it has attached with verification and
+  its hdiutil imageinfo, so that neither needs doing again while the image is
+  unchanged. Entries are plists in IMAGE_CACHE_DIR, keyed by image path and
+  stamped with the size, mtime and _ImageDigest of the image; an entry whose
+  stamp no longer matches is ignored and replaced. Since a cached verification
+  skips hdiutil's checksum, the cache is only used if its directory belongs to
+  the current user and nobody else can write to it.
+
+  Attributes:
+    cache_dir: str, path to the cache directory
+  """
+
+  VERSION = 1
+
+  def __init__(self, cache_dir=IMAGE_CACHE_DIR):
+    self.cache_dir = os.path.expanduser(cache_dir)
+
+  def _Path(self, imagepath):
+    return os.path.join(
+        self.cache_dir,
+        "%s.plist" % hashlib.sha1(os.path.abspath(imagepath)).hexdigest())
+
+  def _CheckDir(self):
+    """Creates the cache directory, or checks that it is private.
+
+    Returns:
+      bool, whether the cache directory can be used
+    """
+    try:
+      if not os.path.isdir(self.cache_dir):
+        os.makedirs(self.cache_dir, 0700)
+      stat = os.lstat(self.cache_dir)
+    except OSError, e:
+      logging.debug("Cannot create image cache %s: %s", self.cache_dir, e)
+      return False
+    if stat.st_uid != os.geteuid() or stat.st_mode & 0022:
+      logging.debug("Image cache %s is not private, not using it.",
+                    self.cache_dir)
+      return False
+    return True
+
+  def _Load(self, imagepath):
+    """Returns (entry, stamp) for an image.
+
+    entry is the cached dictionary if it matches the image as it is now, or
+    an empty one; stamp is the image's current [size, mtime, digest], or None
+    if the image cannot be cached.
+    """
+    try:
+      stat = os.stat(imagepath)
+    except OSError:
+      return {}, None
+    if not os.path.isfile(imagepath) or not self._CheckDir():
+      return {}, None
+    try:
+      entry = plistlib.readPlist(self._Path(imagepath))
+    except (IOError, ValueError, xml.parsers.expat.ExpatError):
+      entry = {}
+    if (entry.get("version") != self.VERSION or
+        entry.get("path") != os.path.abspath(imagepath) or
+        entry.get("stamp", [])[:2] != [stat.st_size, stat.st_mtime]):
+      entry = {}
+    try:
+      stamp = [stat.st_size, stat.st_mtime,
+               _ImageDigest(imagepath, stat.st_size)]
+    except IOError:
+      return {}, None
+    if entry and entry["stamp"] != stamp:
+      entry = {}
+    return entry, stamp
+
+  def _Save(self, imagepath, entry, stamp):
+    """Atomically writes an entry; failures only cost another hdiutil run."""
+    entry = dict(entry, version=self.VERSION, stamp=stamp,
+                 path=os.path.abspath(imagepath))
+    path = self._Path(imagepath)
+    temp_path = None
+    try:
+      # A unique temp file, as other threads may be saving the same entry.
+      fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".cache")
+      with os.fdopen(fd, "w") as cache_file:
+        plistlib.writePlist(entry, cache_file)
+      os.rename(temp_path, path)
+    except (IOError, OSError, TypeError), e:
+      logging.debug("Unable to save image cache %s: %s", path, e)
+      if temp_path and os.path.exists(temp_path):
+        os.remove(temp_path)
+
+  def IsVerified(self, imagepath):
+    """Whether the image, as it is now, has attached with verification."""
+    entry, _ = self._Load(imagepath)
+    return bool(entry.get("verified"))
+
+  def SetVerified(self, imagepath):
+    """Records that the image has attached with verification."""
+    entry, stamp = self._Load(imagepath)
+    if stamp is not None:
+      entry["verified"] = True
+      self._Save(imagepath, entry, stamp)
+
+  def ImageInfo(self, imagepath):
+    """Returns the cached hdiutil imageinfo of the image, or None."""
+    entry, _ = self._Load(imagepath)
+    return entry.get("imageinfo")
+
+  def SetImageInfo(self, imagepath, info):
+    """Records the hdiutil imageinfo of the image."""
+    entry, stamp = self._Load(imagepath)
+    if stamp is not None:
+      entry["imageinfo"] = info
+      self._Save(imagepath, entry, stamp)
+
+
+# The cache Image uses; set to None to always ask hdiutil.
+image_cache = ImageCache()
+
+
 class Image(object):
   """Represents an unmounted image object."""
 
@@ -237,7 +482,11 @@ class Image(object):
       return stdout
 
   def Attach(self, password=None, verify=True, browse=True):
-    """Attaches a disk image, returns list of Disk objects."""
+    """Attaches a disk image, returns list of Disk objects.
+
+    An image which image_cache knows has attached with verification before,
+    and has not changed since, is attached without verifying it again.
+    """
 
     if isinstance(self, EncryptedImage) and not password:
       raise MacDiskError("Encrypted Images cannot Attach without a password")
@@ -247,7 +496,9 @@ class Image(object):
     if isinstance(self, EncryptedImage):
       command.append("-stdinpass")
 
-    if not verify:
+    verified = (verify and image_cache is not None and
+                image_cache.IsVerified(self.imagepath))
+    if not verify or verified:
       command.append("-noverify")
 
     if not browse:
@@ -256,6 +507,8 @@ class Image(object):
     command.append(self.imagepath)
 
     plist = _DictFromSubprocess(command, stdin=password)
+    if verify and not verified and image_cache is not None:
+      image_cache.SetVerified(self.imagepath)
     attached_disks = []
     for entity in plist["system-entities"]:
       # strip off /dev from start
@@ -308,12 +561,196 @@ class EncryptedImage(Image):
     return attached_disks
 
 
-def _DictFromSubprocess(command, stdin=None):
+class ImagePool(object):
+  """Keeps disk images attached between uses.
+
+  Acquire attaches an image the first time it is asked for and hands out its
+  mount points; Release gives them back. An image stays attached while it is
+  in use, and for idle_timeout seconds after its last Release, so that using
+  the same image again does not pay for another attach. Idle images are
+  detached by a background thread once they time out, and the least recently
+  used idle images are detached early when more than max_attached images are
+  attached. Images in use are never detached, so max_attached can be exceeded
+  while they all are.
+
+  Attaching and detaching hold the pool's lock, so a pool is safe to share
+  between threads.
+
+  with ImagePool() as pool:
+    with pool.Mounted("/path/to/package.dmg") as mountpoints:
+      ...
+  """
+
+  def __init__(self, idle_timeout=IMAGE_POOL_IDLE_TIMEOUT,
+               max_attached=IMAGE_POOL_MAX_ATTACHED, verify=True,
+               browse=False):
+    """Initializes the pool.
+
+    Args:
+      idle_timeout: seconds an unused image stays attached
+      max_attached: number of images to keep attached while unused
+      verify: whether to verify images when attaching them
+      browse: whether attached images show up in the Finder
+    """
+    self.idle_timeout = idle_timeout
+    self.max_attached = max_attached
+    self.verify = verify
+    self.browse = browse
+    self._lock = threading.Lock()
+    # image path to {"disks", "mountpoints", "refs", "last_used"}
+    self._images = {}
+    self._reaper = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self.Close()
+
+  def Acquire(self, imagepath):
+    """Attaches an image if needed and takes a reference to it.
+
+    Args:
+      imagepath: str, path to the image
+    Returns:
+      list of the mount points of the image's volumes
+    Raises:
+      MacDiskError: the image could not be attached
+    """
+    imagepath = os.path.abspath(imagepath)
+    with self._lock:
+      pooled = self._images.get(imagepath)
+      if pooled and not all(os.path.ismount(mountpoint)
+                            for mountpoint in pooled["mountpoints"]):
+        # Detached behind our back.
+        del self._images[imagepath]
+        pooled = None
+      if pooled is None:
+        self._Trim(self.max_attached - 1)
+        disks = Image(imagepath).Attach(verify=self.verify,
+                                        browse=self.browse)
+        pooled = {"disks": disks, "refs": 0,
+                  "mountpoints": [disk.mountpoint for disk in disks
+                                  if disk.Mounted()]}
+        self._images[imagepath] = pooled
+      pooled["refs"] += 1
+      pooled["last_used"] = time.time()
+      return list(pooled["mountpoints"])
+
+  def Release(self, imagepath):
+    """Gives back a reference taken by Acquire.
+
+    Args:
+      imagepath: str, path to the image
+    Raises:
+      MacDiskError: the image is not in use
+    """
+    imagepath = os.path.abspath(imagepath)
+    with self._lock:
+      pooled = self._images.get(imagepath)
+      if not pooled or not pooled["refs"]:
+        raise MacDiskError("%s is not in use" % imagepath)
+      pooled["refs"] -= 1
+      pooled["last_used"] = time.time()
+      self._Trim(self.max_attached)
+      if self._reaper is None and self.idle_timeout is not None:
+        self._reaper = threading.Thread(target=self._Reap)
+        self._reaper.daemon = True
+        self._reaper.start()
+
+  @contextlib.contextmanager
+  def Mounted(self, imagepath):
+    """Context manager around Acquire and Release, yielding mount points."""
+    mountpoints = self.Acquire(imagepath)
+    try:
+      yield mountpoints
+    finally:
+      self.Release(imagepath)
+
+  def Attached(self):
+    """Returns the paths of the images the pool has attached."""
+    with self._lock:
+      return sorted(self._images)
+
+  def _Detach(self, imagepath):
+    """Detaches a pooled image; the lock must be held.
+
+    Returns:
+      bool, whether the image was detached
+    """
+    disks = self._images[imagepath]["disks"]
+    whole = [disk for disk in disks if getattr(disk, "wholedisk", False)]
+    if disks:
+      error = _DetachDevice((whole or disks)[0].deviceid)
+      if error is not None:
+        logging.warning("Cannot detach %s: %s", imagepath, error)
+        self._images[imagepath]["last_used"] = time.time()
+        return False
+    del self._images[imagepath]
+    return True
+
+  def _Idle(self):
+    """Returns the paths of the unused images, least recently used first."""
+    idle = [(pooled["last_used"], imagepath)
+            for imagepath, pooled in self._images.iteritems()
+            if not pooled["refs"]]
+    return [imagepath for _, imagepath in sorted(idle)]
+
+  def _Trim(self, limit):
+    """Detaches idle images until at most limit images are attached."""
+    for imagepath in self._Idle():
+      if len(self._images) <= limit:
+        break
+      self._Detach(imagepath)
+
+  def Evict(self, now=None):
+    """Detaches the images which have been unused for idle_timeout seconds.
+
+    Args:
+      now: float, time.time() to measure idleness against
+    Returns:
+      float, time.time() when the next idle image times out, or None if no
+      image is unused
+    """
+    now = now or time.time()
+    with self._lock:
+      for imagepath in self._Idle():
+        if now - self._images[imagepath]["last_used"] >= self.idle_timeout:
+          self._Detach(imagepath)
+      deadlines = [self._images[imagepath]["last_used"] + self.idle_timeout
+                   for imagepath in self._Idle()]
+      if not deadlines:
+        self._reaper = None
+        return None
+      return min(deadlines)
+
+  def _Reap(self):
+    """Evicts idle images as they time out, until none are left."""
+    deadline = time.time()
+    while deadline is not None:
+      time.sleep(max(deadline - time.time(), 0))
+      deadline = self.Evict()
+
+  def Close(self):
+    """Detaches every image the pool has attached, in use or not.
+
+    Returns:
+      list of the paths of images which could not be detached
+    """
+    with self._lock:
+      for imagepath in sorted(self._images):
+        self._Detach(imagepath)
+      return sorted(self._images)
+
+
+def _DictFromSubprocess(command, stdin=None, close_fds=False):
   """returns a dict based upon a subprocess call with a -plist argument.
 
   Args:
     command: the command to be executed as a list
     stdin: any standard input required.
+    close_fds: close other file descriptors in the child; set this when
+               called from several threads at once
   Returns:
     dict: dictionary from command output
   Raises:
@@ -326,11 +763,12 @@ def _DictFromSubprocess(command, stdin=None):
   if stdin:
     (task["stdout"],
      task["stderr"],
-     task["returncode"]) = gmacpyutil.RunProcess(command, stdin)
+     task["returncode"]) = gmacpyutil.RunProcess(command, stdin,
+                                                 close_fds=close_fds)
   else:
     (task["stdout"],
      task["stderr"],
-     task["returncode"]) = gmacpyutil.RunProcess(command)
+     task["returncode"]) = gmacpyutil.RunProcess(command, close_fds=close_fds)
 
   if task["returncode"] is not 0:
     raise MacDiskError("Error running command: %s, stderr: %s" %
@@ -343,29 +781,81 @@ def _DictFromSubprocess(command, stdin=None):
                          task["stdout"])
 
 
-def _DictFromDiskutilInfo(deviceid):
+def _DictFromDiskutilInfo(deviceid, validate=True):
   """calls diskutil info for a specific device id.
 
+  Disks are refreshed from Clone's thread pool, so this, like diskutil list,
+  runs with no other file descriptors open in the child.
+
   Args:
     deviceid: a given device id for a disk like object
+    validate: whether to check deviceid against diskutil list first; skip this
+              for ids which just came from diskutil list
   Returns:
     info: dictionary from resulting plist output
   Raises:
     MacDiskError: deviceid is invalid
   """
   # Do we want to do this? can trigger optical drive noises...
-  if deviceid not in PartitionDeviceIds():
+  if validate and deviceid not in PartitionDeviceIds():
     raise MacDiskError("%s is not a valid disk id" % deviceid)
   else:
     command = ["/usr/sbin/diskutil", "info", "-plist", deviceid]
-    return _DictFromSubprocess(command)
+    return _DictFromSubprocess(command, close_fds=True)
+
+
+def _DictFromDiskutilInfoIfPresent(deviceid):
+  """calls diskutil info, returning None if the device has gone away.
+
+  This runs on several threads at once, so diskutil is started with no other
+  file descriptors; otherwise it could keep another thread's pipes open.
+  """
+  command = ["/usr/sbin/diskutil", "info", "-plist", deviceid]
+  try:
+    return _DictFromSubprocess(command, close_fds=True)
+  except MacDiskError:
+    return None
+
+
+def _DictsFromDiskutilInfo(deviceids):
+  """calls diskutil info for several device ids at once.
+
+  Args:
+    deviceids: list of device ids, e.g. from diskutil list
+  Returns:
+    dict: device id to diskutil info dictionary, leaving out (and logging)
+          devices which went away in the meantime
+  """
+  if not deviceids:
+    return {}
+  pool = thread_pool.ThreadPool(min(len(deviceids), DISKUTIL_INFO_THREADS))
+  try:
+    infos = pool.map(_DictFromDiskutilInfoIfPresent, deviceids)
+  finally:
+    pool.terminate()
+  gone = [deviceid for deviceid, info in zip(deviceids, infos) if info is None]
+  if gone:
+    logging.info("Skipping %s, gone since diskutil list.", ", ".join(gone))
+  return dict((deviceid, info) for deviceid, info in zip(deviceids, infos)
+              if info is not None)
+
+
+def _DisksFromDeviceIds(deviceids):
+  """Returns Disk objects for device ids from diskutil list, in order.
+
+  Devices which went away since they were listed are left out rather than
+  raising MacDiskError, as one ejected disk would otherwise fail the lot.
+  """
+  infos = _DictsFromDiskutilInfo(deviceids)
+  return [Disk(deviceid, attributes=infos[deviceid])
+          for deviceid in deviceids if deviceid in infos]
 
 
 def _DictFromDiskutilList():
   """calls diskutil list -plist and returns as dict."""
 
   command = ["/usr/sbin/diskutil", "list", "-plist"]
-  return _DictFromSubprocess(command)
+  return _DictFromSubprocess(command, close_fds=True)
 
 
 def _DictFromHdiutilInfo():
@@ -376,15 +866,26 @@ def _DictFromHdiutilInfo():
 
 
 def _DictFromHdiutilImageInfo(imagepath, password=None):
-  """calls hdiutil imageinfo -plist and returns as dict."""
+  """calls hdiutil imageinfo -plist and returns as dict.
 
-  if not password:
-    command = ["/usr/bin/hdiutil", "imageinfo", "-plist", imagepath]
-  else:
+  Results for unencrypted images come from image_cache while the image is
+  unchanged.
+  """
+
+  if password:
     command = ["/usr/bin/hdiutil", "imageinfo", "-encryption", "-stdinpass",
                "-plist", imagepath]
+    return _DictFromSubprocess(command, stdin=password)
 
-  return _DictFromSubprocess(command, stdin=password)
+  if image_cache is not None:
+    info = image_cache.ImageInfo(imagepath)
+    if info is not None:
+      return info
+  command = ["/usr/bin/hdiutil", "imageinfo", "-plist", imagepath]
+  info = _DictFromSubprocess(command)
+  if image_cache is not None:
+    image_cache.SetImageInfo(imagepath, info)
+  return info
 
 
 # Class methods
@@ -398,11 +899,11 @@ def PartitionDeviceIds():
 
 
 def Partitions():
-  """Returns a list of all disk objects that are partitions."""
-  partitions = []
-  for deviceid in PartitionDeviceIds():
-    partitions.append(Disk(deviceid))
-  return partitions
+  """Returns a list of all disk objects that are partitions.
+
+  Partitions which go away while they are being listed are left out.
+  """
+  return _DisksFromDeviceIds(PartitionDeviceIds())
 
 
 def WholeDiskDeviceIds():
@@ -415,11 +916,11 @@ def WholeDiskDeviceIds():
 
 
 def WholeDisks():
-  """Returns a list of all disk objects that are whole disks."""
-  wholedisks = []
-  for deviceid in WholeDiskDeviceIds():
-    wholedisks.append(Disk(deviceid))
-  return wholedisks
+  """Returns a list of all disk objects that are whole disks.
+
+  Disks which go away while they are being listed are left out.
+  """
+  return _DisksFromDeviceIds(WholeDiskDeviceIds())
 
 
 def MountedVolumeNames():
@@ -437,13 +938,138 @@ def MountedVolumeNames():
 
 
 def MountedVolumes():
-  """Returns a list of all Disk objects that are mounted volumes."""
-  volumes = []
-  volumenames = MountedVolumeNames()
-  for partition in Partitions():
-    if partition.volumename in volumenames:
-      volumes.append(partition)
-  return volumes
+  """Returns a list of all Disk objects that are mounted volumes.
+
+  Volumes which go away while they are being listed are left out.
+
+  Raises:
+    MacDiskError: unable to list all volumes
+  """
+  listing = _DictFromDiskutilList()
+  try:
+    deviceids = listing["AllDisks"]
+    volumenames = listing["VolumesFromDisks"]
+  except KeyError:
+    raise MacDiskError("Unable to list all volumes names.")
+  return [disk for disk in _DisksFromDeviceIds(deviceids)
+          if disk.Info().get("VolumeName") in volumenames]
+
+
+class StorageSnapshot(object):
+  """A point in time view of all disks, volumes and attached images.
+
+  Built from one diskutil list, one hdiutil info and concurrent diskutil info
+  calls, rather than the two calls per Disk that WholeDisks(), Partitions()
+  and MountedVolumes() used to cost. The Disk objects in a snapshot are not
+  refreshed again unless you call their Refresh().
+
+  Whole disks, partitions and volumes are linked through their
+  ParentWholeDisk; attached images through their system-entities.
+  """
+
+  def __init__(self):
+    self.Refresh()
+
+  def Refresh(self):
+    """Takes the snapshot again.
+
+    Raises:
+      MacDiskError: unable to list disks or images
+    """
+    listing = _DictFromDiskutilList()
+    try:
+      deviceids = listing["AllDisks"]
+      self.wholediskids = listing["WholeDisks"]
+      self.volumenames = listing["VolumesFromDisks"]
+    except KeyError:
+      raise MacDiskError("Unable to list all partitions.")
+    images = _DictFromHdiutilInfo().get("images", [])
+    infos = _DictsFromDiskutilInfo(deviceids)
+
+    self.deviceids = [d for d in deviceids if d in infos]
+    self._disks = {}
+    self._children = {}
+    self._by_mountpoint = {}
+    self._by_volumeuuid = {}
+    for deviceid in self.deviceids:
+      info = infos[deviceid]
+      self._disks[deviceid] = Disk(deviceid, attributes=info)
+      parent = info.get("ParentWholeDisk")
+      if parent and parent != deviceid:
+        self._children.setdefault(parent, []).append(deviceid)
+      if info.get("MountPoint"):
+        self._by_mountpoint[info["MountPoint"]] = deviceid
+      if info.get("VolumeUUID"):
+        self._by_volumeuuid[info["VolumeUUID"]] = deviceid
+
+    self._images = []
+    self._image_by_deviceid = {}
+    for image in images:
+      attached_image = {"image-path": image.get("image-path"), "disks": [],
+                        "info": image}
+      for entity in image.get("system-entities", []):
+        deviceid = entity.get("dev-entry", "").replace("/dev/", "", 1)
+        if deviceid in self._disks:
+          attached_image["disks"].append(self._disks[deviceid])
+          self._image_by_deviceid[deviceid] = attached_image
+      self._images.append(attached_image)
+
+  def ByDeviceId(self, deviceid):
+    """Returns the Disk for a device id such as "disk1", or None."""
+    if deviceid.startswith("/dev/"):
+      deviceid = deviceid.replace("/dev/", "", 1)
+    return self._disks.get(deviceid)
+
+  def ByMountPoint(self, mountpoint):
+    """Returns the Disk mounted at mountpoint, or None."""
+    return self._disks.get(self._by_mountpoint.get(mountpoint))
+
+  def ByVolumeUUID(self, volumeuuid):
+    """Returns the Disk with the volume UUID, or None."""
+    return self._disks.get(self._by_volumeuuid.get(volumeuuid))
+
+  def WholeDisks(self):
+    """Returns a list of all Disk objects that are whole disks."""
+    return [self._disks[d] for d in self.wholediskids if d in self._disks]
+
+  def Partitions(self, deviceid=None):
+    """Returns Disk objects for all device ids, or the children of one.
+
+    Args:
+      deviceid: optional whole disk device id
+    Returns:
+      list of Disk objects; like the module level Partitions(), all of them
+      when deviceid is None
+    """
+    if deviceid is None:
+      return [self._disks[d] for d in self.deviceids]
+    return [self._disks[d] for d in self._children.get(deviceid, [])]
+
+  def Parent(self, deviceid):
+    """Returns the whole disk Disk holding deviceid, or None."""
+    info = self._disks[deviceid].Info() if deviceid in self._disks else {}
+    parent = info.get("ParentWholeDisk")
+    if parent == deviceid:
+      return None
+    return self._disks.get(parent)
+
+  def MountedVolumes(self):
+    """Returns a list of all Disk objects that are mounted volumes."""
+    return [self._disks[d] for d in self.deviceids
+            if self._disks[d].Info().get("VolumeName") in self.volumenames]
+
+  def AttachedImages(self):
+    """info about attached images.
+
+    Returns:
+      a list of dictionaries with the "image-path" of each attached image,
+      its "disks" as Disk objects and its hdiutil "info"
+    """
+    return list(self._images)
+
+  def ImageOf(self, deviceid):
+    """Returns the attached image dictionary backing deviceid, or None."""
+    return self._image_by_deviceid.get(deviceid)
 
 
 def AttachedImages():
@@ -466,23 +1092,121 @@ def AttachedImages():
   return attached_images
 
 
+def _IsUnder(path, mountpoint):
+  """Whether path is on the volume mounted at mountpoint."""
+  return path == mountpoint or path.startswith(mountpoint.rstrip("/") + "/")
+
+
+def _ImageHosts(images):
+  """Works out which attached images are stored on other attached images.
+
+  Args:
+    images: list of image dictionaries from hdiutil info
+  Returns:
+    dict: index of each image to the set of indexes of the images whose
+          volumes hold its image file or shadow file
+  """
+  mountpoints = [[entity["mount-point"]
+                  for entity in image.get("system-entities", [])
+                  if entity.get("mount-point")] for image in images]
+  hosts = {}
+  for i, image in enumerate(images):
+    paths = [image[key] for key in ("image-path", "shadow-path")
+             if image.get(key)]
+    hosts[i] = set(j for j in range(len(images)) if j != i and any(
+        _IsUnder(path, mountpoint)
+        for path in paths for mountpoint in mountpoints[j]))
+  return hosts
+
+
+def _DetachDevice(deviceid, force=False):
+  """Detaches an image, retrying with backoff while it is busy.
+
+  Images are detached from several threads at once, so hdiutil is started
+  with no other file descriptors, lest it hold another thread's pipes open.
+
+  Args:
+    deviceid: str, device of the image, e.g. "/dev/disk2"
+    force: whether to force the detach
+  Returns:
+    None on success, or the error output of the last attempt
+  """
+  command = ["hdiutil", "detach", deviceid]
+  if force:
+    command.append("-force")
+  delay = DETACH_BACKOFF
+  for attempt in range(DETACH_RETRIES + 1):
+    stdout, stderr, returncode = gmacpyutil.RunProcess(command,
+                                                      close_fds=True)
+    if returncode == 0:
+      return None
+    busy = returncode == 16 or "Resource busy" in (stderr or "")
+    if not busy or attempt == DETACH_RETRIES:
+      return stderr or stdout or "hdiutil detach exited %d" % returncode
+    time.sleep(delay)
+    delay *= 2
+
+
 def UnmountAllDiskImages(detach=True, force=False):
   """Unmounts all currently attached disk images with optional force param.
 
+  When detaching, images stored on the volumes of other images, directly or
+  through a shadow file, are detached before the images holding them.
+  Images which don't depend on each other are detached concurrently, and
+  busy images are retried with backoff. An image which cannot be detached
+  leaves the images holding it attached.
+
   Args:
     detach: whether to detach
     force: whether to force the unmount
+  Returns:
+    list of the paths of images which could not be detached
   """
-  for image in AttachedImages():
-    if detach:
-      image["image"].Detach(force=force)
-    else:
+  if not detach:
+    for image in AttachedImages():
       try:
         for disk in image["disks"]:
           if disk.Mounted():
             disk.Unmount(force=force)
       except KeyError:
         pass
+    return []
+
+  images = _DictFromHdiutilInfo().get("images", [])
+  hosts = _ImageHosts(images)
+  remaining = set(range(len(images)))
+  failed = []
+
+  def Detach(i):
+    devices = [entity["dev-entry"]
+               for entity in images[i].get("system-entities", [])
+               if "dev-entry" in entity]
+    if not devices:
+      return None
+    return _DetachDevice(devices[0], force=force)
+
+  pool = thread_pool.ThreadPool(DETACH_THREADS)
+  try:
+    while remaining:
+      # Images none of the remaining images are stored on.
+      hosting = set(j for i in remaining for j in hosts[i])
+      ready = sorted(remaining - hosting) or sorted(remaining)
+      remaining -= set(ready)
+      for i, error in zip(ready, pool.map(Detach, ready)):
+        if error is None:
+          continue
+        failed.append(images[i].get("image-path"))
+        # The images holding this one would only be busy.
+        holders = set(hosts[i])
+        while holders:
+          j = holders.pop()
+          if j in remaining:
+            remaining.remove(j)
+            failed.append(images[j].get("image-path"))
+            holders.update(hosts[j])
+  finally:
+    pool.terminate()
+  return failed
 
 
 def InitalizeVDSB():
@@ -499,11 +1223,64 @@ def InitalizeVDSB():
     return False
 
 
-def Clone(source, target, erase=True, verify=True, show_activity=False):
+def _AsrPhase(line):
+  """Returns the phase an asr --puppetstrings line starts, if any.
+
+  Args:
+    line: str, a line of asr output, e.g. "XSTA\tstart\tverify"
+  Returns:
+    str phase, e.g. "restore" or "verify", or None if line starts no phase
+  """
+  fields = line.split()
+  if len(fields) < 3 or fields[:2] != ["XSTA", "start"]:
+    return None
+  return fields[2]
+
+
+def _AsrProgress(line):
+  """Returns the percentage from an asr --puppetstrings progress line.
+
+  Args:
+    line: str, a line of asr output, e.g. "PPRG\t42\t100"
+  Returns:
+    float percentage, or None if line is not a progress line
+  """
+  fields = line.split()
+  if len(fields) < 2 or fields[0] != "PPRG":
+    return None
+  try:
+    done = float(fields[1])
+    total = float(fields[2]) if len(fields) > 2 else 100.0
+  except ValueError:
+    return None
+  if total <= 0:
+    return None
+  return 100.0 * done / total
+
+
+def _CloneSize(source):
+  """Returns the number of bytes a clone of source covers, or None."""
+  try:
+    if isinstance(source, Image):
+      return getattr(source, "sizeinformation", {}).get("Total Bytes")
+    return getattr(source, "totalsize", None)
+  except MacDiskError:
+    return None
+
+
+def Clone(source, target, erase=True, verify=True, show_activity=False,
+          progress=None):
   """A wrapper around 'asr' to clone one disk object onto another.
 
   We run with --puppetstrings so that we get non-buffered output that we can
-  actually read when show_activity=True.
+  actually read when show_activity=True or progress is given.
+
+  progress is called for each progress line asr prints, as
+  progress(target, percent, bytes_done, bytes_per_second, phase). phase is
+  "restore" while the target is written and "verify" while it is checked;
+  percent, bytes_done and bytes_per_second start again from 0 in each phase.
+  The byte counts are estimated from the percentage and the size of the
+  source, and are None if that size is unknown.
 
   Args:
     source: A Disk or Image object.
@@ -511,11 +1288,13 @@ def Clone(source, target, erase=True, verify=True, show_activity=False):
     erase:  Whether to erase the target. Defaults to True.
     verify: Whether to verify the clone operation. Defaults to True.
     show_activity: whether to print the progress to the screen.
+    progress: optional callable to report progress to.
   Returns:
     boolean: whether the operation succeeded.
   Raises:
     MacDiskError: source is not a Disk or Image object
     MacDiskError: target is not a Disk object
+    MacDiskError: asr failed
   """
 
   if isinstance(source, Image):
@@ -543,18 +1322,80 @@ def Clone(source, target, erase=True, verify=True, show_activity=False):
   if not verify:
     command.append("--noverify")
 
+  total_bytes = _CloneSize(source) if progress else None
+  # stderr goes to stdout so asr can't block on a full stderr pipe while we
+  # read its progress. CloneToTargets runs several of these at once, so asr
+  # must not inherit, and hold open, the pipes of the others.
   task = subprocess.Popen(command, stdout=subprocess.PIPE,
-                          stderr=subprocess.PIPE)
-  returncode = task.poll()
-  if show_activity:
-    while returncode < 0:
-      print task.stdout.readline().strip()
-      returncode = task.poll()
-
-  (unused_stdout, stderr) = task.communicate()
+                          stderr=subprocess.STDOUT, close_fds=True)
+  start = time.time()
+  phase = "restore"
+  output = []
+  try:
+    for line in iter(task.stdout.readline, ""):
+      line = line.strip()
+      if show_activity:
+        print line
+      if _AsrPhase(line):
+        phase = _AsrPhase(line)
+        start = time.time()
+      percent = _AsrProgress(line)
+      if percent is None:
+        if line:
+          output.append(line)
+      elif progress:
+        elapsed = time.time() - start
+        bytes_done = throughput = None
+        if total_bytes:
+          bytes_done = int(total_bytes * percent / 100)
+          if elapsed > 0:
+            throughput = bytes_done / elapsed
+        progress(target, percent, bytes_done, throughput, phase)
+    task.wait()
+  finally:
+    if task.returncode is None:
+      task.kill()
+      task.wait()
 
   if task.returncode:
-    raise MacDiskError("Cloning Error: %s" % stderr)
+    raise MacDiskError("Cloning Error: %s" % "\n".join(output))
 
   return True
 
+
+def CloneToTargets(source, targets, erase=True, verify=True, progress=None,
+                   max_concurrent=None):
+  """Clones one source onto several targets at once.
+
+  Each target is restored by its own asr, as Clone would, and a failing
+  target does not stop the others.
+
+  Args:
+    source: A Disk or Image object.
+    targets: list of Disk objects
+    erase:  Whether to erase the targets. Defaults to True.
+    verify: Whether to verify the clone operations. Defaults to True.
+    progress: optional callable, as for Clone; it is called from several
+              threads, with the target each report is for.
+    max_concurrent: optional int, the most restores to run at once; all of
+                    them by default
+  Returns:
+    dict: target device id to None for success, or the MacDiskError it
+          failed with
+  """
+  if not targets:
+    return {}
+
+  def CloneOne(target):
+    deviceid = getattr(target, "deviceid", target)
+    try:
+      Clone(source, target, erase=erase, verify=verify, progress=progress)
+    except MacDiskError, e:
+      return (deviceid, e)
+    return (deviceid, None)
+
+  pool = thread_pool.ThreadPool(max_concurrent or len(targets))
+  try:
+    return dict(pool.map(CloneOne, targets))
+  finally:
+    pool.terminate()
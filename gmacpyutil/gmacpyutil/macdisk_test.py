@@ -1,6 +1,14 @@
 """Unit tests for macdisk module."""
 
 
+import copy
+import os
+import pickle
+import shutil
+import StringIO
+import tempfile
+import threading
+
 import mox
 import stubout
 
@@ -58,15 +66,17 @@ class MacdiskModuleTest(mox.MoxTestBase):
     """Test UnmountAllDiskImages."""
     detach = True
     force = False
-    self.mox.StubOutWithMock(macdisk, 'AttachedImages')
-    mock_image = self.mox.CreateMockAnything()
-    mock_image.Detach(force=force).AndReturn(None)
-    mock_disk = self.mox.CreateMockAnything()
-    macdisk.AttachedImages().AndReturn([{'image': mock_image,
-                                         'disks': [mock_disk]}])
+    self.mox.StubOutWithMock(macdisk, '_DictFromHdiutilInfo')
+    self.mox.StubOutWithMock(macdisk.gmacpyutil, 'RunProcess')
+    macdisk._DictFromHdiutilInfo().AndReturn(
+        {'images': [{'image-path': '/tmp/a.dmg',
+                     'system-entities': [{'dev-entry': '/dev/disk2'}]}]})
+    macdisk.gmacpyutil.RunProcess(
+        ['hdiutil', 'detach', '/dev/disk2'], close_fds=True).AndReturn(
+            ('', '', 0))
     self.mox.ReplayAll()
     self.assertEqual(macdisk.UnmountAllDiskImages(detach=detach, force=force),
-                     None)
+                     [])
     self.mox.VerifyAll()
 
   def testUnmountAllDiskImagesDetachFalse(self):
@@ -82,9 +92,594 @@ class MacdiskModuleTest(mox.MoxTestBase):
     mock_disk.Unmount(force=force).AndReturn(None)
     self.mox.ReplayAll()
     self.assertEqual(macdisk.UnmountAllDiskImages(detach=detach, force=force),
-                     None)
+                     [])
+    self.mox.VerifyAll()
+
+
+class UnmountAllDiskImagesTest(basetest.TestCase):
+  """Test the dependency ordering of macdisk.UnmountAllDiskImages."""
+
+  def setUp(self):
+    self.stubs = stubout.StubOutForTesting()
+    self.stubs.Set(macdisk.gmacpyutil, 'RunProcess', self.RunProcess)
+    # Replace the module rather than time.sleep, which the pool uses too.
+    self.stubs.Set(macdisk, 'time', self)
+    self.stubs.Set(macdisk, '_DictFromHdiutilInfo',
+                   lambda: {'images': self.images})
+    self.detached = []
+    self.sleeps = []
+    self.busy = {}
+    self.errors = {}
+    self.images = [
+        # An image stored on the volume of the outer image.
+        {'image-path': '/Volumes/Outer/inner.dmg',
+         'system-entities': [{'dev-entry': '/dev/disk3'},
+                             {'dev-entry': '/dev/disk3s1',
+                              'mount-point': '/Volumes/Inner'}]},
+        {'image-path': '/tmp/outer.dmg',
+         'system-entities': [{'dev-entry': '/dev/disk2'},
+                             {'dev-entry': '/dev/disk2s1',
+                              'mount-point': '/Volumes/Outer'}]},
+        # An image whose shadow file is on the inner image.
+        {'image-path': '/tmp/base.dmg',
+         'shadow-path': '/Volumes/Inner/base.shadow',
+         'system-entities': [{'dev-entry': '/dev/disk4'}]},
+        {'image-path': '/tmp/other.dmg',
+         'system-entities': [{'dev-entry': '/dev/disk5'},
+                             {'dev-entry': '/dev/disk5s1',
+                              'mount-point': '/Volumes/Outer2'}]}]
+
+  def tearDown(self):
+    self.stubs.UnsetAll()
+
+  def sleep(self, delay):  # pylint: disable=g-bad-name
+    self.sleeps.append(delay)
+
+  def RunProcess(self, command, close_fds=False):
+    self.assertTrue(close_fds)
+    device = command[2]
+    if self.busy.get(device):
+      self.busy[device] -= 1
+      return '', 'hdiutil: couldn\'t unmount - Resource busy', 16
+    if device in self.errors:
+      return '', self.errors[device], 1
+    self.detached.append(device)
+    return '', '', 0
+
+  def testImageHosts(self):
+    self.assertEqual({0: set([1]), 1: set(), 2: set([0]), 3: set()},
+                     macdisk._ImageHosts(self.images))
+
+  def testDependencyOrder(self):
+    self.assertEqual([], macdisk.UnmountAllDiskImages())
+    self.assertEqual(4, len(self.detached))
+    order = self.detached.index
+    self.assertTrue(order('/dev/disk4') < order('/dev/disk3'))
+    self.assertTrue(order('/dev/disk3') < order('/dev/disk2'))
+
+  def testBusyRetried(self):
+    self.busy['/dev/disk5'] = 2
+    self.assertEqual([], macdisk.UnmountAllDiskImages())
+    self.assertTrue('/dev/disk5' in self.detached)
+    self.assertEqual([1.0, 2.0], self.sleeps)
+
+  def testFailureLeavesHoldersAttached(self):
+    self.busy['/dev/disk3'] = macdisk.DETACH_RETRIES + 1
+    failed = macdisk.UnmountAllDiskImages()
+    self.assertEqual(['/Volumes/Outer/inner.dmg', '/tmp/outer.dmg'], failed)
+    self.assertEqual(['/dev/disk4', '/dev/disk5'], sorted(self.detached))
+    self.assertEqual(macdisk.DETACH_RETRIES, len(self.sleeps))
+
+  def testErrorNotRetried(self):
+    self.errors['/dev/disk5'] = 'hdiutil: detach failed'
+    self.assertEqual(['/tmp/other.dmg'], macdisk.UnmountAllDiskImages())
+    self.assertEqual([], self.sleeps)
+
+
+class StorageSnapshotTest(basetest.TestCase):
+  """Test macdisk.StorageSnapshot."""
+
+  def setUp(self):
+    self.stubs = stubout.StubOutForTesting()
+    self.stubs.Set(macdisk, '_DictFromSubprocess', self.DictFromSubprocess)
+    self.commands = []
+    self.listing = {
+        'AllDisks': ['disk0', 'disk0s1', 'disk0s2', 'disk1', 'disk1s1',
+                     'disk2'],
+        'WholeDisks': ['disk0', 'disk1', 'disk2'],
+        'VolumesFromDisks': ['Macintosh HD', 'Some-Image']}
+    self.infos = {
+        'disk0': {'DeviceIdentifier': 'disk0', 'WholeDisk': True,
+                  'ParentWholeDisk': 'disk0', 'BusProtocol': 'SATA'},
+        'disk0s1': {'DeviceIdentifier': 'disk0s1', 'WholeDisk': False,
+                    'ParentWholeDisk': 'disk0', 'VolumeName': 'EFI',
+                    'BusProtocol': 'SATA'},
+        'disk0s2': {'DeviceIdentifier': 'disk0s2', 'WholeDisk': False,
+                    'ParentWholeDisk': 'disk0', 'BusProtocol': 'SATA',
+                    'VolumeName': 'Macintosh HD', 'MountPoint': '/',
+                    'VolumeUUID': 'UUID-HD'},
+        'disk1': {'DeviceIdentifier': 'disk1', 'WholeDisk': True,
+                  'ParentWholeDisk': 'disk1', 'BusProtocol': 'Disk Image'},
+        'disk1s1': {'DeviceIdentifier': 'disk1s1', 'WholeDisk': False,
+                    'ParentWholeDisk': 'disk1', 'BusProtocol': 'Disk Image',
+                    'VolumeName': 'Some-Image',
+                    'MountPoint': '/Volumes/Some-Image'}}
+    self.hdiutil_info = {
+        'images': [
+            {'image-path': '/tmp/Some-Image.dmg',
+             'system-entities': [
+                 {'dev-entry': '/dev/disk1'},
+                 {'dev-entry': '/dev/disk1s1',
+                  'mount-point': '/Volumes/Some-Image'}]}]}
+
+  def tearDown(self):
+    self.stubs.UnsetAll()
+
+  def DictFromSubprocess(self, command, stdin=None, close_fds=False):
+    self.assertEqual(None, stdin)
+    self.commands.append(command)
+    if command == ['/usr/sbin/diskutil', 'list', '-plist']:
+      return self.listing
+    if command == ['/usr/bin/hdiutil', 'info', '-plist']:
+      return self.hdiutil_info
+    self.assertEqual(['/usr/sbin/diskutil', 'info', '-plist'], command[:3])
+    # diskutil info runs on a thread pool.
+    self.assertTrue(close_fds)
+    if command[3] not in self.infos:
+      raise macdisk.MacDiskError('gone')
+    return self.infos[command[3]]
+
+  def testSnapshot(self):
+    """Test the snapshot links disks, volumes and images."""
+    snapshot = macdisk.StorageSnapshot()
+    # One list, one hdiutil info and one info per disk; disk2 went away.
+    self.assertEqual(8, len(self.commands))
+    self.assertEqual(['disk0', 'disk0s1', 'disk0s2', 'disk1', 'disk1s1'],
+                     [d.deviceid for d in snapshot.Partitions()])
+    self.assertEqual(['disk0', 'disk1'],
+                     [d.deviceid for d in snapshot.WholeDisks()])
+    self.assertEqual(['disk0s1', 'disk0s2'],
+                     [d.deviceid for d in snapshot.Partitions('disk0')])
+    self.assertEqual('disk0', snapshot.Parent('disk0s2').deviceid)
+    self.assertEqual(None, snapshot.Parent('disk0'))
+    self.assertEqual(['disk0s2', 'disk1s1'],
+                     [d.deviceid for d in snapshot.MountedVolumes()])
+    self.assertEqual('disk0s2', snapshot.ByMountPoint('/').deviceid)
+    self.assertEqual('disk0s2', snapshot.ByVolumeUUID('UUID-HD').deviceid)
+    self.assertEqual('disk1s1', snapshot.ByDeviceId('/dev/disk1s1').deviceid)
+    self.assertEqual(None, snapshot.ByDeviceId('disk2'))
+    self.assertTrue(snapshot.ByDeviceId('disk1').diskimage)
+    self.assertFalse(snapshot.ByDeviceId('disk0').diskimage)
+
+    images = snapshot.AttachedImages()
+    self.assertEqual(['/tmp/Some-Image.dmg'],
+                     [i['image-path'] for i in images])
+    self.assertEqual(['disk1', 'disk1s1'],
+                     [d.deviceid for d in images[0]['disks']])
+    self.assertEqual(images[0], snapshot.ImageOf('disk1s1'))
+    self.assertEqual(None, snapshot.ImageOf('disk0s2'))
+
+  def testModuleFunctions(self):
+    """Test WholeDisks and MountedVolumes list disks only once."""
+    self.assertEqual(['disk0', 'disk1'],
+                     [d.deviceid for d in macdisk.WholeDisks()])
+    self.assertEqual(1, self.commands.count(
+        ['/usr/sbin/diskutil', 'list', '-plist']))
+    self.assertEqual(['disk0s2', 'disk1s1'],
+                     [d.deviceid for d in macdisk.MountedVolumes()])
+    self.assertEqual(2, self.commands.count(
+        ['/usr/sbin/diskutil', 'list', '-plist']))
+    # MountedVolumes does not need hdiutil info.
+    self.assertEqual(0, self.commands.count(
+        ['/usr/bin/hdiutil', 'info', '-plist']))
+
+
+class DiskTest(mox.MoxTestBase):
+  """Test macdisk.Disk."""
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self.mox.StubOutWithMock(macdisk, '_DictFromSubprocess')
+    self.info = ['/usr/sbin/diskutil', 'info', '-plist', 'disk0s2']
+
+  def tearDown(self):
+    self.mox.UnsetStubs()
+
+  def testPartial(self):
+    """Test diskutil info only runs for attributes outside partial data."""
+    macdisk._DictFromSubprocess(self.info, close_fds=True).AndReturn(
+        {'DeviceIdentifier': 'disk0s2', 'MountPoint': '/',
+         'BusProtocol': 'SATA', 'TotalSize': 100})
+
+    self.mox.ReplayAll()
+    disk = macdisk.Disk('/dev/disk0s2',
+                        attributes={'MountPoint': '/Volumes/Old'},
+                        partial=True)
+    self.assertEqual('/Volumes/Old', disk.mountpoint)
+    self.assertTrue(disk.Mounted())
+    self.assertEqual(None, disk.refreshed)
+    self.assertTrue(disk.IsStale(3600))
+    self.assertEqual(100, disk.totalsize)
+    self.assertEqual('/', disk.mountpoint)
+    self.assertFalse(disk.diskimage)
+    self.assertFalse(disk.IsStale(3600))
+    self.assertRaises(AttributeError, getattr, disk, 'volumeuuid')
+    self.assertRaises(AttributeError, setattr, disk, 'other', 1)
     self.mox.VerifyAll()
 
+  def testRefreshClearsAttributes(self):
+    """Test Refresh drops attributes diskutil no longer reports."""
+    macdisk._DictFromSubprocess(
+        ['/usr/sbin/diskutil', 'list', '-plist'], close_fds=True).AndReturn(
+            {'AllDisks': ['disk0s2']})
+    macdisk._DictFromSubprocess(self.info, close_fds=True).AndReturn(
+        {'MountPoint': '/'})
+
+    self.mox.ReplayAll()
+    disk = macdisk.Disk('disk0s2', attributes={'MountPoint': '/Volumes/x',
+                                               'BusProtocol': 'Disk Image'})
+    self.assertTrue(disk.diskimage)
+    disk.Refresh()
+    self.assertEqual('/', disk.mountpoint)
+    self.assertFalse(disk.diskimage)
+    self.mox.VerifyAll()
+
+  def testPartitions(self):
+    """Test Partitions are made from diskutil list without diskutil info."""
+    macdisk._DictFromSubprocess(
+        ['/usr/sbin/diskutil', 'list', '-plist'], close_fds=True).AndReturn(
+            {'AllDisksAndPartitions': [
+                {'DeviceIdentifier': 'disk0',
+                 'Partitions': [{'DeviceIdentifier': 'disk0s1',
+                                 'VolumeName': 'EFI'},
+                                {'DeviceIdentifier': 'disk0s2',
+                                 'MountPoint': '/'}]},
+                {'DeviceIdentifier': 'disk1',
+                 'APFSVolumes': [{'DeviceIdentifier': 'disk1s1'}]}]})
+
+    self.mox.ReplayAll()
+    disk = macdisk.Disk('disk0', attributes={'WholeDisk': True})
+    partitions = disk.Partitions()
+    self.assertEqual(['disk0s1', 'disk0s2'],
+                     [p.deviceid for p in partitions])
+    self.assertEqual('/', partitions[1].mountpoint)
+    # Not mounted, which is known without diskutil info.
+    self.assertEqual('', partitions[0].mountpoint)
+    self.assertFalse(partitions[0].Mounted())
+    self.assertEqual('disk0', partitions[0].parentwholedisk)
+    self.assertFalse(partitions[0].wholedisk)
+    self.mox.VerifyAll()
+
+  def testCopyAndPickle(self):
+    """Test copies and unpickled Disks keep their attributes."""
+    self.mox.ReplayAll()
+    disk = macdisk.Disk('disk0s2', attributes={'MountPoint': '/'},
+                        partial=True)
+    for other in (copy.copy(disk),
+                  pickle.loads(pickle.dumps(disk, pickle.HIGHEST_PROTOCOL))):
+      self.assertEqual('disk0s2', other.deviceid)
+      self.assertEqual('/', other.mountpoint)
+    self.mox.VerifyAll()
+
+
+class FakeAsr(object):
+  """A fake asr process."""
+
+  def __init__(self, output, returncode):
+    self.stdout = StringIO.StringIO(output)
+    self.returncode = None
+    self._returncode = returncode
+
+  def wait(self):
+    self.returncode = self._returncode
+    return self.returncode
+
+
+class CloneTest(basetest.TestCase):
+  """Test macdisk.Clone and macdisk.CloneToTargets."""
+
+  def setUp(self):
+    self.stubs = stubout.StubOutForTesting()
+    self.stubs.Set(macdisk.subprocess, 'Popen', self.Popen)
+    self.commands = []
+    self.source = macdisk.Disk('disk1', attributes={
+        'DeviceIdentifier': 'disk1', 'TotalSize': 1000})
+    self.targets = [
+        macdisk.Disk(d, attributes={'DeviceIdentifier': d, 'MountPoint': ''})
+        for d in ('disk2', 'disk3')]
+
+  def tearDown(self):
+    self.stubs.UnsetAll()
+
+  def Popen(self, command, stdout=None, stderr=None, close_fds=False):
+    self.assertEqual(macdisk.subprocess.PIPE, stdout)
+    self.assertEqual(macdisk.subprocess.STDOUT, stderr)
+    self.assertTrue(close_fds)
+    self.commands.append(command)
+    if command[5] == '/dev/disk3':
+      return FakeAsr('XSTA\tstart\trestore\nasr: Couldn\'t restore\n', 1)
+    output = ('XSTA\tstart\trestore\nPPRG\t25\t100\nPPRG\t100\t100\n'
+              'XSTA\tfinish\trestore\n')
+    if '--noverify' not in command:
+      output += ('XSTA\tstart\tverify\nPPRG\t50\t100\n'
+                 'XSTA\tfinish\tverify\n')
+    return FakeAsr(output, 0)
+
+  def testCloneProgress(self):
+    """Test Clone reports progress from asr."""
+    reports = []
+    self.assertTrue(macdisk.Clone(
+        self.source, self.targets[0], verify=False,
+        progress=lambda *args: reports.append(args)))
+    self.assertEqual([['/usr/sbin/asr', 'restore', '--source', '/dev/disk1',
+                       '--target', '/dev/disk2', '--noprompt',
+                       '--puppetstrings', '--erase', '--noverify']],
+                     self.commands)
+    target = self.targets[0]
+    self.assertEqual([(target, 25.0, 250), (target, 100.0, 1000)],
+                     [r[:3] for r in reports])
+    self.assertEqual(['restore', 'restore'], [r[4] for r in reports])
+
+  def testCloneProgressPhases(self):
+    """Test Clone reports which phase each progress report belongs to."""
+    reports = []
+    macdisk.Clone(self.source, self.targets[0],
+                  progress=lambda *args: reports.append(args))
+    self.assertEqual([(25.0, 250, 'restore'), (100.0, 1000, 'restore'),
+                      (50.0, 500, 'verify')],
+                     [(r[1], r[2], r[4]) for r in reports])
+
+  def testCloneUnmountsWithoutInheritedFds(self):
+    """Test unmounting and refreshing a target close fds in the child."""
+    commands = []
+    def RunProcess(command, close_fds=False):
+      self.assertTrue(close_fds)
+      commands.append(command)
+      return '', '', 0
+    def DictFromSubprocess(command, stdin=None, close_fds=False):
+      self.assertEqual(None, stdin)
+      self.assertTrue(close_fds)
+      commands.append(command)
+      if command[1] == 'list':
+        return {'AllDisks': ['disk2']}
+      return {'DeviceIdentifier': 'disk2', 'MountPoint': ''}
+    self.stubs.Set(macdisk.gmacpyutil, 'RunProcess', RunProcess)
+    self.stubs.Set(macdisk, '_DictFromSubprocess', DictFromSubprocess)
+    target = macdisk.Disk('disk2', attributes={'DeviceIdentifier': 'disk2',
+                                               'MountPoint': '/Volumes/x',
+                                               'WholeDisk': False})
+    self.assertTrue(macdisk.Clone(self.source, target))
+    self.assertEqual(['diskutil', 'unmount', 'disk2'], commands[0])
+    self.assertFalse(target.Mounted())
+
+  def testCloneFailure(self):
+    """Test Clone raises MacDiskError with asr's output."""
+    try:
+      macdisk.Clone(self.source, self.targets[1])
+    except macdisk.MacDiskError, e:
+      self.assertTrue("Couldn't restore" in str(e))
+    else:
+      self.fail('MacDiskError not raised')
+    self.assertRaises(macdisk.MacDiskError, macdisk.Clone, 'source',
+                      self.targets[0])
+
+  def testCloneToTargets(self):
+    """Test CloneToTargets restores every target and reports each result."""
+    results = macdisk.CloneToTargets(self.source, self.targets)
+    self.assertEqual(['disk2', 'disk3'], sorted(results))
+    self.assertEqual(None, results['disk2'])
+    self.assertTrue(isinstance(results['disk3'], macdisk.MacDiskError))
+    self.assertEqual(2, len(self.commands))
+    self.assertEqual({}, macdisk.CloneToTargets(self.source, []))
+
+  def testAsrProgress(self):
+    """Test _AsrProgress."""
+    self.assertEqual(50.0, macdisk._AsrProgress('PPRG\t1\t2'))
+    self.assertEqual(7.0, macdisk._AsrProgress('PPRG 7'))
+    self.assertEqual(None, macdisk._AsrProgress('PINF\t1\t2'))
+    self.assertEqual(None, macdisk._AsrProgress('PPRG\tx'))
+    self.assertEqual(None, macdisk._AsrProgress(''))
+
+  def testAsrPhase(self):
+    """Test _AsrPhase."""
+    self.assertEqual('verify', macdisk._AsrPhase('XSTA\tstart\tverify'))
+    self.assertEqual(None, macdisk._AsrPhase('XSTA\tfinish\tverify'))
+    self.assertEqual(None, macdisk._AsrPhase('PPRG\t1\t2'))
+
+
+class ImageCacheTest(basetest.TestCase):
+  """Test macdisk.ImageCache."""
+
+  def setUp(self):
+    self.stubs = stubout.StubOutForTesting()
+    self.tempdir = tempfile.mkdtemp()
+    self.cache = macdisk.ImageCache(os.path.join(self.tempdir, 'cache'))
+    self.imagepath = os.path.join(self.tempdir, 'test.dmg')
+    self.WriteImage('a' * 300000)
+
+  def tearDown(self):
+    self.stubs.UnsetAll()
+    shutil.rmtree(self.tempdir)
+
+  def WriteImage(self, data, mtime=1400000000):
+    with open(self.imagepath, 'wb') as image_file:
+      image_file.write(data)
+    os.utime(self.imagepath, (mtime, mtime))
+
+  def testVerified(self):
+    self.assertFalse(self.cache.IsVerified(self.imagepath))
+    self.cache.SetVerified(self.imagepath)
+    self.assertTrue(self.cache.IsVerified(self.imagepath))
+    self.assertTrue(macdisk.ImageCache(self.cache.cache_dir).IsVerified(
+        self.imagepath))
+
+  def testConcurrentSaves(self):
+    threads = [threading.Thread(target=self.cache.SetVerified,
+                                args=(self.imagepath,)) for _ in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertTrue(self.cache.IsVerified(self.imagepath))
+    self.assertEqual(1, len(os.listdir(self.cache.cache_dir)))
+
+  def testSaveFailureLeavesNoTempFile(self):
+    def FailingWritePlist(unused_entry, unused_cache_file):
+      raise IOError('disk full')
+    self.stubs.Set(macdisk.plistlib, 'writePlist', FailingWritePlist)
+    self.cache.SetVerified(self.imagepath)
+    self.assertEqual([], os.listdir(self.cache.cache_dir))
+
+  def testChangedImage(self):
+    self.cache.SetVerified(self.imagepath)
+    self.WriteImage('a' * 300000, mtime=1400000001)
+    self.assertFalse(self.cache.IsVerified(self.imagepath))
+
+  def testRewrittenInPlace(self):
+    self.cache.SetVerified(self.imagepath)
+    self.WriteImage('b' + 'a' * 299999)
+    self.assertFalse(self.cache.IsVerified(self.imagepath))
+
+  def testImageInfo(self):
+    self.assertEqual(None, self.cache.ImageInfo(self.imagepath))
+    self.cache.SetVerified(self.imagepath)
+    self.cache.SetImageInfo(self.imagepath, {'Format': 'UDZO'})
+    self.assertEqual({'Format': 'UDZO'}, self.cache.ImageInfo(self.imagepath))
+    self.assertTrue(self.cache.IsVerified(self.imagepath))
+
+  def testMissingImage(self):
+    self.cache.SetVerified('/nonexistent/test.dmg')
+    self.assertFalse(self.cache.IsVerified('/nonexistent/test.dmg'))
+
+  def testSharedCacheDirIgnored(self):
+    os.makedirs(self.cache.cache_dir)
+    os.chmod(self.cache.cache_dir, 0777)
+    self.cache.SetVerified(self.imagepath)
+    self.assertEqual([], os.listdir(self.cache.cache_dir))
+    self.assertFalse(self.cache.IsVerified(self.imagepath))
+
+  def testDictFromHdiutilImageInfo(self):
+    commands = []
+
+    def DictFromSubprocess(command):
+      commands.append(command)
+      return {'Format': 'UDZO'}
+
+    self.stubs.Set(macdisk, '_DictFromSubprocess', DictFromSubprocess)
+    self.stubs.Set(macdisk, 'image_cache', self.cache)
+    for _ in range(2):
+      self.assertEqual({'Format': 'UDZO'},
+                       macdisk._DictFromHdiutilImageInfo(self.imagepath))
+    self.assertEqual(1, len(commands))
+
+
+class FakePoolDisk(object):
+
+  def __init__(self, deviceid, mountpoint=None, wholedisk=False):
+    self.deviceid = deviceid
+    self.mountpoint = mountpoint
+    self.wholedisk = wholedisk
+
+  def Mounted(self):
+    return self.mountpoint is not None
+
+
+class ImagePoolTest(basetest.TestCase):
+  """Test macdisk.ImagePool."""
+
+  def setUp(self):
+    self.stubs = stubout.StubOutForTesting()
+    self.now = 1000.0
+    self.attaches = []
+    self.detached = []
+    self.mounted = set()
+    self.stubs.Set(macdisk, 'time', self)
+    self.stubs.Set(macdisk, 'Image', self.Image)
+    self.stubs.Set(macdisk, '_DetachDevice', self.DetachDevice)
+    self.stubs.Set(macdisk.os.path, 'ismount', self.mounted.__contains__)
+    self.stubs.Set(macdisk.ImagePool, '_Reap', lambda unused_self: None)
+    self.pool = macdisk.ImagePool(idle_timeout=60, max_attached=2)
+
+  def tearDown(self):
+    self.stubs.UnsetAll()
+
+  def time(self):  # pylint: disable=g-bad-name
+    return self.now
+
+  def Image(self, imagepath):
+    test = self
+
+    class FakeImage(object):
+
+      def Attach(self, verify=True, browse=True):
+        test.attaches.append((imagepath, verify, browse))
+        n = len(test.attaches)
+        mountpoint = '/Volumes/%s-%d' % (os.path.basename(imagepath), n)
+        test.mounted.add(mountpoint)
+        return [FakePoolDisk('disk%d' % n, wholedisk=True),
+                FakePoolDisk('disk%ds1' % n, mountpoint=mountpoint)]
+
+    return FakeImage()
+
+  def DetachDevice(self, deviceid):
+    self.detached.append(deviceid)
+
+  def testAttachedOnce(self):
+    self.assertEqual(['/Volumes/a.dmg-1'], self.pool.Acquire('/a.dmg'))
+    self.assertEqual(['/Volumes/a.dmg-1'], self.pool.Acquire('/a.dmg'))
+    self.pool.Release('/a.dmg')
+    self.pool.Release('/a.dmg')
+    with self.pool.Mounted('/a.dmg') as mountpoints:
+      self.assertEqual(['/Volumes/a.dmg-1'], mountpoints)
+    self.assertEqual([('/a.dmg', True, False)], self.attaches)
+    self.assertEqual([], self.detached)
+    self.assertEqual(['/a.dmg'], self.pool.Attached())
+
+  def testReleaseNotInUse(self):
+    self.assertRaises(macdisk.MacDiskError, self.pool.Release, '/a.dmg')
+
+  def testEvictIdle(self):
+    self.pool.Acquire('/a.dmg')
+    self.pool.Acquire('/b.dmg')
+    self.pool.Release('/a.dmg')
+    self.now += 30
+    self.assertEqual(1060.0, self.pool.Evict())
+    self.now += 30
+    self.assertEqual(None, self.pool.Evict())
+    self.assertEqual(['disk1'], self.detached)
+    self.assertEqual(['/b.dmg'], self.pool.Attached())
+
+  def testMaxAttached(self):
+    for imagepath in ('/a.dmg', '/b.dmg'):
+      with self.pool.Mounted(imagepath):
+        self.now += 1
+    self.pool.Acquire('/c.dmg')
+    self.assertEqual(['disk1'], self.detached)
+    self.assertEqual(['/b.dmg', '/c.dmg'], self.pool.Attached())
+
+  def testInUseNotEvicted(self):
+    self.pool.Acquire('/a.dmg')
+    self.pool.Acquire('/b.dmg')
+    self.pool.Acquire('/c.dmg')
+    self.now += 600
+    self.pool.Evict()
+    self.assertEqual([], self.detached)
+    self.assertEqual(['/a.dmg', '/b.dmg', '/c.dmg'], self.pool.Attached())
+
+  def testDetachedBehindOurBack(self):
+    with self.pool.Mounted('/a.dmg'):
+      pass
+    self.mounted.clear()
+    self.assertEqual(['/Volumes/a.dmg-2'], self.pool.Acquire('/a.dmg'))
+
+  def testClose(self):
+    with self.pool:
+      self.pool.Acquire('/a.dmg')
+      with self.pool.Mounted('/b.dmg'):
+        pass
+    self.assertEqual(['disk1', 'disk2'], self.detached)
+    self.assertEqual([], self.pool.Attached())
+
 
 class ImageTest(mox.MoxTestBase):
   """Test macdisk.Image class."""
@@ -155,6 +750,47 @@ class ImageTest(mox.MoxTestBase):
     self.assertEqual(set(disks), set(['disk1', 'disk1s1', 'disk1s2']))
     self.mox.VerifyAll()
 
+  def testAttachVerifiedBefore(self):
+    """Test Attach skips verification of a cached, verified image."""
+    self.mox.StubOutWithMock(macdisk, '_DictFromSubprocess')
+    self.mox.StubOutWithMock(macdisk.Image, 'Refresh')
+    self.mox.StubOutWithMock(macdisk, 'Disk')
+    cache = self.mox.CreateMock(macdisk.ImageCache)
+    self.stubs.Set(macdisk, 'image_cache', cache)
+
+    command = ['hdiutil', 'attach', '-plist', '-noverify', 'imagepath']
+    plist = {'system-entities': [{'dev-entry': '/dev/disk1'}]}
+    macdisk.Image.Refresh().AndReturn(None)
+    cache.IsVerified('imagepath').AndReturn(True)
+    macdisk._DictFromSubprocess(command, stdin=None).AndReturn(plist)
+    macdisk.Disk('disk1').AndReturn('disk1')
+
+    self.mox.ReplayAll()
+    img = macdisk.Image('imagepath')
+    self.assertEqual(['disk1'], img.Attach())
+    self.mox.VerifyAll()
+
+  def testAttachRecordsVerification(self):
+    """Test Attach records a verified attach in the cache."""
+    self.mox.StubOutWithMock(macdisk, '_DictFromSubprocess')
+    self.mox.StubOutWithMock(macdisk.Image, 'Refresh')
+    self.mox.StubOutWithMock(macdisk, 'Disk')
+    cache = self.mox.CreateMock(macdisk.ImageCache)
+    self.stubs.Set(macdisk, 'image_cache', cache)
+
+    command = ['hdiutil', 'attach', '-plist', 'imagepath']
+    plist = {'system-entities': [{'dev-entry': '/dev/disk1'}]}
+    macdisk.Image.Refresh().AndReturn(None)
+    cache.IsVerified('imagepath').AndReturn(False)
+    macdisk._DictFromSubprocess(command, stdin=None).AndReturn(plist)
+    cache.SetVerified('imagepath')
+    macdisk.Disk('disk1').AndReturn('disk1')
+
+    self.mox.ReplayAll()
+    img = macdisk.Image('imagepath')
+    self.assertEqual(['disk1'], img.Attach())
+    self.mox.VerifyAll()
+
   def testDetach(self):
     """Test Detach."""
     force = False
@@ -232,6 +232,10 @@ class NetworkProfile(Profile):
     """
     try:
       cert = certs.Certificate(certificate)
+      # Certificates are parsed lazily, so read attributes while errors are
+      # still being caught.
+      subject_cn = cert.subject_cn
+      osx_fingerprint = cert.osx_fingerprint
 
       pkcs12 = crypto.PKCS12Type()
       pkcs12.set_certificate(crypto.load_certificate(
@@ -243,12 +247,12 @@ class NetworkProfile(Profile):
 
     payload = {PAYLOADKEYS_IDENTIFIER: self._GenerateID('machine_cert'),
                PAYLOADKEYS_TYPE: 'com.apple.security.pkcs12',
-               PAYLOADKEYS_DISPLAYNAME: cert.subject_cn,
-               'Password': cert.osx_fingerprint}
+               PAYLOADKEYS_DISPLAYNAME: subject_cn,
+               'Password': osx_fingerprint}
 
     try:
       payload[PAYLOADKEYS_CONTENT] = plistlib.Data(
-          pkcs12.export(cert.osx_fingerprint))
+          pkcs12.export(osx_fingerprint))
     except crypto.Error as e:
       raise CertificateError(e)
 
@@ -268,12 +272,14 @@ class NetworkProfile(Profile):
     """
     try:
       cert = certs.Certificate(certificate)
+      subject_cn = cert.subject_cn
+      osx_fingerprint = cert.osx_fingerprint
     except certs.CertError as e:
       raise CertificateError(e)
 
-    payload = {PAYLOADKEYS_IDENTIFIER: self._GenerateID(cert.osx_fingerprint),
+    payload = {PAYLOADKEYS_IDENTIFIER: self._GenerateID(osx_fingerprint),
                PAYLOADKEYS_TYPE: 'com.apple.security.pkcs1',
-               PAYLOADKEYS_DISPLAYNAME: cert.subject_cn,
+               PAYLOADKEYS_DISPLAYNAME: subject_cn,
                PAYLOADKEYS_CONTENT: plistlib.Data(certificate)}
 
     # Validate payload to generate its UUID
@@ -6,9 +6,17 @@ and
 http://code.google.com/p/pymacadmin/source/browse/examples/crankd/socks-proxy/ProxyManager.py
 """
 
+import datetime
+import fcntl
+import json
 import logging
 import os
+import plistlib
+import re
 import struct
+import tempfile
+import time
+import xml.parsers.expat
 
 # pylint: disable=g-import-not-at-top
 from . import gmacpyutil
@@ -43,6 +51,22 @@ except ImportError:
 
 CORP_PROXY = defaults.CORP_PROXY
 NI_PLIST = '/Library/Preferences/SystemConfiguration/NetworkInterfaces.plist'
+SYSTEM_PROFILER_CACHE_DIR = defaults.SYSTEM_PROFILER_CACHE_DIR
+# Kept in the system_profiler cache until the next reboot.
+UNTIL_REBOOT = 'boot'
+# How long system_profiler output of each type stays in the on-disk cache, in
+# seconds or UNTIL_REBOOT. Types not listed are only cached in-process.
+SYSTEM_PROFILER_TTLS = {
+    'SPHardwareDataType': UNTIL_REBOOT,
+    'SPSerialATADataType': UNTIL_REBOOT,
+    'SPNVMeDataType': UNTIL_REBOOT,
+    'SPHardwareRAIDDataType': UNTIL_REBOOT,
+    'SPParallelATADataType': UNTIL_REBOOT,
+    'SPStorageDataType': 3600,
+    'SPUSBDataType': 300,
+}
+# Bytes of system_profiler output parsed at a time by SystemProfiler.Extract.
+SYSTEM_PROFILER_READ_SIZE = 65536
 
 
 class SysconfigError(Exception):
@@ -236,26 +260,525 @@ class SCPreferences(object):
       self.SetPathValue(u'/System/System/HostName', hostname)
 
 
+_boot_time = None
+
+
+def _BootTime():
+  """Returns the time the machine booted, or None if it is not known."""
+  global _boot_time  # pylint: disable=global-statement
+  if _boot_time is None:
+    stdout, unused_stderr, returncode = gmacpyutil.RunProcess(
+        ['/usr/sbin/sysctl', '-n', 'kern.boottime'])
+    match = re.search(r'sec = (\d+)', stdout or '')
+    if returncode == 0 and match:
+      _boot_time = int(match.group(1))
+  return _boot_time
+
+
+class SystemProfilerCache(object):
+  """On-disk cache of system_profiler output, shared between processes.
+
+  The XML output of each data type is kept in its own file in cache_dir, for
+  as long as SYSTEM_PROFILER_TTLS allows. When an entry is missing or stale,
+  the first process to notice takes a lock on the type and runs
+  system_profiler; others wait for the lock and then use what it wrote
+  instead of running system_profiler too. The cache is only used if its
+  directory belongs to the current user and nobody else can write to it.
+
+  Attributes:
+    cache_dir: str, path to the cache directory
+    ttls: dict, data type to seconds or UNTIL_REBOOT
+  """
+
+  VERSION = 1
+
+  def __init__(self, cache_dir=SYSTEM_PROFILER_CACHE_DIR, ttls=None):
+    self.cache_dir = os.path.expanduser(cache_dir)
+    if ttls is None:
+      ttls = SYSTEM_PROFILER_TTLS
+    self.ttls = ttls
+
+  def _CheckDir(self):
+    """Creates the cache directory, or checks that it is private.
+
+    Returns:
+      bool, whether the cache directory can be used
+    """
+    try:
+      if not os.path.isdir(self.cache_dir):
+        os.makedirs(self.cache_dir, 0700)
+      stat = os.lstat(self.cache_dir)
+    except OSError, e:
+      logging.debug('Cannot create system_profiler cache %s: %s',
+                    self.cache_dir, e)
+      return False
+    if stat.st_uid != os.geteuid() or stat.st_mode & 0022:
+      logging.debug('system_profiler cache %s is not private, not using it.',
+                    self.cache_dir)
+      return False
+    return True
+
+  def _Path(self, sp_type, detail_level, suffix):
+    name = sp_type
+    if detail_level:
+      name = '%s.%s' % (sp_type, detail_level)
+    return os.path.join(self.cache_dir, '%s.%s' % (name, suffix))
+
+  def _Cached(self, sp_type):
+    """Whether output of a type is cached on disk."""
+    return bool(self.ttls.get(sp_type)) and self._CheckDir()
+
+  def _Read(self, sp_type, detail_level):
+    """Returns the cached output for a type, or None if missing or stale."""
+    try:
+      with open(self._Path(sp_type, detail_level, 'xml')) as cache_file:
+        header = json.loads(cache_file.readline())
+        sp_xml = cache_file.read()
+    except (IOError, ValueError):
+      return None
+    if header.get('version') != self.VERSION:
+      return None
+    ttl = self.ttls.get(sp_type)
+    if ttl == UNTIL_REBOOT:
+      boot_time = _BootTime()
+      if boot_time is None or header.get('boot_time') != boot_time:
+        return None
+    elif time.time() - header.get('created', 0) >= ttl:
+      return None
+    return sp_xml
+
+  def _Write(self, sp_type, detail_level, sp_xml):
+    """Atomically writes the output for a type; failures are only logged."""
+    temp_path = None
+    try:
+      fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.cache')
+      with os.fdopen(fd, 'w') as cache_file:
+        cache_file.write(json.dumps({'version': self.VERSION,
+                                     'created': time.time(),
+                                     'boot_time': _BootTime()}) + '\n')
+        cache_file.write(sp_xml)
+      os.rename(temp_path, self._Path(sp_type, detail_level, 'xml'))
+    except (IOError, OSError), e:
+      logging.debug('Unable to save system_profiler cache for %s: %s',
+                    sp_type, e)
+      if temp_path and os.path.exists(temp_path):
+        os.remove(temp_path)
+
+  def Read(self, sp_type, detail_level=None):
+    """Returns the cached output for a type, or None if there is none.
+
+    Args:
+      sp_type: str, system_profiler data type
+      detail_level: str, system_profiler -detailLevel, or None for default
+    Returns:
+      str, the XML output, or None
+    """
+    if not self._Cached(sp_type):
+      return None
+    return self._Read(sp_type, detail_level)
+
+  def Write(self, sp_type, sp_xml, detail_level=None):
+    """Stores the output for a type, if that type is cached on disk."""
+    if self._Cached(sp_type):
+      self._Write(sp_type, detail_level, sp_xml)
+
+  def Get(self, sp_type, fetch, detail_level=None):
+    """Returns the output for a type, from the cache or by calling fetch.
+
+    Args:
+      sp_type: str, system_profiler data type
+      fetch: callable taking sp_type and returning its XML output
+      detail_level: str, system_profiler -detailLevel, or None for default
+    Returns:
+      str, the XML output
+    Raises:
+      SystemProfilerError: fetch failed
+    """
+    if not self._Cached(sp_type):
+      return fetch(sp_type)
+    sp_xml = self._Read(sp_type, detail_level)
+    if sp_xml is not None:
+      return sp_xml
+    try:
+      lock_file = open(self._Path(sp_type, detail_level, 'lock'), 'a')
+    except IOError:
+      return fetch(sp_type)
+    try:
+      fcntl.flock(lock_file, fcntl.LOCK_EX)
+      # Another process may have refreshed it while we waited for the lock.
+      sp_xml = self._Read(sp_type, detail_level)
+      if sp_xml is None:
+        sp_xml = fetch(sp_type)
+        self._Write(sp_type, detail_level, sp_xml)
+      return sp_xml
+    finally:
+      lock_file.close()
+
+  def Invalidate(self, sp_type, detail_level=None):
+    """Removes the cached output for a type."""
+    try:
+      os.remove(self._Path(sp_type, detail_level, 'xml'))
+    except OSError:
+      pass
+
+
+class SystemProfilerExtractor(object):
+  """Pulls selected values out of system_profiler XML as it is parsed.
+
+  A path names a data type followed by dict keys and array indexes, with *
+  matching any key or index, e.g. 'SPHardwareDataType/_items/*/platform_UUID'.
+  Only the values on those paths are built; everything else is skipped as
+  it goes by, so memory use does not grow with the size of the output.
+
+  Feed output in chunks of any size and call Close at the end of each
+  document; several documents can be parsed one after another.
+
+  Attributes:
+    paths: list of str, the paths being extracted
+    results: dict, each path to the list of values found on it, in document
+             order
+  """
+
+  SCALARS = frozenset(['string', 'integer', 'real', 'date', 'data', 'true',
+                       'false'])
+
+  def __init__(self, paths):
+    self.paths = list(paths)
+    self.results = dict((path, []) for path in self.paths)
+    self._patterns = [path.split('/') for path in self.paths]
+    self._parser = None
+
+  def _Reset(self):
+    self._parser = xml.parsers.expat.ParserCreate()
+    self._parser.buffer_text = True
+    self._parser.StartElementHandler = self._Start
+    self._parser.EndElementHandler = self._End
+    self._parser.CharacterDataHandler = self._Text
+    # One frame per open value element; the first is the top-level array and
+    # the second the dict of the data type being parsed.
+    self._stack = []
+    self._skip = 0
+    self._text = []
+
+  @staticmethod
+  def _Str(text):
+    """Returns ASCII text as str, like plistlib does."""
+    try:
+      return text.encode('ascii')
+    except UnicodeError:
+      return text
+
+  def _Scalar(self, tag, text):
+    if tag == 'string':
+      return self._Str(text)
+    elif tag == 'integer':
+      return int(text)
+    elif tag == 'real':
+      return float(text)
+    elif tag == 'date':
+      return datetime.datetime.strptime(text, '%Y-%m-%dT%H:%M:%SZ')
+    elif tag == 'data':
+      return plistlib.Data.fromBase64(text)
+    return tag == 'true'
+
+  def _Start(self, tag, unused_attrs):
+    """Pushes a frame for a value, or starts skipping it if not wanted."""
+    if self._skip:
+      self._skip += 1
+      return
+    if tag == 'plist':
+      return
+    self._text = []
+    if tag == 'key':
+      return
+    if not self._stack:
+      self._stack.append({'tag': tag, 'alive': [], 'hits': [], 'key': None,
+                          'index': 0, 'build': False})
+      return
+
+    parent = self._stack[-1]
+    if parent['tag'] == 'dict':
+      component = parent['key']
+    else:
+      component = str(parent['index'])
+      parent['index'] += 1
+    if len(self._stack) == 1:
+      # A data type; which one is only known once its _dataType is read.
+      alive = [(i, 0) for i in xrange(len(self._patterns))]
+      component = '*'
+    else:
+      alive = parent['alive']
+    frame = {'tag': tag, 'alive': [], 'hits': [], 'key': None, 'index': 0,
+             'matches': [], 'data_type': None}
+    for i, pos in alive:
+      if component == '*' or self._patterns[i][pos] in ('*', component):
+        if pos + 1 == len(self._patterns[i]):
+          frame['hits'].append(i)
+        else:
+          frame['alive'].append((i, pos + 1))
+    frame['build'] = parent['build'] or bool(frame['hits'])
+    frame['is_data_type'] = (len(self._stack) == 2 and
+                             component == '_dataType')
+
+    if tag in self.SCALARS:
+      wanted = frame['build'] or frame['is_data_type']
+    else:
+      wanted = frame['build'] or frame['alive']
+    if not wanted:
+      self._skip = 1
+      return
+    if frame['build'] and tag == 'dict':
+      frame['value'] = {}
+    elif frame['build'] and tag == 'array':
+      frame['value'] = []
+    self._stack.append(frame)
+
+  def _End(self, tag):
+    """Pops a value, storing it in its parent and the results as needed."""
+    if self._skip:
+      self._skip -= 1
+      return
+    if tag == 'plist':
+      return
+    if tag == 'key':
+      self._stack[-1]['key'] = self._Str(''.join(self._text))
+      return
+    frame = self._stack.pop()
+    if not self._stack:
+      return
+    if tag in self.SCALARS:
+      value = self._Scalar(tag, ''.join(self._text))
+    else:
+      value = frame.get('value')
+
+    parent = self._stack[-1]
+    if frame['is_data_type']:
+      parent['data_type'] = value
+    if parent['build']:
+      if parent['tag'] == 'dict':
+        parent['value'][parent['key']] = value
+      else:
+        parent['value'].append(value)
+    if len(self._stack) == 1:
+      data_type = frame
+    else:
+      data_type = self._stack[1]
+    for i in frame['hits']:
+      data_type['matches'].append((i, value))
+    if frame is data_type:
+      for i, value in frame['matches']:
+        if self._patterns[i][0] == frame['data_type']:
+          self.results[self.paths[i]].append(value)
+
+  def _Text(self, data):
+    if not self._skip:
+      self._text.append(data)
+
+  def Feed(self, data):
+    """Parses the next chunk of a document.
+
+    Args:
+      data: str, XML output of system_profiler
+    Raises:
+      xml.parsers.expat.ExpatError: the output is not well formed
+    """
+    if self._parser is None:
+      self._Reset()
+    self._parser.Parse(data, False)
+
+  def Close(self):
+    """Finishes the current document.
+
+    Returns:
+      dict, the results so far
+    Raises:
+      xml.parsers.expat.ExpatError: the document is incomplete
+    """
+    if self._parser is None:
+      self._Reset()
+    try:
+      self._parser.Parse('', True)
+    finally:
+      self._parser = None
+    return self.results
+
+
 class SystemProfiler(object):
-  """Utility Class for parsing system_profiler data."""
+  """Utility Class for parsing system_profiler data.
+
+  Output is cached in-process in _cache, and across processes in disk_cache;
+  set disk_cache to None to always run system_profiler in a new process.
+  """
   _cache = {}
+  _extracted = {}
+  disk_cache = SystemProfilerCache()
+
+  @staticmethod
+  def _Argv(sp_type, detail_level):
+    argv = ['/usr/sbin/system_profiler', '-XML']
+    if detail_level:
+      argv.extend(['-detailLevel', detail_level])
+    if isinstance(sp_type, list):
+      argv.extend(sp_type)
+    else:
+      argv.append(sp_type)
+    return argv
 
-  def _GetSystemProfilerOutput(self, sp_type):
+  def _GetSystemProfilerOutput(self, sp_type, detail_level=None):
+    """Runs system_profiler for one data type, or a list of them."""
     logging.debug('Getting system_profiler output for %s', sp_type)
-    argv = ['/usr/sbin/system_profiler', '-XML', sp_type]
+    argv = self._Argv(sp_type, detail_level)
     stdout, unused_stderr, returncode = gmacpyutil.RunProcess(argv)
     if returncode is not 0:
       raise SystemProfilerError('Could not run %s' % argv)
     else:
       return stdout
 
-  def _GetSystemProfile(self, sp_type):
+  @staticmethod
+  def _CacheKey(sp_type, detail_level):
+    if detail_level:
+      return '%s.%s' % (sp_type, detail_level)
+    return sp_type
+
+  def _GetSystemProfile(self, sp_type, detail_level=None):
     # pylint: disable=global-statement
-    if sp_type not in self._cache:
-      logging.debug('%s not cached', sp_type)
-      sp_xml = self._GetSystemProfilerOutput(sp_type)
-      self._cache[sp_type] = NSString.stringWithString_(sp_xml).propertyList()
-    return self._cache[sp_type]
+    key = self._CacheKey(sp_type, detail_level)
+    if key not in self._cache:
+      logging.debug('%s not cached', key)
+      fetch = lambda sp_type: self._GetSystemProfilerOutput(
+          sp_type, detail_level=detail_level)
+      if self.disk_cache is not None:
+        sp_xml = self.disk_cache.Get(sp_type, fetch, detail_level=detail_level)
+      else:
+        sp_xml = fetch(sp_type)
+      self._cache[key] = NSString.stringWithString_(sp_xml).propertyList()
+    return self._cache[key]
+
+  def Prefetch(self, sp_types, detail_level='mini'):
+    """Fetches several data types with one run of system_profiler.
+
+    Types already cached, in-process or on disk, are not fetched again. The
+    output is split into one entry per type, so later lookups of each type
+    at the same detail level are served from the caches. Note that the mini
+    detail level leaves out personal information such as serial numbers.
+
+    Args:
+      sp_types: list of system_profiler data types
+      detail_level: str, system_profiler -detailLevel, or None for default
+    Raises:
+      SystemProfilerError: system_profiler failed, or its output could not be
+                           split by type
+    """
+    missing = []
+    for sp_type in sp_types:
+      key = self._CacheKey(sp_type, detail_level)
+      if key in self._cache or sp_type in missing:
+        continue
+      sp_xml = None
+      if self.disk_cache is not None:
+        sp_xml = self.disk_cache.Read(sp_type, detail_level=detail_level)
+      if sp_xml is None:
+        missing.append(sp_type)
+      else:
+        self._cache[key] = NSString.stringWithString_(sp_xml).propertyList()
+    if not missing:
+      return
+
+    sp_xml = self._GetSystemProfilerOutput(missing, detail_level=detail_level)
+    try:
+      by_type = dict((data.get('_dataType'), data)
+                     for data in plistlib.readPlistFromString(sp_xml))
+    except (xml.parsers.expat.ExpatError, AttributeError, TypeError), e:
+      raise SystemProfilerError('Cannot split system_profiler output: %s' % e)
+    for sp_type in missing:
+      # Types this machine has nothing for are cached as empty.
+      type_data = [by_type[sp_type]] if sp_type in by_type else []
+      type_xml = plistlib.writePlistToString(type_data)
+      if self.disk_cache is not None:
+        self.disk_cache.Write(sp_type, type_xml, detail_level=detail_level)
+      self._cache[self._CacheKey(sp_type, detail_level)] = (
+          NSString.stringWithString_(type_xml).propertyList())
+
+  def _StreamSystemProfilerOutput(self, sp_types, detail_level, extractor):
+    """Runs system_profiler, feeding its output to extractor as it arrives."""
+    logging.debug('Streaming system_profiler output for %s', sp_types)
+    argv = self._Argv(sp_types, detail_level)
+    task = gmacpyutil.RunProcessInBackground(argv)
+    task.stdin.close()
+    stderr = gmacpyutil.ReadInBackground(task.stderr)
+    try:
+      for chunk in iter(
+          lambda: task.stdout.read(SYSTEM_PROFILER_READ_SIZE), ''):
+        extractor.Feed(chunk)
+    except xml.parsers.expat.ExpatError, e:
+      task.kill()
+      task.wait()
+      raise SystemProfilerError('Cannot parse system_profiler output: %s' % e)
+    stderr()
+    if task.wait() != 0:
+      raise SystemProfilerError('Could not run %s' % argv)
+    try:
+      extractor.Close()
+    except xml.parsers.expat.ExpatError, e:
+      raise SystemProfilerError('Cannot parse system_profiler output: %s' % e)
+
+  def Extract(self, paths, detail_level=None):
+    """Returns only the values at the given paths of system_profiler output.
+
+    Unlike _GetSystemProfile, the output is never turned into a whole
+    property list: values are picked out while it is read, and only they are
+    kept. Types with output in disk_cache are read from there; the others
+    are fetched with a single run of system_profiler.
+
+    Args:
+      paths: list of str, each a data type followed by dict keys and array
+             indexes, with * matching any key or index, e.g.
+             'SPHardwareDataType/_items/*/platform_UUID'
+      detail_level: str, system_profiler -detailLevel, or None for default
+    Returns:
+      dict, each path to the list of values found on it, in document order
+    Raises:
+      SystemProfilerError: system_profiler failed, or its output could not be
+                           parsed
+    """
+    results = {}
+    wanted = []
+    for path in paths:
+      if (path, detail_level) in self._extracted:
+        results[path] = self._extracted[(path, detail_level)]
+      elif path not in wanted:
+        wanted.append(path)
+    if not wanted:
+      return results
+
+    sp_types = []
+    for path in wanted:
+      sp_type = path.split('/', 1)[0]
+      if sp_type not in sp_types:
+        sp_types.append(sp_type)
+
+    extractor = SystemProfilerExtractor(wanted)
+    missing = []
+    for sp_type in sp_types:
+      sp_xml = None
+      if self.disk_cache is not None:
+        sp_xml = self.disk_cache.Read(sp_type, detail_level=detail_level)
+      if sp_xml is None:
+        missing.append(sp_type)
+        continue
+      try:
+        extractor.Feed(sp_xml)
+        extractor.Close()
+      except xml.parsers.expat.ExpatError, e:
+        raise SystemProfilerError('Cannot parse cached %s output: %s' %
+                                  (sp_type, e))
+    if missing:
+      self._StreamSystemProfilerOutput(missing, detail_level, extractor)
+
+    for path in wanted:
+      self._extracted[(path, detail_level)] = extractor.results[path]
+      results[path] = extractor.results[path]
+    return results
 
   def GetMBSerialNumber(self):
     """Retrieves the Mainboard serial number.
@@ -314,6 +837,9 @@ class SystemProfiler(object):
     # the order is important so we prefer SATA, NVMe, RAID then finally PATA.
     sp_types = ['SPSerialATADataType', 'SPNVMeDataType',
                 'SPHardwareRAIDDataType', 'SPParallelATADataType']
+    # One system_profiler run for all of them; serial numbers need the
+    # default detail level.
+    self.Prefetch(sp_types, detail_level=None)
     for sp_type in sp_types:
       for data in self._GetSystemProfile(sp_type):
         if data.get('_dataType', None) == sp_type:
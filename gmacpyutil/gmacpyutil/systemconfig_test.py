@@ -1,7 +1,13 @@
 """Unit tests for systemconfig module."""
 
+import os
+import plistlib
+import shutil
+import StringIO
 import struct
-
+import subprocess
+import sys
+import tempfile
 
 import mock
 
@@ -431,6 +437,319 @@ class SystemProfilerTest(basetest.TestCase):
     self.assertEqual(sp._cache, {'bar': 'contents'})
 
 
+class FakeNSString(object):
+  """Parses plists the way NSString.propertyList() would."""
+
+  def __init__(self, string):
+    self.string = string
+
+  @classmethod
+  def stringWithString_(cls, string):  # pylint: disable=g-bad-name
+    return cls(string)
+
+  def propertyList(self):  # pylint: disable=g-bad-name
+    return plistlib.readPlistFromString(self.string)
+
+
+class SystemProfilerPrefetchTest(basetest.TestCase):
+  """Test SystemProfiler.Prefetch."""
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.patches = [
+        mock.patch.dict(systemconfig.SystemProfiler._cache, clear=True),
+        mock.patch.object(systemconfig, 'NSString', FakeNSString),
+        mock.patch.object(systemconfig, '_BootTime', return_value=1),
+        mock.patch.object(
+            systemconfig.SystemProfiler, 'disk_cache',
+            systemconfig.SystemProfilerCache(self.tempdir)),
+        mock.patch.object(systemconfig.gmacpyutil, 'RunProcess',
+                          side_effect=self.RunProcess)]
+    for patch in self.patches:
+      patch.start()
+    self.argvs = []
+    self.data = {
+        'SPHardwareDataType': {'_dataType': 'SPHardwareDataType',
+                               '_items': [{'platform_UUID': 'UUID'}]},
+        'SPUSBDataType': {'_dataType': 'SPUSBDataType', '_items': []},
+        'SPNVMeDataType': {
+            '_dataType': 'SPNVMeDataType',
+            '_items': [{'_items': [{'bsd_name': 'disk0',
+                                    'device_serial': 'SERIAL'}]}]}}
+
+  def tearDown(self):
+    for patch in reversed(self.patches):
+      patch.stop()
+    shutil.rmtree(self.tempdir)
+
+  def RunProcess(self, argv):
+    self.argvs.append(argv)
+    return (plistlib.writePlistToString(
+        [self.data[t] for t in argv if t in self.data]), '', 0)
+
+  def testPrefetch(self):
+    sp = systemconfig.SystemProfiler()
+    sp.Prefetch(['SPHardwareDataType', 'SPUSBDataType', 'SPAudioDataType'])
+    self.assertEqual(
+        [['/usr/sbin/system_profiler', '-XML', '-detailLevel', 'mini',
+          'SPHardwareDataType', 'SPUSBDataType', 'SPAudioDataType']],
+        self.argvs)
+    self.assertEqual([self.data['SPUSBDataType']],
+                     sp._GetSystemProfile('SPUSBDataType', 'mini'))
+    self.assertEqual([], sp._GetSystemProfile('SPAudioDataType', 'mini'))
+    sp.Prefetch(['SPUSBDataType'])
+    self.assertEqual(1, len(self.argvs))
+
+  def testPrefetchFromDisk(self):
+    systemconfig.SystemProfiler().Prefetch(['SPHardwareDataType'],
+                                           detail_level=None)
+    systemconfig.SystemProfiler._cache.clear()
+    sp = systemconfig.SystemProfiler()
+    sp.Prefetch(['SPHardwareDataType', 'SPUSBDataType'], detail_level=None)
+    self.assertEqual(['SPUSBDataType'], self.argvs[1][2:])
+    self.assertEqual('UUID', sp.GetHWUUID())
+    self.assertEqual(2, len(self.argvs))
+
+  def testPrefetchBadOutput(self):
+    self.patches[-1].stop()
+    with mock.patch.object(systemconfig.gmacpyutil, 'RunProcess',
+                           return_value=('not xml', '', 0)):
+      self.assertRaises(systemconfig.SystemProfilerError,
+                        systemconfig.SystemProfiler().Prefetch,
+                        ['SPUSBDataType'])
+    self.patches[-1].start()
+
+  def testGetDiskSerialNumber(self):
+    sp = systemconfig.SystemProfiler()
+    self.assertEqual('SERIAL', sp.GetDiskSerialNumber())
+    self.assertEqual(
+        [['/usr/sbin/system_profiler', '-XML', 'SPSerialATADataType',
+          'SPNVMeDataType', 'SPHardwareRAIDDataType',
+          'SPParallelATADataType']],
+        self.argvs)
+
+
+class SystemProfilerExtractTest(basetest.TestCase):
+  """Test SystemProfilerExtractor and SystemProfiler.Extract."""
+
+  PATHS = ['SPHardwareDataType/_items/*/platform_UUID',
+           'SPUSBDataType/_items/1',
+           'SPUSBDataType/_items/*/_name',
+           'SPUSBDataType/_items/*/_items/*/vendor_id']
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.patches = [
+        mock.patch.dict(systemconfig.SystemProfiler._extracted, clear=True),
+        mock.patch.object(systemconfig, '_BootTime', return_value=1),
+        mock.patch.object(
+            systemconfig.SystemProfiler, 'disk_cache',
+            systemconfig.SystemProfilerCache(self.tempdir)),
+        mock.patch.object(systemconfig.gmacpyutil, 'RunProcessInBackground',
+                          side_effect=self.RunProcessInBackground)]
+    for patch in self.patches:
+      patch.start()
+    self.argvs = []
+    self.returncode = 0
+    self.bad_output = False
+    self.data = {
+        'SPHardwareDataType': {'_dataType': 'SPHardwareDataType',
+                               '_items': [{'platform_UUID': 'UUID',
+                                           'serial_number': 'SERIAL'}]},
+        'SPUSBDataType': {
+            '_dataType': 'SPUSBDataType',
+            '_items': [{'_name': 'USB31Bus', '_items': [
+                           {'_name': u'Hub \u2013 1', 'vendor_id': 1452,
+                            'removable': True}]},
+                       {'_name': 'USB20Bus', 'speed': 1.5,
+                        'data': plistlib.Data('\x00\x01')}]}}
+
+  def tearDown(self):
+    for patch in reversed(self.patches):
+      patch.stop()
+    shutil.rmtree(self.tempdir)
+
+  def Output(self, sp_types):
+    if self.bad_output:
+      return '<plist><array><dict></array></plist>'
+    return plistlib.writePlistToString(
+        [self.data[t] for t in sp_types if t in self.data])
+
+  def RunProcessInBackground(self, argv):
+    self.argvs.append(argv)
+    task = mock.Mock()
+    task.stdout = StringIO.StringIO(self.Output(argv))
+    task.stderr = StringIO.StringIO('')
+    task.wait.return_value = self.returncode
+    self.task = task
+    return task
+
+  def testExtractor(self):
+    extractor = systemconfig.SystemProfilerExtractor(self.PATHS)
+    sp_xml = self.Output(['SPHardwareDataType', 'SPUSBDataType'])
+    for i in xrange(0, len(sp_xml), 7):
+      extractor.Feed(sp_xml[i:i + 7])
+    results = extractor.Close()
+    self.assertEqual(
+        {'SPHardwareDataType/_items/*/platform_UUID': ['UUID'],
+         'SPUSBDataType/_items/1': [self.data['SPUSBDataType']['_items'][1]],
+         'SPUSBDataType/_items/*/_name': ['USB31Bus', 'USB20Bus'],
+         'SPUSBDataType/_items/*/_items/*/vendor_id': [1452]},
+        results)
+    extractor.Feed(self.Output(['SPHardwareDataType']))
+    extractor.Close()
+    self.assertEqual(['UUID', 'UUID'],
+                     results['SPHardwareDataType/_items/*/platform_UUID'])
+
+  def testExtractorDataTypeLast(self):
+    extractor = systemconfig.SystemProfilerExtractor(
+        ['SPHardwareDataType/_items/*/platform_UUID'])
+    extractor.Feed('<plist><array><dict><key>_items</key><array><dict>'
+                   '<key>platform_UUID</key><string>UUID</string></dict>'
+                   '</array><key>_dataType</key><string>SPUSBDataType</string>'
+                   '</dict></array></plist>')
+    self.assertEqual(
+        {'SPHardwareDataType/_items/*/platform_UUID': []}, extractor.Close())
+
+  def testExtract(self):
+    sp = systemconfig.SystemProfiler()
+    results = sp.Extract(self.PATHS)
+    self.assertEqual(
+        [['/usr/sbin/system_profiler', '-XML', 'SPHardwareDataType',
+          'SPUSBDataType']], self.argvs)
+    self.assertEqual(['UUID'],
+                     results['SPHardwareDataType/_items/*/platform_UUID'])
+    self.assertEqual(['USB31Bus', 'USB20Bus'],
+                     results['SPUSBDataType/_items/*/_name'])
+    self.assertEqual(results, sp.Extract(self.PATHS))
+    self.assertEqual(1, len(self.argvs))
+
+  def testExtractFromDisk(self):
+    sp = systemconfig.SystemProfiler()
+    sp.disk_cache.Write('SPHardwareDataType',
+                        self.Output(['SPHardwareDataType']))
+    results = sp.Extract(self.PATHS)
+    self.assertEqual([['/usr/sbin/system_profiler', '-XML', 'SPUSBDataType']],
+                     self.argvs)
+    self.assertEqual(['UUID'],
+                     results['SPHardwareDataType/_items/*/platform_UUID'])
+
+  def testExtractFromDiskOncePerType(self):
+    sp = systemconfig.SystemProfiler()
+    sp.disk_cache.Write('SPUSBDataType', self.Output(['SPUSBDataType']))
+    results = sp.Extract(['SPUSBDataType/_items/*/_name',
+                          'SPUSBDataType/_items/1/speed'])
+    self.assertEqual([], self.argvs)
+    self.assertEqual(['USB31Bus', 'USB20Bus'],
+                     results['SPUSBDataType/_items/*/_name'])
+    self.assertEqual([1.5], results['SPUSBDataType/_items/1/speed'])
+
+  def testExtractLargeStderr(self):
+    def RunProcessInBackground(argv):
+      return subprocess.Popen(
+          [sys.executable, '-c',
+           'import sys; sys.stderr.write("warning\\n" * 100000); '
+           'sys.stdout.write(%r)' % self.Output(argv)],
+          stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+          stderr=subprocess.PIPE)
+    with mock.patch.object(systemconfig.gmacpyutil, 'RunProcessInBackground',
+                           side_effect=RunProcessInBackground):
+      results = systemconfig.SystemProfiler().Extract(self.PATHS)
+    self.assertEqual(['UUID'],
+                     results['SPHardwareDataType/_items/*/platform_UUID'])
+
+  def testExtractFails(self):
+    self.returncode = 1
+    self.assertRaises(systemconfig.SystemProfilerError,
+                      systemconfig.SystemProfiler().Extract, self.PATHS)
+
+  def testExtractBadOutput(self):
+    self.bad_output = True
+    self.assertRaises(systemconfig.SystemProfilerError,
+                      systemconfig.SystemProfiler().Extract,
+                      ['SPUSBDataType/_items'])
+    self.task.kill.assert_called_once_with()
+
+
+class SystemProfilerCacheTest(basetest.TestCase):
+  """Test systemconfig.SystemProfilerCache class."""
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.cache_dir = os.path.join(self.tempdir, 'cache')
+    self.ttls = {'SPHardwareDataType': systemconfig.UNTIL_REBOOT,
+                 'SPUSBDataType': 300}
+    self.fetch = mock.Mock(side_effect=lambda sp_type: '<xml %s>' % sp_type)
+    self.boot_time = mock.patch.object(systemconfig, '_BootTime',
+                                       return_value=1400000000)
+    self.boot_time.start()
+
+  def tearDown(self):
+    self.boot_time.stop()
+    shutil.rmtree(self.tempdir)
+
+  def Cache(self):
+    return systemconfig.SystemProfilerCache(self.cache_dir, ttls=self.ttls)
+
+  def testSharedBetweenInstances(self):
+    for _ in range(2):
+      self.assertEqual('<xml SPHardwareDataType>',
+                       self.Cache().Get('SPHardwareDataType', self.fetch))
+    self.assertEqual(1, self.fetch.call_count)
+
+  def testUntilReboot(self):
+    self.Cache().Get('SPHardwareDataType', self.fetch)
+    systemconfig._BootTime.return_value = 1400000500
+    self.Cache().Get('SPHardwareDataType', self.fetch)
+    self.assertEqual(2, self.fetch.call_count)
+
+  @mock.patch.object(systemconfig.time, 'time')
+  def testTTL(self, mock_time):
+    mock_time.return_value = 1000.0
+    self.Cache().Get('SPUSBDataType', self.fetch)
+    mock_time.return_value = 1299.0
+    self.Cache().Get('SPUSBDataType', self.fetch)
+    self.assertEqual(1, self.fetch.call_count)
+    mock_time.return_value = 1300.0
+    self.Cache().Get('SPUSBDataType', self.fetch)
+    self.assertEqual(2, self.fetch.call_count)
+
+  def testNotCachedType(self):
+    for _ in range(2):
+      self.Cache().Get('SPAudioDataType', self.fetch)
+    self.assertEqual(2, self.fetch.call_count)
+    self.assertFalse(os.path.exists(self.cache_dir))
+
+  def testSharedCacheDirIgnored(self):
+    os.makedirs(self.cache_dir)
+    os.chmod(self.cache_dir, 0777)
+    for _ in range(2):
+      self.Cache().Get('SPHardwareDataType', self.fetch)
+    self.assertEqual(2, self.fetch.call_count)
+    self.assertEqual([], os.listdir(self.cache_dir))
+
+  def testFetchError(self):
+    self.fetch.side_effect = systemconfig.SystemProfilerError('failed')
+    self.assertRaises(systemconfig.SystemProfilerError, self.Cache().Get,
+                      'SPHardwareDataType', self.fetch)
+    self.assertFalse(os.path.exists(
+        os.path.join(self.cache_dir, 'SPHardwareDataType.xml')))
+
+  @mock.patch.object(systemconfig.gmacpyutil, 'RunProcess')
+  def testBootTime(self, mock_rp):
+    self.boot_time.stop()
+    try:
+      mock_rp.return_value = (
+          '{ sec = 1400000000, usec = 0 } Tue May 13 16:53:20 2014\n', '', 0)
+      systemconfig._boot_time = None
+      self.assertEqual(1400000000, systemconfig._BootTime())
+      self.assertEqual(1400000000, systemconfig._BootTime())
+      self.assertEqual(1, mock_rp.call_count)
+    finally:
+      systemconfig._boot_time = None
+      self.boot_time.start()
+
+
 def main(unused_argv):
   basetest.main()
 